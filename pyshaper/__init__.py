@@ -28,8 +28,52 @@ shaperPeriod = 30
 # where pyshaper sticks its pidfile
 pidfile = "/var/run/pyshaper.pid"
 
-# command we use to discover existing TCP connections
-netstatCmd = "netstat -e -e -e -v --inet -p --numeric-ports"
+# how we discover existing TCP connections - 'netlink' dumps them in bulk
+# via sock_diag, 'proc' reads the kernel's socket table from /proc/net/tcp,
+# 'netstat' runs netstatCmd and parses its output. Each one falls back
+# on the ones after it if it can't be used
+connBackend = "proc"
+
+# kernel's table of current TCP sockets, for the 'proc' backend
+procNetTcp = "/proc/net/tcp"
+
+# command we use to discover existing TCP connections, for the 'netstat'
+# backend (also used as a fallback if the 'proc' backend fails)
+netstatCmd = "netstat -e -e -e -v --inet -p --numeric-hosts --numeric-ports"
+
+# how we set up qdiscs, classes and filters - 'netlink' sends them straight
+# to the kernel over an rtnetlink socket, 'tc' feeds tc commands to a
+# 'tc -batch' process. 'netlink' falls back on 'tc' if it can't be used
+tcBackend = "tc"
+
+# rebuild a device's qdiscs make-before-break - building the new tree
+# alongside the old one, which carries on shaping until the new one's
+# complete - rather than deleting everything and starting again, which
+# leaves the link unshaped for a moment. Needs the prio qdisc
+makeBeforeBreak = True
+
+# how often, in seconds, to read back the qdiscs, classes and filters on
+# our devices and put right anything that's not as we left it (0 to
+# disable) - and where we keep what we left, for 'pyshaper verify'
+verifyPeriod = 300
+tcStatePath = "/var/run/pyshaper.tc"
+
+# where we remember the tc class ids we've given each class
+classIdsPath = "/etc/pyshaper/classids"
+
+# optional local database of IP ranges -> countries, in CSV form, used for
+# the 'cc' and 'country' test attributes in preference to the GeoIP module
+geoipCsvPath = "/etc/pyshaper/geoip.csv"
+
+# how many remote addresses to remember the countries of
+geoipCacheSize = 65536
+
+# how many connections to remember the classifications of
+classCacheSize = 65536
+
+# classify new connections in bulk with NumPy, if it's installed, when
+# there are at least this many of them on an interface (0 to disable)
+vectorMinConns = 2000
 
 # default verbosity of output messages
 verbosity = 2
@@ -0,0 +1,302 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Builds classic BPF programs for tc's bpf classifier, for interfaces
+using the 'bpf' classifier
+
+A program picks the remote address, the two ports and the local
+address out of each TCP packet, and looks for the connection in a
+binary search tree of all the connections we're shaping - on the
+remote address first, then the ports, then the local address -
+returning the connection's class. The static classes' rules get
+tried before that, in the order they're configured
+
+Everything gets loaded relative to the network header, so the
+programs work whatever the link layer is
+"""
+
+import socket
+import struct
+
+# instruction classes
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+
+# load sizes and modes
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_MSH = 0xa0
+
+# alu and jump operations
+BPF_AND = 0x50
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+BPF_K = 0x00
+
+# offsets from here on load from the network header
+SKF_NET_OFF = -0x100000
+
+IPPROTO_TCP = 6
+
+# the kernel takes up to 4096 instructions, but tc only has room for
+# about 2000 in its 16k netlink message, along with any police action
+maxInsns = 1800
+
+# where the prologue stores each part of the key - the remote address,
+# both ports as one word (source port in the high half), and the local
+# address
+REMOTE, PORTS, LOCAL = range(3)
+
+# what a program returns for a match, to have the filter's own classid
+# and actions used
+inClass = 0xffffffffL
+
+
+class BpfError(Exception):
+    pass
+
+
+def insn(code, jt=0, jf=0, k=0):
+    return (code, jt, jf, k & 0xffffffffL)
+
+
+def ldAbs(size, off):
+    return insn(BPF_LD | size | BPF_ABS, k=SKF_NET_OFF + off)
+
+
+def ldMem(slot):
+    return insn(BPF_LD | BPF_MEM, k=slot)
+
+
+def stMem(slot):
+    return insn(BPF_ST, k=slot)
+
+
+def ret(value):
+    return insn(BPF_RET | BPF_K, k=value)
+
+
+def prologue(egress, nomatch):
+    """
+    Checks the packet is TCP, and not a later fragment, then stores
+    its key parts in scratch memory. Going out, the local address is
+    the source, coming in, the remote one is
+    """
+    if egress:
+        remote, local = 16, 12
+    else:
+        remote, local = 12, 16
+    return [
+        ldAbs(BPF_B, 9),
+        insn(BPF_JMP | BPF_JEQ | BPF_K, 1, 0, IPPROTO_TCP),
+        ret(nomatch),
+        ldAbs(BPF_H, 6),
+        insn(BPF_JMP | BPF_JSET | BPF_K, 0, 1, 0x1fff),
+        ret(nomatch),
+        ldAbs(BPF_W, remote),
+        stMem(REMOTE),
+        ldAbs(BPF_W, local),
+        stMem(LOCAL),
+        # X = ip header length
+        insn(BPF_LDX | BPF_B | BPF_MSH, k=SKF_NET_OFF),
+        insn(BPF_LD | BPF_W | BPF_IND, k=SKF_NET_OFF),
+        stMem(PORTS),
+    ]
+
+
+def ruleCode(conds, result):
+    """
+    Code which returns result if every one of conds - (slot, mask,
+    value) tuples - holds, and otherwise carries on after it
+    """
+    code = [ret(result)]
+    for slot, mask, value in reversed(conds):
+        test = [ldMem(slot)]
+        if mask != 0xffffffffL:
+            test.append(insn(BPF_ALU | BPF_AND | BPF_K, k=mask))
+        test.append(insn(BPF_JMP | BPF_JEQ | BPF_K, 0, len(code), value & mask))
+        code = test + code
+    return code
+
+
+def searchCode(entries, level, nomatch):
+    """
+    Code which looks for the key in slots level onwards among entries,
+    a sorted list of (key, result), returning the result it finds or
+    nomatch
+    """
+    # group the entries on this level's part of the key
+    values = []
+    groups = {}
+    for key, result in entries:
+        if key[level] not in groups:
+            values.append(key[level])
+            groups[key[level]] = []
+        groups[key[level]].append((key, result))
+
+    leaves = []
+    for value in values:
+        group = groups[value]
+        if len(group) == 1:
+            leaves.append(chainCode(group[0][0], level, group[0][1], nomatch))
+        else:
+            leaves.append([insn(BPF_JMP | BPF_JEQ | BPF_K, 1, 0, value),
+                           ret(nomatch)]
+                          + searchCode(group, level + 1, nomatch))
+
+    return [ldMem(level)] + treeCode(values, leaves, 0, len(values))
+
+
+def chainCode(key, level, result, nomatch):
+    """
+    Code which checks the rest of a key with nothing else under it in
+    the tree, from level on - the part for level's already loaded
+    """
+    code = []
+    checks = []
+    for i in range(level, len(key)):
+        if i > level:
+            code.append(ldMem(i))
+        checks.append((len(code), key[i]))
+        code.append(None)
+    # each check goes on to the next, or to the nomatch at the end
+    end = len(code) + 1
+    for pos, value in checks:
+        code[pos] = insn(BPF_JMP | BPF_JEQ | BPF_K, 0, end - pos - 1, value)
+    return code + [ret(result), ret(nomatch)]
+
+
+def treeCode(values, leaves, lo, hi):
+    """
+    Binary search over values[lo:hi], whose code when found is in
+    leaves. Jumps can only go 255 instructions forward, so a longer
+    way round gets taken past big subtrees
+    """
+    if hi - lo == 1:
+        return leaves[lo]
+    mid = (lo + hi) / 2
+    left = treeCode(values, leaves, lo, mid)
+    right = treeCode(values, leaves, mid, hi)
+    if len(left) <= 255:
+        return [insn(BPF_JMP | BPF_JGE | BPF_K, len(left), 0, values[mid])] \
+            + left + right
+    return [insn(BPF_JMP | BPF_JGE | BPF_K, 0, 1, values[mid]),
+            insn(BPF_JMP | BPF_JA, k=len(left))] + left + right
+
+
+class Classifier:
+    """
+    Collects the rules and connections for one program, and builds it
+
+    Going out (egress true), a program returns the classid of the
+    packet's class. Coming in, each class gets a program of its own,
+    which just says whether the packet's in the class (see program)
+    """
+
+    def __init__(self, egress):
+
+        self.egress = egress
+        self.rules = []
+        self.conns = {}
+
+    def addRule(self, result, raddr=None, rport=None, laddr=None, lport=None):
+        """
+        Adds a static rule, on whichever of the remote address (which
+        may be a CIDR block), remote port, local address and local port
+        are given
+        """
+        conds = []
+        if raddr:
+            addr, mask = parsePrefix(raddr)
+            conds.append((REMOTE, mask, addr))
+        if laddr:
+            addr, mask = parsePrefix(laddr)
+            conds.append((LOCAL, mask, addr))
+        if self.egress:
+            localShift, remoteShift = 16, 0
+        else:
+            localShift, remoteShift = 0, 16
+        if rport:
+            conds.append((PORTS, 0xffff << remoteShift, int(rport) << remoteShift))
+        if lport:
+            conds.append((PORTS, 0xffff << localShift, int(lport) << localShift))
+        self.rules.append((conds, result))
+
+    def addConn(self, result, laddr, lport, raddr, rport):
+
+        if self.egress:
+            ports = (int(lport) << 16) | int(rport)
+        else:
+            ports = (int(rport) << 16) | int(lport)
+        key = (parsePrefix(raddr)[0], ports, parsePrefix(laddr)[0])
+        self.conns.setdefault(key, result)
+
+    def __len__(self):
+        return len(self.rules) + len(self.conns)
+
+    def program(self, nomatch=0):
+        """
+        Returns the program, as a list of (code, jt, jf, k) - raises
+        BpfError if it's too long
+        """
+        code = prologue(self.egress, nomatch)
+        for conds, result in self.rules:
+            code.extend(ruleCode(conds, result))
+        if self.conns:
+            entries = self.conns.items()
+            entries.sort()
+            code.extend(searchCode(entries, 0, nomatch))
+        code.append(ret(nomatch))
+        if len(code) > maxInsns:
+            raise BpfError("program needs %d instructions, more than %d" % (
+                len(code), maxInsns))
+        return code
+
+
+def parsePrefix(s):
+    """
+    Parses an address or CIDR block into (address, mask) ints
+    """
+    addr = s
+    plen = 32
+    try:
+        if "/" in s:
+            addr, plen = s.split("/", 1)
+            plen = int(plen)
+        value = struct.unpack("!L", socket.inet_aton(addr))[0]
+    except (ValueError, socket.error):
+        raise BpfError("bad address '%s'" % s)
+    if not 0 <= plen <= 32:
+        raise BpfError("bad address '%s'" % s)
+    mask = (0xffffffffL << (32 - plen)) & 0xffffffffL
+    return value & mask, mask
+
+
+def bytecode(prog):
+    """
+    Formats prog the way tc's 'bytecode' option takes it
+    """
+    return "%d,%s" % (len(prog), ",".join(
+        ["%d %d %d %d" % i for i in prog]))
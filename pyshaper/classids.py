@@ -0,0 +1,138 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Gives each class a tc classid of its own, which it keeps
+
+Classes get the minor numbers of their htb classids (which are also
+their marks, and the majors of their leaf qdiscs unless devices get
+rebuilt make-before-break) from here, keyed on
+'<iface>.<class>'. Numbers get remembered in a file, so a class keeps
+its number across config reloads and restarts, and adding or removing
+a class leaves every other class's tc setup alone. Numbers are unique
+across all interfaces, so marks are too
+"""
+
+import os
+
+
+class ClassIdError(Exception):
+    pass
+
+
+class ClassIds:
+    """
+    Hands out class minor numbers, saving them in the file at path
+    """
+
+    # the default class's
+    defaultMinor = 0x1000
+
+    # taken by the root qdisc (1:), the root class (1:1), the default
+    # class (1:1000), and the ingress qdisc (ffff:)
+    reserved = [0, 1, defaultMinor, 0xffff]
+
+    # where to start looking for free numbers
+    first = 0x101
+
+    def __init__(self, path):
+
+        self.path = path
+
+        # '<iface>.<class>' -> minor
+        self.ids = {}
+        self.used = {}
+        for minor in self.reserved:
+            self.used[minor] = None
+        self.next = self.first
+        self.changed = False
+
+        self.load()
+
+    def load(self):
+        """
+        Reads in the numbers we gave out before, if we have them
+        """
+        try:
+            f = file(self.path)
+        except IOError:
+            return
+        for line in f.readlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                key, minor = line.split()
+                minor = int(minor, 16)
+            except ValueError:
+                continue
+            if minor in self.used or key in self.ids or not 0 < minor < 0xffff:
+                continue
+            self.ids[key] = minor
+            self.used[minor] = key
+        f.close()
+
+    def save(self):
+        """
+        Writes out the numbers, if any have been given out since we
+        last did - raises IOError if we can't
+        """
+        if not self.changed:
+            return
+        pathNew = self.path + ".new"
+        f = file(pathNew, "w")
+        f.write("# pyshaper class ids - <iface>.<class> <minor, in hex>\n")
+        items = self.ids.items()
+        items.sort()
+        for key, minor in items:
+            f.write("%s %x\n" % (key, minor))
+        f.close()
+        os.rename(pathNew, self.path)
+        self.changed = False
+
+    def get(self, iface, name):
+        """
+        Returns the minor number of class name on interface iface,
+        giving it one if it doesn't have one yet
+        """
+        key = "%s.%s" % (iface, name)
+        try:
+            return self.ids[key]
+        except KeyError:
+            pass
+
+        minor = self.next
+        while minor in self.used:
+            minor += 1
+            if minor > 0xffff:
+                minor = 2
+            if minor == self.next:
+                raise ClassIdError("No class ids left for %s" % key)
+        self.ids[key] = minor
+        self.used[minor] = key
+        self.next = minor + 1
+        self.changed = True
+        return minor
+
+    def name(self, iface, minor):
+        """
+        Returns the name of the class on interface iface with minor
+        number minor, or None
+        """
+        if minor == self.defaultMinor:
+            return 'default'
+        key = self.used.get(minor, None)
+        if key is None or not key.startswith(iface + "."):
+            return None
+        return key[len(iface) + 1:]
@@ -17,10 +17,15 @@ import traceback
 
 import os
 import re
+import socket
+
+from collections import OrderedDict
 
 import pyshaper
 
-from pyshaper.util import staticItemMatch
+from pyshaper import prefix, rules, tcmodel, vector
+from pyshaper.conn import Conn
+from pyshaper.util import addrToInt, staticItemMatch
 
 
 class ShaperConfig:
@@ -42,6 +47,7 @@ class ShaperConfig:
         'expr',
         'bwIn',
         'bwOut',
+        'filterMode',
         'name',
         'parent',
     ]
@@ -78,6 +84,13 @@ class ShaperConfig:
         self.interfacesdict = {}
         self.interfaces = []
 
+        # classifications made under the old rules are no use now
+        self.classCache = ClassCache()
+
+        # (name, path) of each prefix list, in file order
+        self.prefixLists = []
+        prefix.lists.clear()
+
         # rip comments
         raw = reComment.sub("\n", raw)
 
@@ -103,6 +116,128 @@ class ShaperConfig:
         for item, val in cmds:
             self.execute(item, val)
 
+        # compile each interface's rules into a classifier function
+        for iface in self.interfaces:
+            iface.compile()
+
+        self.indexAddrs()
+        self.fields = self.usedFields()
+
+
+
+    def classify(self, conn):
+        """
+        Returns the class which connection conn belongs in, on the
+        interface whose address it's on, or None if it's not on
+        any of our interfaces
+
+        Results are kept in self.classCache, so a connection's rules
+        only get evaluated the first time it's seen
+        """
+        iface = self.ifaceFor(conn.laddr)
+        if iface is None:
+            return None
+
+        cache = self.classCache
+        ident = conn.ident
+        try:
+            return cache.get(ident)
+        except KeyError:
+            pass
+
+        cls = iface.classify(conn)
+        cache.put(ident, cls)
+        return cls
+
+    def classifyAll(self, conns):
+        """
+        Like classify(), but for a whole TCPConns at once - returns a
+        list of the class each connection belongs in, or None for
+        those not on any of our interfaces
+
+        Connections not found in self.classCache are grouped by
+        interface, and big enough groups are classified in one go
+        by the interface's VectorClassifier
+        """
+        table = conns.table
+        laddrs = table.laddr
+        cache = self.classCache
+        ifaces = self.addrIntIfaces
+        result = [None] * len(conns)
+
+        # rows of the connections we've not seen before, per interface
+        pending = {}
+        for row in xrange(len(result)):
+            iface = ifaces.get(laddrs[row], None)
+            if iface is None:
+                # not on an address we shape
+                continue
+
+            try:
+                result[row] = cache.get(table.ident(row))
+            except KeyError:
+                pending.setdefault(iface.name, []).append(row)
+
+        for name, rows in pending.items():
+            iface = self.interfacesdict[name]
+            if iface.vectorClassifier is not None \
+                    and len(rows) >= pyshaper.vectorMinConns:
+                idxs = iface.vectorClassifier.classify(table, rows)
+            else:
+                classifier = iface.classifier
+                idxs = [classifier(Conn(table, row)) for row in rows]
+            for row, idx in zip(rows, idxs):
+                if idx < 0:
+                    cls = iface.default
+                else:
+                    cls = iface.classes[idx]
+                cache.put(table.ident(row), cls)
+                result[row] = cls
+
+        return result
+
+    def ifaceFor(self, localip):
+        """
+        Returns the interface with address localip, or None
+        """
+        return self.addrIfaces.get(localip, None)
+
+    def indexAddrs(self):
+        """
+        Builds the maps of local address -> interface, both by dotted
+        quad (self.addrIfaces) and by int (self.addrIntIfaces). If two
+        interfaces claim an address, the first one gets it
+        """
+        self.addrIfaces = {}
+        self.addrIntIfaces = {}
+        for iface in self.interfaces:
+            for addr in iface.ipaddrs:
+                if addr in self.addrIfaces:
+                    print "%s: address %s is already on interface %s" % (
+                        iface.name, addr, self.addrIfaces[addr].name)
+                    continue
+                self.addrIfaces[addr] = iface
+                try:
+                    self.addrIntIfaces[addrToInt(addr)] = iface
+                except socket.error:
+                    # not a dotted quad, so no connection will be on it
+                    pass
+
+    def usedFields(self):
+        """
+        Returns a list of the connection attributes which any
+        class's test expressions refer to, so that TCPConns need
+        only look up those
+        """
+        fields = []
+        for iface in self.interfaces:
+            for cls in iface.classes:
+                for field in cls.fields:
+                    if field not in fields:
+                        fields.append(field)
+        return fields
+
+
 
 
     def execute(self, item, val=None):
@@ -121,6 +256,14 @@ class ShaperConfig:
         elif item == 'guiheight':
             self.guiHeight = int(val)
             return
+        elif item == 'prefixes':
+            try:
+                name, path = self.reSpaces.split(val.strip(), 1)
+            except ValueError:
+                raise Exception("Bad line in %s: %s %s (should be"
+                                " 'prefixes <name> <path>')" % (self.path, item, val))
+            self.addPrefixList(name, path)
+            return
 
         try:
             ifname, rest = item.split(".", 1)
@@ -145,7 +288,13 @@ class ShaperConfig:
             ifrec.bwOut = float(val)
             return
         if rest == 'ip':
-            ifrec.ipaddr = val
+            ifrec.setAddrs(val)
+            return
+        if rest == 'filters':
+            if val not in ShaperConfigIface.filterModes:
+                raise Exception("Bad line in %s: %s %s (should be one of %s)" % (
+                    self.path, item, val, ", ".join(ShaperConfigIface.filterModes)))
+            ifrec.filterMode = val
             return
 
         # not magic - take as class name
@@ -163,7 +312,11 @@ class ShaperConfig:
 
         # process magic names
         if rest in ['pri', 'priority']:
-            clsrec.pri = int(val)
+            pri = int(val)
+            if not 0 <= pri < tcmodel.maxFilterPrio:
+                raise Exception("Priority of '%s.%s' must be from 0 to %s" % (
+                    ifname, clsname, tcmodel.maxFilterPrio - 1))
+            clsrec.pri = pri
             return
         if rest == 'in':
             clsrec.bwIn = float(val)
@@ -188,6 +341,20 @@ class ShaperConfig:
 
 
 
+    def addPrefixList(self, name, path):
+        """
+        Loads the file of CIDR blocks at path (relative to the config
+        file's directory) as the prefix list 'name', for tests like
+        "raddr in prefixes('name')"
+        """
+        fullpath = os.path.join(os.path.dirname(self.path), path)
+        try:
+            trie = prefix.loadPrefixFile(fullpath, name)
+        except (IOError, ValueError), e:
+            raise Exception("Can't load prefix list '%s': %s" % (name, e))
+        prefix.lists[name] = trie
+        self.prefixLists.append((name, path))
+
     def save(self, hasChanged=False):
         """
         Writes the configuration out to disk, if changed
@@ -228,6 +395,12 @@ class ShaperConfig:
             "",
             ]))
 
+        if self.prefixLists:
+            f.write("# lists of address prefixes, for prefixes() in tests\n")
+            for name, listpath in self.prefixLists:
+                f.write("prefixes %s %s\n" % (name, listpath))
+            f.write("\n\n")
+
         for iface in self.interfaces:
             iface.save(f)
             f.write("\n")
@@ -265,6 +438,51 @@ class ShaperConfig:
 
 
 
+class ClassCache:
+    """
+    Remembers which class each connection was put in, keyed on the
+    connection's (laddr, lport, raddr, rport, pid, starttime) - none
+    of the attributes rules can test change over the life of a
+    connection, so neither does its class
+
+    Holds at most 'size' connections, dropping the least recently
+    seen ones first. Needs flushing whenever the rules change
+    """
+
+    def __init__(self, size=pyshaper.classCacheSize):
+
+        self.size = size
+        self.classes = OrderedDict()
+
+    def get(self, ident):
+        """
+        Returns the cached class for ident, raising KeyError if
+        there isn't one
+        """
+        classes = self.classes
+        cls = classes.pop(ident)
+        classes[ident] = cls
+        return cls
+
+    def put(self, ident, cls):
+
+        classes = self.classes
+        if ident not in classes and len(classes) >= self.size:
+            classes.popitem(last=False)
+        classes[ident] = cls
+
+    def discard(self, ident):
+
+        self.classes.pop(ident, None)
+
+    def clear(self):
+
+        self.classes.clear()
+
+    def __len__(self):
+        return len(self.classes)
+
+
 class ShaperConfigIface:
     """
     Holds the config info for a specific interface
@@ -274,6 +492,12 @@ class ShaperConfigIface:
     bwIn = 1024 * 1024   # default 1Gbit/sec - ridiculous
     bwOut = 1024 * 1024
 
+    # how connections get sorted into classes - see pyshaper.conf.readme
+    filterModes = ['u32', 'flower', 'mark', 'bpf']
+    filterMode = 'u32'
+
+    reAddrDelim = re.compile("[\\s,]+")
+
 
     def __init__(self, name):
 
@@ -290,8 +514,38 @@ class ShaperConfigIface:
         dflt.bwIn = self.bwIn
         dflt.bwOut = self.bwOut
 
-        self.ipaddr = '0.0.0.0'
+        self.setAddrs('0.0.0.0')
+
 
+    def setAddrs(self, val):
+        """
+        Sets our local address(es), from the value of an '<iface>.ip'
+        line - one or more addresses, separated by spaces or commas.
+        The first is the primary one, self.ipaddr
+        """
+        self.ipaddrs = self.reAddrDelim.split(val.strip())
+        self.ipaddr = self.ipaddrs[0]
+
+    def compile(self):
+        """
+        Compiles the rules of all our classes into self.classifier
+        """
+        self.classifier = rules.compileIface(self)
+        if vector.numpy and pyshaper.vectorMinConns:
+            self.vectorClassifier = vector.VectorClassifier(self)
+        else:
+            self.vectorClassifier = None
+
+    def classify(self, conn):
+        """
+        Returns the class which connection conn belongs in - the
+        first static class it matches, otherwise the first class
+        it matches, otherwise the default class
+        """
+        idx = self.classifier(conn)
+        if idx < 0:
+            return self.default
+        return self.classes[idx]
 
     def __getattr__(self, name):
         """convenience for interactive debugging"""
@@ -321,7 +575,7 @@ class ShaperConfigIface:
     def __str__(self):
 
         s = "%s: ip=%s in=%s out=%s" % \
-        (self.name, self.ipaddr, self.bwIn, self.bwOut)
+        (self.name, ",".join(self.ipaddrs), self.bwIn, self.bwOut)
         if self.classes:
             s += "\n" + "\n".join([str(cls) for cls in self.classes])
         s += "\n" + str(self.default)
@@ -336,10 +590,12 @@ class ShaperConfigIface:
         """
         name = self.name
         f.write("\n".join([
-            "%s.ip %s" % (name, self.ipaddr),
+            "%s.ip %s" % (name, " ".join(self.ipaddrs)),
             "%s.in %s" % (name, self.bwIn),
             "%s.out %s" % (name, self.bwOut),
         ]) + "\n")
+        if self.filterMode != ShaperConfigIface.filterMode:
+            f.write("%s.filters %s\n" % (name, self.filterMode))
         for cls in self.classes:
             cls.save(f)
         self.default.save(f)
@@ -360,9 +616,6 @@ class ShaperConfigClass:
     laddr = None
     lport = None
 
-    # window size in seconds for calculating rates
-    rateWindow1 = 5.0
-
     def __init__(self, parent, name):
 
         self.parent = parent
@@ -375,16 +628,12 @@ class ShaperConfigClass:
 
         self.tests = []
         self.exprs = []
+        self.fields = []
 
-        # these lists are for dynamic monitoring via the gui
-        self.pktInHist = []  # list of (time, size) tuples for inbound pkts
-        self.pktOutHist = []  # ditto for outbound packets
-
+        # set from the kernel's counters by the gui
         self.rateIn = 0.0
         self.rateOut = 0.0
 
-        self.silly = "xxx"
-
     def __getattr__(self, name):
         """
         convenience for interactive debugging
@@ -401,6 +650,9 @@ class ShaperConfigClass:
         if name == 'ipaddr':
             self.ipaddr = parent.ipaddr
             return parent.ipaddr
+        if name == 'ipaddrs':
+            self.ipaddrs = parent.ipaddrs
+            return parent.ipaddrs
 
         if name in ['__nonzero__', '__len__']:
             raise AttributeError(name)
@@ -463,18 +715,15 @@ class ShaperConfigClass:
         Adds a test to this bw class
         """
         # convert expr into a valid lambda func
-        self.exprs.append(expr)
         try:
-            for term in ['cc', 'country',
-                         'cmd', 'args',
-                         'laddr', 'lport', 'raddr', 'rport',
-                         'user']:
-                expr = expr.replace(term, 'f.' + term)
-            test = eval("lambda f:" + expr)
-            self.tests.append(test)
-        except:
-            traceback.print_exc()
-            raise Exception("Invalid test expression '%s'" % expr)
+            test = rules.compileTest(expr)
+        except rules.RuleError, e:
+            raise Exception(str(e))
+        self.exprs.append(expr)
+        self.tests.append(test)
+        for field in rules.testFields(rules.parseTest(expr)):
+            if field not in self.fields:
+                self.fields.append(field)
 
     def save(self, f):
         """
@@ -536,112 +785,6 @@ class ShaperConfigClass:
                     return True
             return False
 
-    def matchesPacket(self, src, sport, dst, dport, dynamic=False):
-        """
-        return True if a packet, specified  by src, sport, dst, dport matches either
-        our static rule, or matches one or more connections currently known to this class
-        """
-        f = staticItemMatch
-
-        if 0:
-            if self.name == 'local-apache' and sport not in [22,
-                                                             25] and dport not in [
-                22, 25]:
-                raddr = self.raddr
-                rport = self.rport
-                laddr = self.laddr
-                lport = self.lport
-
-                print "----vvv----------------------"
-                print "cls.matchesPacket: trying to match packet %s:%s->%s:%s against class %s" % (
-                    repr(src), repr(sport), repr(dst), repr(dport), self.name)
-                print "mode=%s" % self.mode
-                print "raddr=%s rport=%s laddr=%s lport=%s" % (
-                    repr(raddr), repr(rport), repr(laddr), repr(lport))
-                print "----^^^----------------------"
-
-        # test for dynamic match
-        # print "-------------------"
-        if dynamic:
-            for conn in self.conns:
-                # print "XXX", conn
-                if conn.matchesPacket(src, sport, dst, dport):
-                    # print "dynamic match %s: %s:%s -> %s:%s" % (
-                    #    self.name, src, sport, dst, dport)
-                    return True
-        else:
-            # test for static match
-            if self.mode == 'static':
-                raddr = self.raddr
-                rport = self.rport
-                laddr = self.laddr
-                lport = self.lport
-
-                if ((f(raddr, src) and f(rport,
-                                         sport) and self.ipaddr == dst and f(
-                        lport, dport))
-                        or
-                        (f(raddr, dst) and f(rport,
-                                             dport) and self.ipaddr == src and f(
-                            lport, sport))
-                ):
-                    # print "static match %s: %s:%s -> %s:%s" % (
-                    #    self.name, src, sport, dst, dport)
-                    return True
-
-        # nothing matches
-        return False
-
-    def on_packet(self, src, sport, dst, dport, plen):
-
-        # print "class %s.%s got packet %s:%s -> %s:%s %s" % (
-        #    self.parent.name, self.name, src, sport, dst, dport, plen)
-
-        dt = self.rateWindow1
-        now = time.time()
-        then = now - dt
-        self.lastPktTime = now
-
-        ipaddr = self.ipaddr
-        pktInHist = self.pktInHist
-        pktOutHist = self.pktOutHist
-
-        # save packet in inbound and/or outbound histories
-        item = (now, plen)
-        if dst == ipaddr:
-            pktInHist.insert(0, item)
-        if src == ipaddr:
-            pktOutHist.insert(0, item)
-
-        # calculate current in and out rates
-        i = 0
-        totIn = 0
-        for when, size in pktInHist:
-            if when < then:
-                break
-            totIn += size
-            i += 1
-        self.rateIn = totIn / dt  # determine moving avg in
-        del pktInHist[i:]
-
-        i = 0
-        totOut = 0
-        for when, size in pktOutHist:
-            if when < then:
-                break
-            totOut += size
-            i += 1
-        self.rateOut = totOut / dt  # determine moving avg in
-        del pktOutHist[i:]
-
-        # print "%s.%s: rate = %s b/s in, %s b/s out" % (
-        #    self.parent.name, self.name, self.rateIn, self.rateOut)
-
-        # self.pktInHist = []   # list of (time, size) tuples for inbound pkts, in reverse order
-        # self.pktOutHist = []  # ditto for outbound packets
-
-        self.silly = "yyy"
-
     def sortConnections(self):
         """
         Sorts connections into a predetermined order, so that if the
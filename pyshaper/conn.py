@@ -13,24 +13,235 @@
 #
 
 import commands
+import socket
 import traceback
 
+from array import array
+
 import pyshaper
-from pyshaper.util import staticItemMatch
+from pyshaper import procfs
+from pyshaper.geo import getGeo
+from pyshaper.sockdiag import SockDiag, SockDiagError
+from pyshaper.util import addrToInt, intToAddr
+
+
+class ConnTable:
+    """
+    Compact store for a scan's worth of TCP connections, in
+    struct-of-arrays form - one typed array per attribute, with a row
+    per connection. Addresses are kept as 32-bit ints, and user, cmd,
+    args and country values as indexes into pools of shared objects,
+    so each distinct value is stored once per scan
+
+    The lazily looked up columns (see TCPConns.lazyFields) hold
+    'unset' until filled in
+    """
 
-try:
-    import GeoIP
-except ImportError:
-    GeoIP = None
+    unset = -1
 
+    def __init__(self):
+
+        self.laddr = array('L')
+        self.lport = array('H')
+        self.raddr = array('L')
+        self.rport = array('H')
+        self.state = array('B')
+        self.uid = array('l')
+        self.inode = array('L')
+        self.pid = array('l')
+        self.starttime = array('L')
+
+        # indexes into self.pool, or unset
+        self.user = array('l')
+        self.cmd = array('l')
+        self.args = array('l')
+        self.cc = array('l')
+        self.country = array('l')
+
+        # shared values, and where each one lives in the pool
+        self.pool = [None]
+        self.poolIndex = {}
+
+        # int -> dotted quad address strings already worked out
+        self.addrs = {}
+
+        # key -> row, built when first needed
+        self.keyRows = None
+
+    def __len__(self):
+        return len(self.laddr)
 
-class Conn:
+    def append(self, laddr, lport, raddr, rport, state, uid, inode,
+               pid, starttime, user=None):
+        """
+        Adds a connection, returning its row number. Addresses are ints
+        """
+        unset = self.unset
+        self.keyRows = None
+        self.laddr.append(laddr)
+        self.lport.append(lport)
+        self.raddr.append(raddr)
+        self.rport.append(rport)
+        self.state.append(state)
+        self.uid.append(uid)
+        self.inode.append(inode)
+        self.pid.append(pid)
+        self.starttime.append(starttime)
+        if user is None:
+            self.user.append(unset)
+        else:
+            self.user.append(self.intern(user))
+        self.cmd.append(unset)
+        self.args.append(unset)
+        self.cc.append(unset)
+        self.country.append(unset)
+        return len(self.laddr) - 1
+
+    def pop(self):
+        """
+        Removes the last row
+        """
+        self.keyRows = None
+        for col in [self.laddr, self.lport, self.raddr, self.rport,
+                    self.state, self.uid, self.inode, self.pid,
+                    self.starttime, self.user, self.cmd, self.args,
+                    self.cc, self.country]:
+            col.pop()
+
+    def intern(self, value):
+        """
+        Returns the pool index of value, adding it if it's new. Lists
+        (ie args) are pooled as tuples, but handed back as lists
+        """
+        if isinstance(value, list):
+            key = tuple(value)
+        else:
+            key = value
+        try:
+            return self.poolIndex[key]
+        except KeyError:
+            idx = self.poolIndex[key] = len(self.pool)
+            self.pool.append(value)
+            return idx
+
+    def key(self, row):
+        """
+        Returns the identity of the connection in row - its
+        (laddr, lport, raddr, rport, inode), with int addresses
+        """
+        return (self.laddr[row], self.lport[row],
+                self.raddr[row], self.rport[row], self.inode[row])
+
+    def ident(self, row):
+        """
+        Returns the (laddr, lport, raddr, rport, pid, starttime) of
+        the connection in row, with int addresses - which, unlike the
+        inode in key(), is enough to tell that it's still owned by
+        the same process
+        """
+        return (self.laddr[row], self.lport[row],
+                self.raddr[row], self.rport[row],
+                self.pid[row], self.starttime[row])
+
+    def keys(self):
+        """
+        Returns a dict mapping each connection's key to its row
+        """
+        keys = self.keyRows
+        if keys is None:
+            key = self.key
+            keys = self.keyRows = dict([(key(row), row)
+                                        for row in xrange(len(self.laddr))])
+        return keys
+
+    def addrStr(self, n):
+        """
+        Returns int address n as a dotted quad
+        """
+        try:
+            return self.addrs[n]
+        except KeyError:
+            s = self.addrs[n] = intToAddr(n)
+            return s
+
+
+def addrColumn(name):
+    """
+    Makes a Conn property presenting int address column 'name'
+    as dotted quad strings
+    """
+    def get(self):
+        table = self.table
+        return table.addrStr(getattr(table, name)[self.row])
+    return property(get)
+
+
+def intColumn(name):
+    """
+    Makes a Conn property for plain column 'name'
+    """
+    def get(self):
+        return getattr(self.table, name)[self.row]
+    return property(get)
+
+
+def pooledColumn(name):
+    """
+    Makes a Conn property for pooled column 'name', which gets
+    looked up on first access if the scan didn't fill it in
+    """
+    def get(self):
+        table = self.table
+        idx = getattr(table, name)[self.row]
+        if idx == table.unset:
+            table.owner.resolve(self.row, name)
+            idx = getattr(table, name)[self.row]
+        return table.pool[idx]
+    return property(get)
+
+
+class Conn(object):
     """
     Simple class representing a single current TCP connection
+
+    This is a lightweight view onto one row of a ConnTable - it holds
+    nothing itself but the table and row number
     """
+
+    __slots__ = ('table', 'row')
+
+    laddr = addrColumn('laddr')
+    lport = intColumn('lport')
+    raddr = addrColumn('raddr')
+    rport = intColumn('rport')
+    state = intColumn('state')
+    uid = intColumn('uid')
+    inode = intColumn('inode')
+    pid = intColumn('pid')
+    starttime = intColumn('starttime')
+
+    user = pooledColumn('user')
+    cmd = pooledColumn('cmd')
+    args = pooledColumn('args')
+    cc = pooledColumn('cc')
+    country = pooledColumn('country')
+
+    def __init__(self, table, row):
+
+        self.table = table
+        self.row = row
+
+    @property
+    def key(self):
+        return self.table.key(self.row)
+
+    @property
+    def ident(self):
+        return self.table.ident(self.row)
+
     def __str__(self):
 
-        if GeoIP:
+        if getGeo():
             return "%s/%s %s:%s => %s:%s (%s/%s)" % (
                 self.user, self.pid,
                 self.laddr, self.lport, self.raddr, self.rport,
@@ -48,112 +259,293 @@ class Conn:
         return str(self) + " (%s %s)" % (
             self.cmd, " ".join(["' " + arg +"'" for arg in self.args]))
 
-    def matchesPacket(self, src, sport, dst, dport):
-        """
-        Returns True if a packet matches this connection
-        """
-        raddr = self.raddr
-        rport = self.rport
-        laddr = self.laddr
-        lport = self.lport
 
-        # print "Conn: matching %s:%s->%s:%s against %s:%s,%s:%s" % (
-        #    repr(src), repr(sport), repr(dst), repr(dport),
-        #    repr(raddr), repr(rport), repr(laddr), repr(lport))
-        m = staticItemMatch
+class ConnDelta:
+    """
+    What changed between two scans of the TCP connections, matching
+    up connections by their (laddr, lport, raddr, rport, inode)
 
-        if ((m(raddr, src) and m(rport, sport) and m(lport, dport))
-                or
-                (m(raddr, dst) and m(rport, dport) and m(lport, sport))
-        ):
-            # print "Conn.matchesPacket: true"
-            return True
-        else:
-            return False
+    added is a list of the new scan's Conns which weren't in the old
+    one, removed is a list of the old scan's Conns which have gone,
+    and unchanged is a list of (new, old) Conn pairs for the rest
+    """
+
+    def __init__(self, added, removed, unchanged):
+
+        self.added = added
+        self.removed = removed
+        self.unchanged = unchanged
+
+    def __str__(self):
+
+        return "+%s -%s =%s" % (
+            len(self.added), len(self.removed), len(self.unchanged))
 
 
 
 
 class TCPConns:
     """
-    Class which scans the current TCP connections, and returns a
-    list with a dict representing each connection
+    Class which scans the current TCP connections, and presents
+    them as a sequence of Conn objects, backed by a ConnTable
     """
 
 
+    backend = pyshaper.connBackend
+    procNetTcp = pyshaper.procNetTcp
     netstatCmd = pyshaper.netstatCmd
 
+    # netlink socket for the 'netlink' backend, shared between scans
+    sockDiag = None
 
+    # socket inode -> pid map, kept up to date across scans
+    inodeIndex = None
 
-    def __init__(self):
+    # (pid, starttime) -> cmd/args of each process with connections
+    procCache = None
 
-        if GeoIP:
-            # create a GeoIP object, enable country lookups
-            try:
-                g = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
-                self.ip2cc = g.country_code_by_addr
-                self.ip2country = g.country_name_by_addr
-            except:
-                self.ip2cc = None
-                self.ip2country = None
-                traceback.print_exc()
-        else:
-            self.ip2cc = None
-            self.ip2country = None
+
+
+    # Conn attributes which cost extra lookups per connection - only
+    # the ones listed in 'fields' get filled in during the scan, the
+    # rest are looked up if and when something asks for them
+    procFields = ['cmd', 'args', 'user']
+    geoFields = ['cc', 'country']
+    lazyFields = procFields + geoFields
+
+
+    def __init__(self, fields=None):
+        """
+        fields is a list of the Conn attributes which will be needed
+        for every connection (see ShaperConfig.fields), or None to fetch
+        them all
+        """
+        if fields is None:
+            fields = self.lazyFields
+        self.needProc = [f for f in self.procFields if f in fields] != []
+        self.needGeo = [f for f in self.geoFields if f in fields] != []
+
+        # country lookups, if available
+        self.geo = getGeo()
 
         self.getconns()
 
 
     def getconns(self):
 
+        if self.backend == 'netlink':
+            try:
+                self.table = self.getconnsNetlink()
+                return
+            except (socket.error, SockDiagError):
+                # no sock_diag in this kernel - fall back on /proc
+                traceback.print_exc()
+
+        if self.backend in ['netlink', 'proc']:
+            try:
+                self.table = self.getconnsProc()
+                return
+            except (IOError, OSError):
+                # no usable /proc - fall back on netstat
+                traceback.print_exc()
+
+        self.table = self.getconnsNetstat()
+
+
+    def getconnsProc(self):
+        """
+        Builds the connections table by streaming through the kernel's
+        TCP socket table, with no subprocess involved
+        """
+        return self.buildConns(procfs.readTcpTable(self.procNetTcp))
+
+
+    def getconnsNetlink(self):
+        """
+        Builds the connections table from a single netlink sock_diag dump
+        """
+        if TCPConns.sockDiag is None:
+            TCPConns.sockDiag = SockDiag()
+        return self.buildConns(self.sockDiag.dump())
+
+
+    def getProcCache(self):
+        """
+        Returns the process details cache shared by all scans
+        """
+        if TCPConns.procCache is None:
+            TCPConns.procCache = procfs.ProcInfoCache()
+        return TCPConns.procCache
+
+
+    def newTable(self):
+
+        table = self.table = ConnTable()
+        table.owner = self
+        return table
+
+
+    def buildConns(self, sockets):
+        """
+        Turns a sequence of (laddr, lport, raddr, rport, state, uid, inode)
+        socket tuples into a ConnTable
+        """
+        # netstat leaves out listening sockets unless given '-a', and
+        # sockets with no inode (eg TIME_WAIT) have no owning process
+        sockets = [s for s in sockets
+                   if s[4] != procfs.TCP_LISTEN and s[6]]
+
+        # map socket inodes to their owning processes
+        if TCPConns.inodeIndex is None:
+            TCPConns.inodeIndex = procfs.InodeIndex()
+        inodes = self.inodeIndex
+        inodes.refresh([(s[6], s[5]) for s in sockets])
+
+        # drop cached details of processes which have exited
+        procCache = self.getProcCache()
+        procCache.prune([(pid, rec.starttime)
+                         for pid, rec in inodes.procs.items()])
+
+        table = self.newTable()
+        for laddr, lport, raddr, rport, state, uid, inode in sockets:
+
+            # netstat skips sockets not owned by any process
+            pid = inodes.get(inode, None)
+            if pid is None:
+                continue
+
+            row = table.append(laddr, lport, raddr, rport, state, uid,
+                               inode, pid, inodes.starttime(pid))
+            self.fill(row)
+
+        return table
+
+
+    def getconnsNetstat(self):
+        """
+        Builds the connections table by running 'netstat' and
+        picking apart its output
+        """
         # run 'netstat', break output into lines
         lines = commands.getoutput(self.netstatCmd).strip().split("\n")
 
         # and break each line into fields
         lines = [pyshaper.reSpaces.split(l) for l in lines]
 
-        ip2cc = self.ip2cc
-        ip2country = self.ip2country
-
-        conns = []
+        table = self.newTable()
         for line in lines:
             try:
                 if line[0] == 'tcp':
-                    d = Conn()
                     localend = line[3].split(":")
-                    d.laddr = localend[0]
-                    d.lport = int(localend[1])
                     remend = line[4].split(":")
-                    raddr = remend[0]
-                    d.raddr = raddr
-                    d.rport = int(remend[1])
-                    d.user = line[6]
-                    d.inode = int(line[7])
+                    state = procfs.tcpStateNames.get(line[5], 0)
                     proc = line[8].split("/")
-                    d.pid = int(proc[0])
-                    cmdline = file("/proc/%s/cmdline" % d.pid) \
-                                                   .read().strip().split("\x00")
-                    if cmdline[-1] == '':
-                        cmdline.pop()
-                    d.cmd = cmdline[0]
-                    d.args = cmdline[1:]
-                    if ip2cc:
-                        try:
-                            d.cc = ip2cc(raddr)
-                        except:
-                            d.cc = None
-                    if ip2cc:
-                        try:
-                            d.country = ip2country(raddr)
-                        except:
-                            d.country = None
-                    conns.append(d)
+                    row = table.append(
+                        addrToInt(localend[0]), int(localend[1]),
+                        addrToInt(remend[0]), int(remend[1]),
+                        state, -1, int(line[7]), int(proc[0]), 0,
+                        user=line[6])
+                    self.fill(row)
             except:
                 # print "hates %s" % repr(line)
                 # traceback.print_exc()
                 pass
-        self.conns = conns
 
+        # drop cached details of processes which have exited
+        self.getProcCache().prune()
+
+        return table
+
+
+    def fill(self, row):
+        """
+        Looks up whichever of the costlier attributes of a new row
+        are needed up front. If its process has exited, or anything
+        else about it can't be looked up, drops the row
+        """
+        try:
+            if self.needProc:
+                self.addProcInfo(row)
+            if self.needGeo:
+                self.addCountry(row)
+        except Exception:
+            self.table.pop()
+
+
+    def addProcInfo(self, row):
+        """
+        Fills in the command line of a connection, from the process
+        owning it, and its user, from the socket's owner as netstat
+        reports it. Raises IOError or OSError if the process has exited
+        """
+        table = self.table
+        starttime = table.starttime[row] or None
+        info = self.getProcCache().get(table.pid[row], starttime)
+        table.starttime[row] = info.starttime
+        table.cmd[row] = table.intern(info.cmd)
+        table.args[row] = table.intern(info.args)
+        if table.user[row] == table.unset:
+            table.user[row] = table.intern(procfs.userName(table.uid[row]))
+
+
+    def addCountry(self, row):
+        """
+        Fills in the country of a connection's remote end
+        """
+        table = self.table
+        if self.geo:
+            cc, country = self.geo.lookup(table.addrStr(table.raddr[row]))
+        else:
+            cc = country = None
+        table.cc[row] = table.intern(cc)
+        table.country[row] = table.intern(country)
+
+
+    def resolve(self, row, name):
+        """
+        Looks up attribute name of a connection, when first accessed
+        """
+        if name in self.geoFields:
+            self.addCountry(row)
+            return
+        try:
+            self.addProcInfo(row)
+        except (IOError, OSError):
+            # process has exited since the scan
+            table = self.table
+            table.cmd[row] = table.intern(None)
+            table.args[row] = table.intern([])
+            if table.user[row] == table.unset:
+                table.user[row] = table.intern(procfs.userName(table.uid[row]))
+
+
+
+    def delta(self, prev):
+        """
+        Compares this scan against an earlier one, prev (which can
+        be None), and returns a ConnDelta
+        """
+        table = self.table
+        if prev is None:
+            return ConnDelta(list(self), [], [])
+
+        prevTable = prev.table
+        prevKeys = prevTable.keys()
+
+        added = []
+        unchanged = []
+        for key, row in table.keys().items():
+            prevRow = prevKeys.get(key, None)
+            if prevRow is None:
+                added.append(Conn(table, row))
+            else:
+                unchanged.append((Conn(table, row), Conn(prevTable, prevRow)))
+
+        keys = table.keys()
+        removed = [Conn(prevTable, row) for key, row in prevKeys.items()
+                   if key not in keys]
+
+        return ConnDelta(added, removed, unchanged)
 
 
     def dump(self):
@@ -163,15 +555,27 @@ class TCPConns:
 
 
     def __getitem__(self, item):
-        return self.conns[item]
+        if item < 0:
+            item += len(self.table)
+        if item < 0 or item >= len(self.table):
+            raise IndexError(item)
+        return Conn(self.table, item)
 
 
     def __getslice__(self, fromidx, toidx):
-        return self.conns[fromidx:toidx]
+        table = self.table
+        return [Conn(table, row)
+                for row in range(*slice(fromidx, toidx).indices(len(table)))]
+
+
+    def __iter__(self):
+        table = self.table
+        for row in xrange(len(table)):
+            yield Conn(table, row)
 
 
     def __len__(self):
-        return len(self.conns)
+        return len(self.table)
 
 
     def filter(self, **kw):
@@ -179,11 +583,9 @@ class TCPConns:
         for conn in self:
             matches = True
             for k ,v in kw.items():
-                if conn[k] != v:
+                if getattr(conn, k) != v:
                     matches = False
                     break
             if matches:
                 conns.append(conn)
         return conns
-
-
@@ -0,0 +1,215 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Country lookups for remote addresses, for the 'cc' and 'country'
+connection attributes
+
+Lookups go through a single GeoLookup per process, which remembers
+recent results. The answers come either from the GeoIP C module, or
+from a local CSV database of IP ranges, which works without it
+"""
+
+import csv
+import os
+import socket
+import threading
+import traceback
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+import pyshaper
+from pyshaper.util import addrToInt
+
+try:
+    import GeoIP
+except ImportError:
+    GeoIP = None
+
+
+class GeoIPBackend:
+    """
+    Looks up countries via the GeoIP C module
+    """
+
+    def __init__(self):
+
+        g = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
+        self.ip2cc = g.country_code_by_addr
+        self.ip2country = g.country_name_by_addr
+
+    def lookup(self, addr):
+
+        try:
+            cc = self.ip2cc(addr)
+        except:
+            cc = None
+        try:
+            country = self.ip2country(addr)
+        except:
+            country = None
+        return cc, country
+
+
+class RangeTableBackend:
+    """
+    Looks up countries in a CSV database of IP ranges, loaded into
+    sorted arrays of range start/end addresses, which get searched
+    with bisect
+
+    Each line of the CSV file is either in MaxMind's legacy country
+    format:
+
+        "1.0.0.0","1.0.0.255","16777216","16777471","AU","Australia"
+
+    or just:
+
+        start,end,cc,country
+
+    where start and end are dotted quads or ints. Ranges mustn't overlap
+    """
+
+    def __init__(self, path):
+
+        rows = []
+        f = file(path)
+        try:
+            for row in csv.reader(f):
+                try:
+                    if len(row) >= 6:
+                        start, end = int(row[2]), int(row[3])
+                        cc, country = row[4], row[5]
+                    elif len(row) == 4:
+                        start, end = self.parseAddr(row[0]), self.parseAddr(row[1])
+                        cc, country = row[2], row[3]
+                    else:
+                        continue
+                except (ValueError, socket.error):
+                    # header line, or junk
+                    continue
+                rows.append((start, end, cc, country))
+        finally:
+            f.close()
+        rows.sort()
+
+        self.starts = array('L', [r[0] for r in rows])
+        self.ends = array('L', [r[1] for r in rows])
+
+        # there's a couple of hundred countries, so share the strings
+        names = {}
+        self.ccs = [names.setdefault(r[2], r[2]) for r in rows]
+        self.countries = [names.setdefault(r[3], r[3]) for r in rows]
+
+    def parseAddr(self, s):
+
+        s = s.strip()
+        if "." in s:
+            return addrToInt(s)
+        return int(s)
+
+    def lookup(self, addr):
+
+        try:
+            n = addrToInt(addr)
+        except socket.error:
+            return None, None
+        i = bisect_right(self.starts, n) - 1
+        if i >= 0 and n <= self.ends[i]:
+            return self.ccs[i], self.countries[i]
+        return None, None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class GeoLookup:
+    """
+    Front end to a country lookup backend, which keeps the results
+    for the most recently seen remote addresses in a bounded LRU cache
+    """
+
+    def __init__(self, backend, size=pyshaper.geoipCacheSize):
+
+        self.backend = backend
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, addr):
+        """
+        Returns (cc, country) for remote address addr, with None
+        for both if unknown
+        """
+        cache = self.cache
+        self.lock.acquire()
+        try:
+            try:
+                res = cache.pop(addr)
+            except KeyError:
+                res = self.backend.lookup(addr)
+                if len(cache) >= self.size:
+                    cache.popitem(last=False)
+            cache[addr] = res
+            return res
+        finally:
+            self.lock.release()
+
+    def cc(self, addr):
+        return self.lookup(addr)[0]
+
+    def country(self, addr):
+        return self.lookup(addr)[1]
+
+
+# the process-wide GeoLookup, created on first call to getGeo()
+geo = None
+geoLoaded = False
+geoLock = threading.Lock()
+
+
+def getGeo():
+    """
+    Returns the process-wide GeoLookup, loading it on first call.
+    Uses the CSV range database at pyshaper.geoipCsvPath if there's
+    one, otherwise the GeoIP module. Returns None if neither is
+    available, in which case countries are all None
+    """
+    global geo, geoLoaded
+
+    if geoLoaded:
+        return geo
+
+    geoLock.acquire()
+    try:
+        if not geoLoaded:
+            backend = None
+            if os.path.isfile(pyshaper.geoipCsvPath):
+                try:
+                    backend = RangeTableBackend(pyshaper.geoipCsvPath)
+                except:
+                    traceback.print_exc()
+            if backend is None and GeoIP:
+                try:
+                    backend = GeoIPBackend()
+                except:
+                    traceback.print_exc()
+            if backend is not None:
+                geo = GeoLookup(backend)
+            geoLoaded = True
+    finally:
+        geoLock.release()
+
+    return geo
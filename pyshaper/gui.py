@@ -24,9 +24,10 @@ import pyshaper
 
 from Tkinter import *
 
+from pyshaper.classids import ClassIds
 from pyshaper.config import ShaperConfig
 from pyshaper.conn import TCPConns
-from pyshaper.ipmon import IPmon, MatchedConnectionException
+from pyshaper.tcstats import TcStats
 from pyshaper.util import takeKey
 
 
@@ -39,6 +40,9 @@ class TShaperGui:
         - display/edit shaper config
         - send a SIGHUP to running shaper to make it reload config
     """
+
+    # how often to read the kernel's counters for the class rates
+    statsPeriod = 1.0
     
     
     def __init__(self):
@@ -54,18 +58,14 @@ class TShaperGui:
         self.conns = TCPConns()
         thread.start_new_thread(self.thrdConns, ())
 
-        # cache of packet details
-        # each key is a list [src,sport,dst,dport] of packet details
-        # each value is a shaper class which matches the packet
-        self.pktCache = {}
-
         self.savingWindowSize = False
 
         self.buildWindow()
         self.centerWindow()
 
-        ipmon = self.ipmon = IPmon(handler=self.on_packet)
-        thread.start_new_thread(ipmon.run, ())
+        # class rates, from the kernel's counters
+        self.stats = TcStats()
+        thread.start_new_thread(self.thrdStats, ())
 
     
     
@@ -635,79 +635,13 @@ class TShaperGui:
         self.butApplyChanges.configure(state=NORMAL)
     
     
-    def on_packet(self, pkt):
-        """
-        Receives a packet I/O notification from the IPmon thread
-        """
-        #print pkt
-
-        # turn on traffic 'LED' and mark time of receiving last pkt
-        self.labTraffic.config(bg='green', fg=theme.labBgColor)
-        self.lastPktTime = time.time()
-
-        # is this pkt info cached?
-        src = pkt['src']
-        sport = pkt['sport']
-        dst = pkt['dst']
-        dport = pkt['dport']
-        plen = pkt['len']
-
-        cls = self.pktCache.get((src, sport, dst, dport), None)
-
-        cls = None # disable caching for now
-
-        if cls:
-            #print "on_packet: found in cache as class %s" % cls.name
-            cls.on_packet(src, sport, dst, dport, plen)
-            return
-        else:
-            # classify packet
-            for mode in [True, False]:
-                for iface in self.config.interfaces:
-                    # try the classes
-                    for cls in iface.classes:
-                        if cls.name == 'default':
-                            continue
-                        #print "gui.on_packet: awaiting lock"
-                        self.lockConns.acquire()
-                        #print "gui.on_packet: got lock"
-                        try:
-                            res = cls.matchesPacket(src, sport, dst, dport, mode)
-                        except:
-                            traceback.print_exc()
-                            res = None
-                        self.lockConns.release()
-                        #print "gui.on_packet: released lock"
-                        if res:
-                            #print "cls %s matches %s,%s,%s,%s" % (cls.name, src,sport,dst,dport)
-                            self.pktCache[src, sport, dst, dport] = cls
-                            cls.on_packet(src, sport, dst, dport, plen)
-                            return
-
-                    # is either src or dest matching iface's ip?
-                    #print "ipaddr=%s src=%s dst=%s" % (repr(iface.ipaddr),repr(src),repr(dst))
-                    if iface.ipaddr in (src, dst):
-                        # yes, handle as default
-                        #self.pktCache[src, sport, dst, dport] = iface.default
-                        iface.default.on_packet(src, sport, dst, dport, plen)
-                        return
-
-        print "unmatched packet %s:%s->%s:%s %s" % (src, sport, dst, dport, plen)
-
-
-
-
-
-
-    
-    
     def on_refresh(self, ev=None):
         """
         Thread which updates the gui periodically
         """
         try:
             # turn off 'traffic' light if no recent traffic
-            if time.time() - self.lastPktTime > 0.1:
+            if time.time() - self.lastPktTime > self.statsPeriod + 0.1:
                 # timeout - turn off traffic indicator label
                 self.labTraffic.config(bg=theme.labBgColor, fg=theme.labFgColor)
 
@@ -738,7 +672,7 @@ class TShaperGui:
             time.sleep(1)
 
             try:
-                conns = TCPConns()
+                conns = TCPConns(fields=self.config.fields)
 
                 #print "thrdConns: awaiting lock"
                 self.lockConns.acquire()
@@ -753,31 +687,15 @@ class TShaperGui:
 
                     # sort current connections into classes
                     #print "---- thrdConns ----"
-                    for conn in conns:
+                    # find the class each belongs in, or default -
+                    # remembered from last time for old connections
+                    classes = self.config.classifyAll(conns)
+                    for conn, cls in zip(conns, classes):
                         #print "thrdConns: %s:%s %s:%s" % (conn.raddr, conn.rport, conn.laddr, conn.lport)
-                        try:
-                            localip = conn.laddr
-
-                            # match against each rule
-                            for iface in self.config.interfaces:
-                                # ditch connections that aren't on this interface
-                                if iface.ipaddr != localip:
-                                    continue
-
-                                # try to match against all classes
-                                for cls in iface.classes:
-                                    if cls.matches(conn):
-                                        #print "%s matched %s:%s %s:%s" % (
-                                        #    cls.name, conn.laddr, conn.lport, conn.raddr, conn.rport)
-                                        cls.conns.append(conn)
-                                        raise MatchedConnectionException() # bail out to uppermost loop
-
-                                # no rule found for conn, add to default
-                                iface.default.conns.append(conn)
-                                break # quicker than raising exception
-
-                        except MatchedConnectionException:
-                            pass
+                        if cls is not None:
+                            #print "%s matched %s:%s %s:%s" % (
+                            #    cls.name, conn.laddr, conn.lport, conn.raddr, conn.rport)
+                            cls.conns.append(conn)
 
                     self.conns = conns
                 except:
@@ -789,6 +707,36 @@ class TShaperGui:
             except:
                 traceback.print_exc()
 
+    def thrdStats(self):
+        """
+        Periodically reads the kernel's counters, and updates the
+        rates of all the classes from them
+        """
+        while 1:
+            time.sleep(self.statsPeriod)
+
+            try:
+                self.stats.poll([iface.name for iface in self.config.interfaces])
+
+                # the daemon gives out new class ids as it goes
+                classIds = ClassIds(pyshaper.classIdsPath)
+
+                traffic = False
+                for iface in self.config.interfaces:
+                    rates = self.stats.classRates(iface.name, classIds)
+                    for cls in iface.classes + [iface.default]:
+                        cls.rateIn, cls.rateOut = rates.get(cls.name, (0.0, 0.0))
+                        if cls.rateIn or cls.rateOut:
+                            traffic = True
+
+                # turn on traffic 'LED'
+                if traffic:
+                    self.labTraffic.config(bg='green', fg=theme.labBgColor)
+                    self.lastPktTime = time.time()
+
+            except:
+                traceback.print_exc()
+
 
     
     
@@ -2223,14 +2171,6 @@ class ClsListBoxItem(WidgetListBoxItem):
 
         cls = self.cls
 
-        # mad-assed kludge - feed in some 'null' packets to cls to flush out the
-        # class' history
-        cls.on_packet(0, 0, 0, 0, 0)
-
-        #if cls.name == 'httpout' and cls.silly != 'xxx':
-        #    print "%s.%s: rate = %s b/s in, %s b/s out, %s" % (
-        #        cls.parent.name, cls.name, cls.rateIn, cls.rateOut, cls.silly)
-
         self.labRateIn.config(text="%16.2f" % (cls.rateIn / 128))
         self.labRateOut.config(text="%16.2f" % (cls.rateOut / 128))
 
@@ -18,6 +18,7 @@
 
 import getopt
 import signal
+import socket
 import sys
 import traceback
 
@@ -25,7 +26,9 @@ import os
 
 import pyshaper
 from pyshaper import configDir, reDelim
+from pyshaper import tcstate
 from pyshaper.conn import TCPConns
+from pyshaper.rtnl import Rtnl, RtnlError
 
 from pyshaper.gui import TShaperGui
 from pyshaper.tshaper import TShaper
@@ -149,6 +152,24 @@ def main():
             print "Can't find pidfile %s, pyshaper appears not to be running" % pyshaper.pidfile
             sys.exit(1)
 
+    elif cmd == 'verify':
+        model = tcstate.loadModel(pyshaper.tcStatePath)
+        if model is None:
+            print "Can't read %s, pyshaper appears not to be running" % pyshaper.tcStatePath
+            sys.exit(1)
+        try:
+            found, drift = tcstate.verify(Rtnl(), model)
+        except (socket.error, RtnlError), e:
+            print "Can't read back tc setup: %s" % e
+            sys.exit(1)
+        for line in drift:
+            print line
+        if drift:
+            print "tc setup differs from pyshaper's in %d places" % len(drift)
+            sys.exit(1)
+        print "tc setup is as pyshaper left it"
+        sys.exit(0)
+
     elif cmd in ['kill', 'stop']:
         if os.path.isfile(pyshaper.pidfile):
             pid = int(file(pyshaper.pidfile).read())
@@ -186,6 +207,8 @@ def usage(detailed=False):
     print "     reload - force the running instance of pyshaper to re-read"
     print "              its configuration file from /etc/pyshaper/pyshaper.conf,"
     print "              then rebuild the shaping rules"
+    print "     verify - check the qdiscs, classes and filters are still as the"
+    print "              running pyshaper left them, listing any differences"
     print "     help   - display this help"
     print
 
@@ -0,0 +1,229 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Marks connections with their class via nftables, for interfaces using
+the 'mark' classifier
+
+Each class gets an nftables set of the (laddr, lport, raddr, rport)
+tuples of its connections, and a rule which stamps packets matching
+the set with the class's mark - both the packet's own mark, for the
+egress fw filters, and the connection's, which the ingress qdisc copies
+back onto incoming packets with the connmark action. Only the low 16
+bits of each mark are ours
+
+Changes in class membership then come down to adding and deleting set
+elements, all in one atomic 'nft -f' batch
+"""
+
+import re
+import subprocess
+
+from collections import OrderedDict
+
+
+# our nftables table
+table = "ip pyshaper"
+
+# the bits of packet and connection marks we use
+markMask = 0xffff
+
+setType = "ipv4_addr . inet_service . ipv4_addr . inet_service"
+
+# how many elements to put in each add/delete element command
+elementsPerCmd = 1000
+
+reBadChars = re.compile("[^A-Za-z0-9_]")
+
+
+class NftSet:
+    """
+    The connections in one class, as an nftables set
+    """
+
+    def __init__(self, iface, name, mark):
+
+        self.iface = iface
+        self.name = reBadChars.sub("_", "%s_%s" % (iface, name))
+        self.mark = mark
+        self.elements = {}
+
+    def add(self, laddr, lport, raddr, rport):
+        self.elements["%s . %s . %s . %s" % (laddr, lport, raddr, rport)] = 1
+
+
+class NftModel:
+    """
+    The sets and rules we want in our nftables table
+    """
+
+    def __init__(self):
+
+        self.ifaces = []
+        self.sets = OrderedDict()
+
+    def addIface(self, iface):
+        """
+        Adds an interface using the mark classifier
+        """
+        if iface not in self.ifaces:
+            self.ifaces.append(iface)
+
+    def addSet(self, iface, name, mark):
+        """
+        Adds class name on interface iface, to be marked with mark,
+        and returns its NftSet
+        """
+        self.addIface(iface)
+        nftset = NftSet(iface, name, mark)
+        self.sets[nftset.name] = nftset
+        return nftset
+
+    def layout(self):
+        """
+        Everything about the table except the set elements
+        """
+        return (self.ifaces,
+                [(s.iface, s.name, s.mark) for s in self.sets.values()])
+
+    def diff(self, old):
+        """
+        Returns the nft script which turns the table in model old into
+        this one - empty if there's nothing to do. old may be None,
+        when we don't know what's there
+
+        Only set elements get added and deleted, unless the interfaces
+        or classes have changed, when the whole table gets rebuilt
+        """
+        if old is None or old.layout() != self.layout():
+            return self.build()
+
+        lines = []
+        for name, nftset in self.sets.items():
+            oldset = old.sets[name]
+            gone = [e for e in oldset.elements if e not in nftset.elements]
+            new = [e for e in nftset.elements if e not in oldset.elements]
+            lines.extend(elementCmds("delete", name, gone))
+            lines.extend(elementCmds("add", name, new))
+        return "".join([line + "\n" for line in lines])
+
+    def build(self):
+        """
+        Returns the nft script which sets up the table from scratch
+        """
+        lines = [
+            # clear out whatever was there, without failing if nothing was
+            "add table %s" % table,
+            "delete table %s" % table,
+            "add table %s" % table,
+        ]
+        for name in self.sets:
+            lines.append("add set %s %s { type %s ; }" % (table, name, setType))
+
+        lines.append("add chain %s out { type filter hook postrouting"
+                     " priority -150 ; policy accept ; }" % table)
+        lines.append("add chain %s in { type filter hook prerouting"
+                     " priority -150 ; policy accept ; }" % table)
+
+        keep = "0x%08x" % (0xffffffffL & ~markMask)
+        for iface in self.ifaces:
+            # forget the class of connections we're no longer shaping
+            lines.append(
+                "add rule %s out oifname \"%s\" ct mark and 0x%x != 0"
+                " ct mark set ct mark and %s" % (table, iface, markMask, keep))
+
+        for name, nftset in self.sets.items():
+            mark = "%s or 0x%x" % (keep, nftset.mark)
+            lines.append(
+                "add rule %s out oifname \"%s\""
+                " ip saddr . tcp sport . ip daddr . tcp dport @%s"
+                " meta mark set meta mark and %s"
+                " ct mark set ct mark and %s" % (
+                    table, nftset.iface, name, mark, mark))
+            # for connections which hear from the far end before they
+            # send anything
+            lines.append(
+                "add rule %s in iifname \"%s\""
+                " ip daddr . tcp dport . ip saddr . tcp sport @%s"
+                " ct mark set ct mark and %s" % (
+                    table, nftset.iface, name, mark))
+
+        for name, nftset in self.sets.items():
+            lines.extend(elementCmds("add", name, nftset.elements.keys()))
+
+        return "".join([line + "\n" for line in lines])
+
+
+def elementCmds(verb, name, elements):
+    """
+    Returns the commands to add or delete elements from set name
+    """
+    cmds = []
+    for i in range(0, len(elements), elementsPerCmd):
+        cmds.append("%s element %s %s { %s }" % (
+            verb, table, name, ", ".join(elements[i:i + elementsPerCmd])))
+    return cmds
+
+
+def clearScript():
+    """
+    Returns the nft script which gets rid of our table
+    """
+    return "add table %s\ndelete table %s\n" % (table, table)
+
+
+class Nft:
+    """
+    Runs nft scripts with 'nft -f'
+    """
+
+    nftPath = "nft"
+
+    def run(self, script):
+        """
+        Runs script as one atomic batch, returning nft's error message
+        if it fails, or None
+        """
+        try:
+            proc = subprocess.Popen([self.nftPath, "-f", "-"],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    close_fds=True)
+            out = proc.communicate(script)[0]
+        except OSError, e:
+            return "can't run %s: %s" % (self.nftPath, e)
+        if proc.returncode:
+            return out.strip() or "%s exited with status %s" % (
+                self.nftPath, proc.returncode)
+        return None
+
+
+class FakeNft:
+    """
+    Stands in for Nft, keeping every script it's given in self.batches,
+    so tests don't need root or nftables. Set 'error' to have the next
+    run fail with that message
+    """
+
+    def __init__(self):
+
+        self.batches = []
+        self.error = None
+
+    def run(self, script):
+
+        self.batches.append(script)
+        error, self.error = self.error, None
+        return error
@@ -0,0 +1,245 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Lists of address prefixes (CIDR blocks), for rules like
+
+    raddr in prefixes('cdn')
+    raddr in '10.0.0.0/8'
+
+Each list is held in a binary trie keyed on the bits of the address,
+so testing an address costs at most 32 steps, however many prefixes
+the list has
+"""
+
+import socket
+
+from array import array
+
+from pyshaper.util import addrToInt
+
+
+def parseCidr(s):
+    """
+    Parses 'a.b.c.d/len' (or a bare address, taken as /32) into a
+    (network, length) tuple, with the network as an int and any host
+    bits cleared. Raises ValueError if s isn't valid
+    """
+    s = s.strip()
+    if "/" in s:
+        addr, plen = s.split("/", 1)
+        try:
+            plen = int(plen)
+        except ValueError:
+            raise ValueError("Bad prefix length in '%s'" % s)
+        if plen < 0 or plen > 32:
+            raise ValueError("Bad prefix length in '%s'" % s)
+    else:
+        addr, plen = s, 32
+    try:
+        net = addrToInt(addr.strip())
+    except socket.error:
+        raise ValueError("Bad address in '%s'" % s)
+    return net & prefixMask(plen), plen
+
+
+def prefixMask(plen):
+
+    return (0xffffffffL << (32 - plen)) & 0xffffffffL
+
+
+def isCidr(s):
+    """
+    Returns True if s looks like 'a.b.c.d/len'
+    """
+    if "/" not in s:
+        return False
+    try:
+        parseCidr(s)
+    except ValueError:
+        return False
+    return True
+
+
+class PrefixTrie:
+    """
+    Binary trie of address prefixes, one level per address bit
+
+    Nodes are numbered, with node 0 the root, and live in parallel
+    arrays - the child for a 0 bit, the child for a 1 bit (-1 for
+    none), and the length of the prefix ending there (-1 for none)
+
+    Supports 'addr in trie' for addresses as dotted quads or ints
+    """
+
+    def __init__(self, name=None):
+
+        self.name = name
+        self.zero = array('l', [-1])
+        self.one = array('l', [-1])
+        self.plen = array('b', [-1])
+        self.count = 0
+
+    def add(self, net, plen):
+        """
+        Adds prefix net/plen, with net an int
+        """
+        net &= prefixMask(plen)
+        zero, one = self.zero, self.one
+        node = 0
+        for bit in xrange(31, 31 - plen, -1):
+            if (net >> bit) & 1:
+                children = one
+            else:
+                children = zero
+            child = children[node]
+            if child < 0:
+                child = children[node] = len(zero)
+                zero.append(-1)
+                one.append(-1)
+                self.plen.append(-1)
+            node = child
+        if self.plen[node] < 0:
+            self.count += 1
+        self.plen[node] = plen
+
+    def addCidr(self, s):
+        """
+        Adds a prefix given as 'a.b.c.d/len'
+        """
+        self.add(*parseCidr(s))
+
+    def longest(self, addr):
+        """
+        Returns the length of the longest prefix in the trie which
+        covers addr, or -1 if none do
+        """
+        if not isinstance(addr, (int, long)):
+            addr = addrToInt(addr)
+        zero, one, plens = self.zero, self.one, self.plen
+        best = -1
+        node = 0
+        bit = 31
+        while node >= 0:
+            if plens[node] >= 0:
+                best = plens[node]
+            if bit < 0:
+                break
+            if (addr >> bit) & 1:
+                node = one[node]
+            else:
+                node = zero[node]
+            bit -= 1
+        return best
+
+    def __contains__(self, addr):
+        """
+        Tests whether any prefix in the trie covers addr - stopping
+        at the first one on the way down
+        """
+        if not isinstance(addr, (int, long)):
+            addr = addrToInt(addr)
+        zero, one, plens = self.zero, self.one, self.plen
+        node = 0
+        bit = 31
+        while node >= 0:
+            if plens[node] >= 0:
+                return True
+            if bit < 0:
+                break
+            if (addr >> bit) & 1:
+                node = one[node]
+            else:
+                node = zero[node]
+            bit -= 1
+        return False
+
+    def ranges(self):
+        """
+        Returns the addresses the trie covers, as a sorted list of
+        non-overlapping (first, last) int ranges, with adjacent ranges
+        merged
+        """
+        ranges = []
+        stack = [(0, 0, 0)]
+        while stack:
+            node, net, depth = stack.pop()
+            if self.plen[node] >= 0:
+                # covers everything below it
+                ranges.append((net, net | (0xffffffffL >> depth)))
+                continue
+            # push the 1 side first, so the 0 side comes off first
+            child = self.one[node]
+            if child >= 0:
+                stack.append((child, net | (1L << (31 - depth)), depth + 1))
+            child = self.zero[node]
+            if child >= 0:
+                stack.append((child, net, depth + 1))
+
+        merged = []
+        for first, last in ranges:
+            if merged and merged[-1][1] + 1 >= first:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def __len__(self):
+        return self.count
+
+    def __deepcopy__(self, memo):
+        # never changes once loaded, and can be huge
+        return self
+
+    def __repr__(self):
+        return "<PrefixTrie %s: %d prefixes>" % (self.name, self.count)
+
+
+def loadPrefixFile(path, name=None):
+    """
+    Loads a file of prefixes into a new PrefixTrie. The file has one
+    CIDR block (or bare address) per line, with blank lines and
+    anything after a '#' ignored
+    """
+    trie = PrefixTrie(name)
+    f = file(path)
+    try:
+        lineno = 0
+        for line in f:
+            lineno += 1
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            try:
+                trie.addCidr(line)
+            except ValueError, e:
+                raise ValueError("%s line %d: %s" % (path, lineno, e))
+    finally:
+        f.close()
+    return trie
+
+
+# the prefix lists named in the config file - name -> PrefixTrie
+lists = {}
+
+
+def getList(name):
+    """
+    Returns the prefix list called name, as used by prefixes('name')
+    in test expressions. Raises KeyError if there's no such list
+    """
+    try:
+        return lists[name]
+    except KeyError:
+        raise KeyError("No prefix list called '%s'" % name)
@@ -0,0 +1,419 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Helpers for pulling socket and process info straight out of /proc,
+without forking off netstat
+"""
+
+import os
+import pwd
+import struct
+import threading
+
+
+# TCP states, as they appear in the 'st' column of /proc/net/tcp
+TCP_ESTABLISHED = 0x01
+TCP_SYN_SENT = 0x02
+TCP_SYN_RECV = 0x03
+TCP_FIN_WAIT1 = 0x04
+TCP_FIN_WAIT2 = 0x05
+TCP_TIME_WAIT = 0x06
+TCP_CLOSE = 0x07
+TCP_CLOSE_WAIT = 0x08
+TCP_LAST_ACK = 0x09
+TCP_LISTEN = 0x0A
+TCP_CLOSING = 0x0B
+
+# the same states, as named in netstat's output
+tcpStateNames = {
+    'ESTABLISHED': TCP_ESTABLISHED,
+    'SYN_SENT': TCP_SYN_SENT,
+    'SYN_RECV': TCP_SYN_RECV,
+    'FIN_WAIT1': TCP_FIN_WAIT1,
+    'FIN_WAIT2': TCP_FIN_WAIT2,
+    'TIME_WAIT': TCP_TIME_WAIT,
+    'CLOSE': TCP_CLOSE,
+    'CLOSE_WAIT': TCP_CLOSE_WAIT,
+    'LAST_ACK': TCP_LAST_ACK,
+    'LISTEN': TCP_LISTEN,
+    'CLOSING': TCP_CLOSING,
+}
+
+
+def hexToInt(s):
+    """
+    Converts a /proc/net/tcp address, which is the 32-bit address in host
+    byte order printed as hex, into an int in the usual (network) order
+    """
+    return struct.unpack("!L", struct.pack("=L", int(s, 16)))[0]
+
+
+def readTcpTable(path):
+    """
+    Generator which streams through a /proc/net/tcp style table,
+    yielding (laddr, lport, raddr, rport, state, uid, inode) for
+    each socket in it, with addresses as ints
+    """
+    f = file(path)
+    try:
+        f.readline()  # column headers
+        for line in f:
+            flds = line.split()
+            try:
+                laddr, lport = flds[1].split(":")
+                raddr, rport = flds[2].split(":")
+                yield (hexToInt(laddr), int(lport, 16),
+                       hexToInt(raddr), int(rport, 16),
+                       int(flds[3], 16), int(flds[7]), int(flds[9]))
+            except (IndexError, ValueError):
+                continue
+    finally:
+        f.close()
+
+
+def listPids(procdir="/proc"):
+    """
+    Returns a list of the pids of all currently running processes
+    """
+    return [int(name) for name in os.listdir(procdir) if name.isdigit()]
+
+
+def readSocketInode(fdpath):
+    """
+    Returns the socket inode that fd symlink fdpath refers to,
+    or None if it's not a socket (or has vanished)
+    """
+    try:
+        target = os.readlink(fdpath)
+    except OSError:
+        return None
+    if target.startswith("socket:["):
+        return int(target[8:-1])
+    return None
+
+
+def readStartTime(pid, procdir="/proc"):
+    """
+    Returns the start time of process pid, in clock ticks since boot,
+    from field 22 of /proc/<pid>/stat. Together with the pid, this
+    identifies a process even across pid reuse
+    """
+    data = file("%s/%s/stat" % (procdir, pid)).read()
+
+    # the command name in field 2 can contain spaces and parens, so
+    # count fields from the closing paren after it
+    return int(data[data.rindex(")") + 2:].split()[19])
+
+
+class ProcFds:
+    """
+    What an InodeIndex remembers about one process - its start
+    time, and the socket inode (or None) behind each of its fds
+    """
+
+    def __init__(self, starttime):
+
+        self.starttime = starttime
+        self.fds = {}
+
+
+class InodeIndex:
+    """
+    Persistent map of socket inode -> owning pid, which lives across
+    scans and is brought up to date incrementally
+
+    Processes are tracked by pid plus start time. On each refresh,
+    new processes get all their fds read, and known ones only have
+    their fd directory listed, with just the fds which have appeared
+    since last time being read. So a steady-state refresh costs one
+    stat read and one directory listing per process, plus a readlink
+    per new fd, rather than a readlink for every fd on the box
+
+    A socket which lands on a reused fd number doesn't show up in the
+    listing, so for sockets still unaccounted for, the fds of the
+    processes running as the socket's owner get read again - and only
+    if that doesn't find them, the fds of every process
+    """
+
+    def __init__(self, procdir="/proc"):
+
+        self.procdir = procdir
+        self.lock = threading.Lock()
+
+        # pid -> ProcFds for each process we know of
+        self.procs = {}
+
+        # socket inode -> pid
+        self.inodes = {}
+
+        # inodes which a full rescan couldn't find an owner for, so
+        # we don't rescan for them again on every refresh
+        self.orphans = {}
+
+    def get(self, inode, default=None):
+
+        return self.inodes.get(inode, default)
+
+    def starttime(self, pid):
+        """
+        Returns the start time of pid, as seen at the last refresh
+        """
+        return self.procs[pid].starttime
+
+    def refresh(self, wanted=()):
+        """
+        Brings the index up to date with the processes now running
+
+        wanted is a list of (inode, uid) pairs for the sockets we need
+        owners for, with uid None if not known. If any of these are
+        still unknown after the incremental update (eg, a socket landed
+        on an fd number that was closed and reused since last time),
+        the fds of the processes running as their uids get read again,
+        then if that doesn't find them all, every process's
+        """
+        self.lock.acquire()
+        try:
+            self.update()
+
+            missing = [(inode, uid) for inode, uid in wanted
+                       if inode not in self.inodes
+                       and inode not in self.orphans]
+            uids = dict([(uid, 1) for inode, uid in missing])
+            done = {}
+            if missing and None not in uids:
+                done = dict.fromkeys(self.ownedBy(uids))
+                self.rescan(done.keys())
+                missing = [(inode, uid) for inode, uid in missing
+                           if inode not in self.inodes]
+            if missing:
+                self.rescan([pid for pid in self.procs.keys()
+                             if pid not in done])
+                self.orphans.update([(inode, 1) for inode, uid in missing
+                                     if inode not in self.inodes])
+
+            # only remember orphans which are still around
+            if self.orphans:
+                wantedSet = dict([(inode, 1) for inode, uid in wanted])
+                for inode in self.orphans.keys():
+                    if inode not in wantedSet:
+                        del self.orphans[inode]
+        finally:
+            self.lock.release()
+
+    def update(self):
+        """
+        Incremental pass - picks up new and exited processes, and new
+        or closed fds in processes we already know
+        """
+        procs = {}
+        for pid in listPids(self.procdir):
+            try:
+                starttime = readStartTime(pid, self.procdir)
+            except (IOError, OSError, ValueError, IndexError):
+                # exited while we were looking
+                continue
+
+            rec = self.procs.get(pid, None)
+            if rec is not None and rec.starttime != starttime:
+                # pid has been reused by a new process
+                self.forget(pid, rec)
+                rec = None
+            if rec is None:
+                rec = ProcFds(starttime)
+            self.updateFds(pid, rec)
+            procs[pid] = rec
+
+        for pid, rec in self.procs.items():
+            if pid not in procs:
+                self.forget(pid, rec)
+        self.procs = procs
+
+    def updateFds(self, pid, rec):
+        """
+        Syncs our record of a process's fds with its fd directory,
+        reading links only for fds we haven't seen before
+        """
+        fddir = "%s/%s/fd" % (self.procdir, pid)
+        try:
+            names = os.listdir(fddir)
+        except OSError:
+            return
+
+        fds = rec.fds
+        inodes = self.inodes
+        if len(names) == len(fds):
+            for name in names:
+                if name not in fds:
+                    break
+            else:
+                # unchanged
+                return
+
+        current = dict.fromkeys(names)
+        for name, inode in fds.items():
+            if name not in current:
+                del fds[name]
+                if inode is not None and inodes.get(inode) == pid:
+                    del inodes[inode]
+        for name in names:
+            if name not in fds:
+                inode = fds[name] = readSocketInode(fddir + "/" + name)
+                if inode is not None:
+                    inodes[inode] = pid
+
+    def ownedBy(self, uids):
+        """
+        Returns the pids of known processes running as any of uids
+        """
+        pids = []
+        for pid in self.procs.keys():
+            try:
+                if os.stat("%s/%s" % (self.procdir, pid)).st_uid in uids:
+                    pids.append(pid)
+            except OSError:
+                pass
+        return pids
+
+    def rescan(self, pids):
+        """
+        Re-reads every fd of processes pids
+        """
+        inodes = self.inodes
+        for pid in pids:
+            rec = self.procs[pid]
+            self.forget(pid, rec)
+            fddir = "%s/%s/fd" % (self.procdir, pid)
+            for name in rec.fds.keys():
+                inode = rec.fds[name] = readSocketInode(fddir + "/" + name)
+                if inode is not None:
+                    inodes[inode] = pid
+
+    def forget(self, pid, rec):
+
+        inodes = self.inodes
+        for inode in rec.fds.values():
+            if inode is not None and inodes.get(inode) == pid:
+                del inodes[inode]
+
+
+def readCmdline(pid, procdir="/proc"):
+    """
+    Returns the command line of process pid, as a list of strings
+    """
+    cmdline = file("%s/%s/cmdline" % (procdir, pid)).read().strip().split("\x00")
+    if cmdline[-1] == '':
+        cmdline.pop()
+    return cmdline
+
+
+class ProcInfo:
+    """
+    Details of one process that connection rules care about -
+    shared by all the Conn objects belonging to that process
+    """
+
+    def __init__(self, pid, starttime, cmd, args):
+
+        self.pid = pid
+        self.starttime = starttime
+        self.cmd = cmd
+        self.args = args
+
+
+class ProcInfoCache:
+    """
+    Cache of ProcInfo records, keyed on (pid, starttime), so each
+    process's cmdline is read once during its lifetime rather than
+    once per connection per scan. Keying on start time as well as pid
+    means a reused pid never picks up a dead process's details
+    """
+
+    def __init__(self, procdir="/proc"):
+
+        self.procdir = procdir
+        self.lock = threading.Lock()
+        self.infos = {}
+
+    def get(self, pid, starttime=None):
+        """
+        Returns the ProcInfo for pid, reading it from /proc if
+        we haven't already got it. Raises IOError or OSError if
+        the process has gone
+        """
+        if starttime is None:
+            starttime = readStartTime(pid, self.procdir)
+        key = (pid, starttime)
+        info = self.infos.get(key, None)
+        if info is None:
+            cmdline = readCmdline(pid, self.procdir)
+            # exiting processes, and ones which have blanked their
+            # argv, can have an empty command line
+            info = ProcInfo(pid, starttime, (cmdline or [''])[0],
+                            cmdline[1:])
+            self.lock.acquire()
+            self.infos[key] = info
+            self.lock.release()
+        return info
+
+    def prune(self, live=None):
+        """
+        Evicts records for processes which have exited
+
+        live is a list of the (pid, starttime) keys of all running
+        processes, if known - otherwise each cached process is checked
+        """
+        self.lock.acquire()
+        try:
+            infos = self.infos
+            if live is not None:
+                live = dict.fromkeys(live)
+                for key in infos.keys():
+                    if key not in live:
+                        del infos[key]
+            else:
+                for key in infos.keys():
+                    pid, starttime = key
+                    try:
+                        alive = readStartTime(pid, self.procdir) == starttime
+                    except (IOError, OSError, ValueError, IndexError):
+                        alive = False
+                    if not alive:
+                        del infos[key]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.infos)
+
+
+# uid -> user name lookups already done
+userNames = {}
+
+
+def userName(uid):
+    """
+    Maps a numeric uid to a user name, falling back to the uid
+    itself (as a string) for uids with no passwd entry, same as netstat
+    """
+    try:
+        return userNames[uid]
+    except KeyError:
+        pass
+    try:
+        name = pwd.getpwuid(uid)[0]
+    except KeyError:
+        name = str(uid)
+    userNames[uid] = name
+    return name
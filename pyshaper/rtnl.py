@@ -0,0 +1,1461 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Sets up qdiscs, classes and filters by sending rtnetlink messages
+straight to the kernel, rather than having tc parse our commands
+
+Takes the same commands we'd otherwise feed to 'tc -batch' (see
+tcbatch), and builds the RTM_NEWQDISC/RTM_NEWTCLASS/RTM_NEWTFILTER
+messages tc would for them - rate tables included - sending them in
+batches over one NETLINK_ROUTE socket, and collecting the kernel's
+ACKs. Only the parts of tc's syntax which pyshaper generates are
+understood: htb, sfq, prio and ingress qdiscs, htb classes, u32 filters
+with flowids, links, hash tables, police and connmark actions, fw
+filters, flower filters on IPv4 addresses and ports, and bpf filters
+with inline bytecode
+
+It can also dump the qdiscs, classes and filters already on a device,
+for tcstate to compare with what we think is there, and for tcstats to
+read the kernel's byte counts from
+"""
+
+import fcntl
+import os
+import re
+import socket
+import struct
+
+from pyshaper.sockdiag import nlmsghdr, nlmsgAlign
+
+
+NETLINK_ROUTE = 0
+
+RTM_NEWQDISC = 36
+RTM_DELQDISC = 37
+RTM_GETQDISC = 38
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_GETTCLASS = 42
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+RTM_GETTFILTER = 46
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x001
+NLM_F_MULTI = 0x002
+NLM_F_ACK = 0x004
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# flags on ACKs
+NLM_F_CAPPED = 0x100
+NLM_F_ACK_TLVS = 0x200
+
+SOL_NETLINK = 270
+NETLINK_CAP_ACK = 10
+NETLINK_EXT_ACK = 11
+NLMSGERR_ATTR_MSG = 1
+
+SIOCGIFINDEX = 0x8933
+
+TC_H_ROOT = 0xffffffffL
+TC_H_INGRESS = 0xfffffff1L
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_STATS = 3
+
+TCA_HTB_PARMS = 1
+TCA_HTB_INIT = 2
+TCA_HTB_CTAB = 3
+TCA_HTB_RTAB = 4
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+
+# htb class prios run from 0 to TC_HTB_NUMPRIO - 1, and the kernel
+# clamps any higher one it's given
+TC_HTB_NUMPRIO = 8
+
+TCA_U32_CLASSID = 1
+TCA_U32_HASH = 2
+TCA_U32_LINK = 3
+TCA_U32_DIVISOR = 4
+TCA_U32_SEL = 5
+TCA_U32_POLICE = 6
+TCA_U32_ACT = 7
+
+TCA_FLOWER_CLASSID = 1
+TCA_FLOWER_ACT = 3
+TCA_FLOWER_KEY_ETH_TYPE = 8
+TCA_FLOWER_KEY_IP_PROTO = 9
+TCA_FLOWER_KEY_IPV4_SRC = 10
+TCA_FLOWER_KEY_IPV4_SRC_MASK = 11
+TCA_FLOWER_KEY_IPV4_DST = 12
+TCA_FLOWER_KEY_IPV4_DST_MASK = 13
+TCA_FLOWER_KEY_TCP_SRC = 18
+TCA_FLOWER_KEY_TCP_DST = 19
+TCA_FLOWER_KEY_UDP_SRC = 20
+TCA_FLOWER_KEY_UDP_DST = 21
+
+TCA_BPF_ACT = 1
+TCA_BPF_CLASSID = 3
+TCA_BPF_OPS_LEN = 4
+TCA_BPF_OPS = 5
+
+TCA_FW_CLASSID = 1
+TCA_FW_POLICE = 2
+TCA_FW_MASK = 5
+
+TCA_ACT_KIND = 1
+TCA_ACT_OPTIONS = 2
+TCA_ACT_STATS = 4
+
+TCA_STATS_BASIC = 1
+
+TCA_CONNMARK_PARMS = 1
+
+TCA_POLICE_TBF = 1
+TCA_POLICE_RATE = 2
+TCA_POLICE_RATE64 = 8
+
+TC_U32_TERMINAL = 1
+
+TC_LINKLAYER_ETHERNET = 1
+
+TC_ACT_UNSPEC = -1
+TC_ACT_OK = 0
+TC_ACT_RECLASSIFY = 1
+TC_ACT_SHOT = 2
+TC_ACT_PIPE = 3
+
+# struct tcmsg: family, pads, ifindex, handle, parent, info
+tcmsg = struct.Struct("=BBHiLLL")
+
+# struct rtattr: len, type
+rtattr = struct.Struct("=HH")
+
+# the start of struct tc_stats: bytes, packets
+tcStats = struct.Struct("=QL")
+
+# struct tc_ratespec: cell_log, linklayer, overhead, cell_align, mpu, rate
+ratespec = struct.Struct("=BBHhHL")
+
+# struct tc_htb_glob: version, rate2quantum, defcls, debug, direct_pkts
+htbGlob = struct.Struct("=LLLLL")
+
+# the rest of struct tc_htb_opt, after the rate and ceil ratespecs:
+# buffer, cbuffer, quantum, level, prio
+htbOptTail = struct.Struct("=LLLLL")
+
+# struct tc_sfq_qopt: quantum, perturb_period, limit, divisor, flows
+sfqQopt = struct.Struct("=LlLLL")
+
+# struct tc_prio_qopt: bands, priomap
+prioQopt = struct.Struct("=i16B")
+
+# struct tc_police, minus its ratespecs and tail: index, action, limit,
+# burst, mtu - and the tail: refcnt, bindcnt, capab
+policeHead = struct.Struct("=LlLLL")
+policeTail = struct.Struct("=llL")
+
+# struct sock_filter: a classic BPF instruction
+sockFilter = struct.Struct("=HBBL")
+
+# struct tc_connmark: tc_gen (index, capab, action, refcnt, bindcnt),
+# then the conntrack zone
+connmarkParms = struct.Struct("=LLiiiHxx")
+
+# struct tc_u32_sel: flags, offshift, nkeys, pad, then offmask (network
+# order), off, offoff, hoff, then hmask (network order)
+u32SelHead = struct.Struct("=BBBx")
+u32SelMid = struct.Struct("=Hhh")
+be16 = struct.Struct("!H")
+be32 = struct.Struct("!L")
+
+# struct tc_u32_key: mask and val in network order, then off, offmask
+u32KeyHead = struct.Struct("!LL")
+u32KeyTail = struct.Struct("=ll")
+
+u32MaxKeys = 128
+
+# what we send for each kind of command - message type and flags
+verbs = {
+    'qdisc': {'add': (RTM_NEWQDISC, NLM_F_CREATE | NLM_F_EXCL),
+              'replace': (RTM_NEWQDISC, NLM_F_CREATE | NLM_F_REPLACE),
+              'change': (RTM_NEWQDISC, 0),
+              'del': (RTM_DELQDISC, 0)},
+    'class': {'add': (RTM_NEWTCLASS, NLM_F_CREATE | NLM_F_EXCL),
+              'replace': (RTM_NEWTCLASS, NLM_F_CREATE | NLM_F_REPLACE),
+              'change': (RTM_NEWTCLASS, 0),
+              'del': (RTM_DELTCLASS, 0)},
+    'filter': {'add': (RTM_NEWTFILTER, NLM_F_CREATE | NLM_F_EXCL),
+               'replace': (RTM_NEWTFILTER, NLM_F_CREATE | NLM_F_REPLACE),
+               'change': (RTM_NEWTFILTER, 0),
+               'del': (RTM_DELTFILTER, 0)},
+}
+
+# unit suffixes for rates, in bits/sec, and sizes, in bytes - as tc has them
+rateUnits = {
+    'bit': 1, 'kbit': 1000, 'mbit': 1000000, 'gbit': 1000000000,
+    'kibit': 1024, 'mibit': 1024 * 1024, 'gibit': 1024 * 1024 * 1024,
+    'bps': 8, 'kbps': 8000, 'mbps': 8000000, 'gbps': 8000000000L,
+    'kibps': 8 * 1024, 'mibps': 8 * 1024 * 1024,
+}
+sizeUnits = {
+    '': 1, 'b': 1,
+    'k': 1024, 'kb': 1024, 'm': 1024 * 1024, 'mb': 1024 * 1024,
+    'g': 1024 * 1024 * 1024, 'gb': 1024 * 1024 * 1024,
+    'kbit': 1024 / 8.0, 'mbit': 1024 * 1024 / 8.0,
+    'gbit': 1024 * 1024 * 1024 / 8.0,
+}
+
+
+class RtnlError(Exception):
+    """
+    A command we can't turn into a netlink message
+    """
+    pass
+
+
+class NoDevice(RtnlError):
+    pass
+
+
+# ----------------------------------------------------------------
+# the kernel's clock, for working out rate tables and burst times
+
+
+# what /proc/net/psched says on most kernels
+pschedDefault = (1000, 64, 1000000, 1000000000)
+
+pschedPath = "/proc/net/psched"
+
+_clock = None
+
+
+def clock():
+    """
+    Returns (ticks per usec, hz) for the kernel's packet scheduler
+    clock, from /proc/net/psched, the same way tc works them out
+    """
+    global _clock
+    if _clock is None:
+        try:
+            f = file(pschedPath)
+            try:
+                t2us, us2t, res, hz = [int(x, 16) for x in f.read().split()[:4]]
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            t2us, us2t, res, hz = pschedDefault
+
+        if res == 1000000000:
+            t2us = us2t
+        tickInUsec = float(t2us) / us2t * (res / 1000000.0)
+        if res != 1000000:
+            hz = 100
+        _clock = (tickInUsec, hz)
+    return _clock
+
+
+def xmitTime(rate, size):
+    """
+    Ticks to send size bytes at rate bytes/sec
+    """
+    usecs = long(1000000.0 * size / rate)
+    return long(usecs * clock()[0]) & 0xffffffffL
+
+
+# (rate, mtu, mpu) -> (ratespec, table), as there are only ever a few
+# different rates about, and tables are slow to work out
+rateTables = {}
+rateTablesMax = 1024
+
+
+def rateTable(rate, mtu=0, mpu=0):
+    """
+    Returns (ratespec, table) for rate (in bytes/sec) - the kernel's
+    table of the time to send packets of each size, as 256 u32s
+    """
+    key = (rate, mtu, mpu)
+    try:
+        return rateTables[key]
+    except KeyError:
+        pass
+
+    if mtu == 0:
+        mtu = 2047
+    cellLog = 0
+    while (mtu >> cellLog) > 255:
+        cellLog += 1
+    tick = clock()[0]
+    table = [long(long(1000000.0 * max((i + 1) << cellLog, mpu) / rate)
+                  * tick) & 0xffffffffL
+             for i in range(256)]
+    spec = ratespec.pack(cellLog, TC_LINKLAYER_ETHERNET, 0, -1, mpu,
+                         min(rate, 0xffffffffL))
+
+    if len(rateTables) >= rateTablesMax:
+        rateTables.clear()
+    result = rateTables[key] = (spec, struct.pack("=256L", *table))
+    return result
+
+
+# ----------------------------------------------------------------
+# parsing tc's syntax
+
+
+def parseHandle(s):
+    """
+    Parses a qdisc or class handle like '1:', '1:101' or 'ffff:'
+    """
+    if s == 'root':
+        return TC_H_ROOT
+    if s == 'none':
+        return 0
+    try:
+        if ":" not in s:
+            raise ValueError(s)
+        major, minor = s.split(":", 1)
+        major = int(major or "0", 16)
+        minor = int(minor or "0", 16)
+    except ValueError:
+        raise RtnlError("Bad handle '%s'" % s)
+    if major > 0xffff or minor > 0xffff:
+        raise RtnlError("Bad handle '%s'" % s)
+    return (major << 16) | minor
+
+
+def parseU32Handle(s):
+    """
+    Parses a u32 handle, 'htid:hash:node', with any part left empty
+    """
+    parts = s.split(":")
+    if len(parts) > 3:
+        raise RtnlError("Bad u32 handle '%s'" % s)
+    parts = parts + [""] * (3 - len(parts))
+    try:
+        htid, bucket, node = [int(part or "0", 16) for part in parts]
+    except ValueError:
+        raise RtnlError("Bad u32 handle '%s'" % s)
+    if htid > 0xfff or bucket > 0xff or node > 0xfff:
+        raise RtnlError("Bad u32 handle '%s'" % s)
+    return (htid << 20) | (bucket << 12) | node
+
+
+def parseFwHandle(s):
+    """
+    Parses an fw handle, 'mark' or 'mark/mask', returning (handle, mask),
+    with mask None if there isn't one
+    """
+    try:
+        if "/" in s:
+            handle, mask = s.split("/", 1)
+            return parseInt(handle, 0), parseInt(mask, 0)
+        return parseInt(s, 0), None
+    except RtnlError:
+        raise RtnlError("Bad fw handle '%s'" % s)
+
+
+def parsePrefix(s):
+    """
+    Parses an IPv4 address or CIDR block, returning (address, mask)
+    as ints
+    """
+    addr = s
+    plen = 32
+    if "/" in addr:
+        addr, plen = addr.split("/", 1)
+        plen = parseInt(plen)
+    try:
+        val = be32.unpack(socket.inet_aton(addr))[0]
+    except socket.error:
+        raise RtnlError("Bad address '%s'" % s)
+    if not 0 <= plen <= 32:
+        raise RtnlError("Bad address '%s'" % s)
+    return val, (0xffffffffL << (32 - plen)) & 0xffffffffL
+
+
+def splitUnit(s):
+
+    i = 0
+    while i < len(s) and (s[i].isdigit() or s[i] == '.'):
+        i += 1
+    try:
+        return float(s[:i]), s[i:].lower()
+    except ValueError:
+        raise RtnlError("Bad number '%s'" % s)
+
+
+def parseRate(s):
+    """
+    Parses a rate, returning bytes/sec. Plain numbers are bits/sec
+    """
+    n, unit = splitUnit(s)
+    if unit == '':
+        unit = 'bit'
+    try:
+        return long(n * rateUnits[unit] / 8)
+    except KeyError:
+        raise RtnlError("Bad rate '%s'" % s)
+
+
+def parseSize(s):
+    """
+    Parses a size, returning bytes
+    """
+    n, unit = splitUnit(s)
+    try:
+        return long(n * sizeUnits[unit])
+    except KeyError:
+        raise RtnlError("Bad size '%s'" % s)
+
+
+def parseInt(s, base=10):
+
+    try:
+        return int(s, base)
+    except ValueError:
+        raise RtnlError("Bad number '%s'" % s)
+
+
+reQuoted = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def argList(cmd):
+    """
+    Splits a command into words, reversed so they can be taken off
+    the front with pop() - running out raises IndexError. Words can
+    be in double quotes, like tc's bpf bytecode
+    """
+    if '"' in cmd:
+        args = [quoted or word for quoted, word in reQuoted.findall(cmd)]
+    else:
+        args = cmd.split()
+    args.reverse()
+    return args
+
+
+def attr(atype, payload):
+    """
+    Builds an rtattr, padded to 4 bytes
+    """
+    length = rtattr.size + len(payload)
+    return rtattr.pack(length, atype) + payload \
+        + "\0" * (nlmsgAlign(length) - length)
+
+
+def attr32(atype, value):
+    return attr(atype, struct.pack("=L", value))
+
+
+def parseAttrs(data):
+    """
+    Splits data into a list of (type, payload) tuples
+    """
+    attrs = []
+    offset = 0
+    while offset + rtattr.size <= len(data):
+        length, atype = rtattr.unpack_from(data, offset)
+        if length < rtattr.size:
+            break
+        attrs.append((atype, data[offset + rtattr.size:offset + length]))
+        offset += nlmsgAlign(length)
+    return attrs
+
+
+# ----------------------------------------------------------------
+# qdisc, class and filter options
+
+
+def htbQdiscOpts(args):
+
+    defcls = 0
+    r2q = 10
+    while args:
+        word = args.pop()
+        if word == 'default':
+            defcls = parseInt(args.pop(), 16)
+        elif word == 'r2q':
+            r2q = parseInt(args.pop())
+        else:
+            raise RtnlError("Unsupported htb option '%s'" % word)
+    return attr(TCA_HTB_INIT, htbGlob.pack(3, r2q, defcls, 0, 0))
+
+
+def htbClassOpts(args):
+
+    rate = ceil = None
+    buf = cbuf = 0
+    prio = quantum = 0
+    mtu = 1600
+    while args:
+        word = args.pop()
+        if word == 'rate':
+            rate = parseRate(args.pop())
+        elif word == 'ceil':
+            ceil = parseRate(args.pop())
+        elif word in ('burst', 'buffer', 'maxburst'):
+            buf = parseSize(args.pop())
+        elif word in ('cburst', 'cbuffer', 'cmaxburst'):
+            cbuf = parseSize(args.pop())
+        elif word == 'prio':
+            prio = parseInt(args.pop())
+        elif word == 'quantum':
+            quantum = parseSize(args.pop())
+        elif word == 'mtu':
+            mtu = parseSize(args.pop())
+        else:
+            raise RtnlError("Unsupported htb option '%s'" % word)
+
+    if not rate:
+        raise RtnlError("htb class needs a rate")
+    if not ceil:
+        ceil = rate
+
+    hz = clock()[1]
+    if not buf:
+        buf = rate / hz + mtu
+    if not cbuf:
+        cbuf = ceil / hz + mtu
+
+    rspec, rtab = rateTable(rate, mtu)
+    cspec, ctab = rateTable(ceil, mtu)
+    opt = rspec + cspec + htbOptTail.pack(
+        xmitTime(rate, buf), xmitTime(ceil, cbuf), quantum, 0, prio)
+
+    opts = ""
+    if rate > 0xffffffffL:
+        opts += attr(TCA_HTB_RATE64, struct.pack("=Q", rate))
+    if ceil > 0xffffffffL:
+        opts += attr(TCA_HTB_CEIL64, struct.pack("=Q", ceil))
+    return opts + attr(TCA_HTB_PARMS, opt) + attr(TCA_HTB_RTAB, rtab) \
+        + attr(TCA_HTB_CTAB, ctab)
+
+
+def sfqQdiscOpts(args):
+
+    quantum = limit = perturb = 0
+    while args:
+        word = args.pop()
+        if word == 'perturb':
+            perturb = parseInt(args.pop())
+        elif word == 'quantum':
+            quantum = parseSize(args.pop())
+        elif word == 'limit':
+            limit = parseInt(args.pop())
+        else:
+            raise RtnlError("Unsupported sfq option '%s'" % word)
+    return sfqQopt.pack(quantum, perturb, limit, 0, 0)
+
+
+def prioQdiscOpts(args):
+
+    bands = 3
+    priomap = [1, 2, 2, 2, 1, 2, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1]
+    while args:
+        word = args.pop()
+        if word == 'bands':
+            bands = parseInt(args.pop())
+        elif word == 'priomap':
+            priomap = []
+            while args and len(priomap) < 16:
+                priomap.append(parseInt(args.pop()))
+            if len(priomap) != 16:
+                raise RtnlError("priomap needs 16 bands")
+        else:
+            raise RtnlError("Unsupported prio option '%s'" % word)
+    for band in priomap:
+        if band >= bands:
+            raise RtnlError("priomap band %s out of range" % band)
+    return prioQopt.pack(bands, *priomap)
+
+
+def policeOpts(args):
+    """
+    Parses a police action, stopping at the first word which isn't
+    part of it
+    """
+    rate = burst = mtu = 0
+    action = TC_ACT_RECLASSIFY
+    while args:
+        word = args[-1]
+        if word == 'rate':
+            args.pop()
+            rate = parseRate(args.pop())
+        elif word in ('burst', 'buffer', 'maxburst'):
+            args.pop()
+            burst = parseSize(args.pop())
+        elif word in ('mtu', 'minburst'):
+            args.pop()
+            mtu = parseSize(args.pop())
+        elif word in actionControls:
+            args.pop()
+            action = actionControls[word]
+        else:
+            break
+
+    if not rate:
+        raise RtnlError("police needs a rate")
+    if not burst:
+        raise RtnlError("police needs a burst")
+
+    spec, table = rateTable(rate, mtu)
+    tbf = policeHead.pack(0, action, 0, xmitTime(rate, burst), mtu) \
+        + spec + ratespec.pack(0, 0, 0, 0, 0, 0) + policeTail.pack(0, 0, 0)
+    opts = attr(TCA_POLICE_TBF, tbf) + attr(TCA_POLICE_RATE, table)
+    if rate > 0xffffffffL:
+        opts += attr(TCA_POLICE_RATE64, struct.pack("=Q", rate))
+    return opts
+
+
+def connmarkOpts(args):
+    """
+    Parses a connmark action's options, stopping at the first word
+    which isn't one of them
+    """
+    zone = 0
+    action = TC_ACT_PIPE
+    while args:
+        word = args[-1]
+        if word == 'zone':
+            args.pop()
+            zone = parseInt(args.pop())
+        elif word in actionControls:
+            args.pop()
+            action = actionControls[word]
+        else:
+            break
+    return attr(TCA_CONNMARK_PARMS, connmarkParms.pack(0, 0, action, 0, 0, zone))
+
+
+def actionOpts(args):
+    """
+    Parses the action after a filter's 'action' keyword, as the list
+    of actions the filter's TCA_*_ACT attribute holds
+    """
+    kind = args.pop()
+    if kind not in actionKinds:
+        raise RtnlError("Unsupported action '%s'" % kind)
+    return attr(1, attr(TCA_ACT_KIND, kind + "\0")
+                + attr(TCA_ACT_OPTIONS, actionKinds[kind](args)))
+
+
+class U32Sel:
+    """
+    The selector of a u32 filter - its match keys, merged the way tc
+    merges them
+    """
+
+    def __init__(self):
+
+        self.flags = 0
+        self.keys = []
+        self.hmask = 0
+        self.hoff = 0
+
+    def packKey(self, val, mask, off, offmask=0):
+
+        val &= mask
+        for key in self.keys:
+            if key[2] == off and key[3] == offmask:
+                if (key[1] ^ val) & mask & key[0]:
+                    raise RtnlError("Conflicting u32 matches at offset %d" % off)
+                key[0] |= mask
+                key[1] |= val
+                return
+        if off % 4:
+            raise RtnlError("u32 match offset %d not word aligned" % off)
+        if len(self.keys) >= u32MaxKeys:
+            raise RtnlError("Too many u32 matches")
+        self.keys.append([mask, val, off, offmask])
+
+    def packKey16(self, val, mask, off):
+
+        if val > 0xffff or mask > 0xffff:
+            raise RtnlError("u32 16 bit match out of range")
+        if off % 4 == 0:
+            val <<= 16
+            mask <<= 16
+        self.packKey(val, mask, off - off % 4)
+
+    def packKey8(self, val, mask, off):
+
+        if val > 0xff or mask > 0xff:
+            raise RtnlError("u32 8 bit match out of range")
+        shift = 24 - 8 * (off % 4)
+        self.packKey(val << shift, mask << shift, off - off % 4)
+
+    def match(self, args):
+        """
+        Parses the rest of a 'match ...' clause
+        """
+        layer = args.pop()
+        if layer == 'u32':
+            val = parseInt(args.pop(), 0) & 0xffffffffL
+            mask = parseInt(args.pop(), 0) & 0xffffffffL
+            off = 0
+            if args and args[-1] == 'at':
+                args.pop()
+                off = parseInt(args.pop(), 0)
+            self.packKey(val, mask, off)
+        elif layer == 'ip':
+            what = args.pop()
+            if what in ('src', 'dst'):
+                val, mask = parsePrefix(args.pop())
+                self.packKey(val, mask, {'src': 12, 'dst': 16}[what])
+            elif what in ('sport', 'dport'):
+                val = parseInt(args.pop(), 0)
+                mask = parseInt(args.pop(), 0)
+                self.packKey16(val, mask, {'sport': 20, 'dport': 22}[what])
+            elif what in ('protocol', 'tos', 'dsfield'):
+                val = parseInt(args.pop(), 0)
+                mask = parseInt(args.pop(), 0)
+                self.packKey8(val, mask, {'protocol': 9}.get(what, 1))
+            else:
+                raise RtnlError("Unsupported u32 match 'ip %s'" % what)
+        else:
+            raise RtnlError("Unsupported u32 match '%s'" % layer)
+
+    def pack(self):
+
+        data = u32SelHead.pack(self.flags, 0, len(self.keys)) \
+            + be16.pack(0) + u32SelMid.pack(0, 0, self.hoff) \
+            + be32.pack(self.hmask)
+        for mask, val, off, offmask in self.keys:
+            data += u32KeyHead.pack(mask, val) + u32KeyTail.pack(off, offmask)
+        return data
+
+
+def u32Opts(args):
+
+    if not args:
+        # just the filter's prio, as tc has it
+        return None
+    sel = U32Sel()
+    hasSel = False
+    opts = ""
+    while args:
+        word = args.pop()
+        if word == 'match':
+            sel.match(args)
+            hasSel = True
+        elif word == 'hashkey':
+            if args.pop() != 'mask':
+                raise RtnlError("Unsupported u32 hashkey")
+            sel.hmask = parseInt(args.pop(), 16) & 0xffffffffL
+            if args and args[-1] == 'at':
+                args.pop()
+                sel.hoff = parseInt(args.pop(), 0)
+            hasSel = True
+        elif word == 'divisor':
+            opts += attr32(TCA_U32_DIVISOR, parseInt(args.pop()))
+        elif word == 'ht':
+            opts += attr32(TCA_U32_HASH, parseU32Handle(args.pop()))
+        elif word == 'link':
+            opts += attr32(TCA_U32_LINK, parseU32Handle(args.pop()))
+        elif word in ('flowid', 'classid'):
+            opts += attr32(TCA_U32_CLASSID, parseHandle(args.pop()))
+            sel.flags |= TC_U32_TERMINAL
+        elif word == 'police':
+            opts += attr(TCA_U32_POLICE, policeOpts(args))
+            sel.flags |= TC_U32_TERMINAL
+        elif word == 'action':
+            opts += attr(TCA_U32_ACT, actionOpts(args))
+            sel.flags |= TC_U32_TERMINAL
+        else:
+            raise RtnlError("Unsupported u32 option '%s'" % word)
+    if hasSel:
+        opts += attr(TCA_U32_SEL, sel.pack())
+    return opts
+
+
+def flowerOpts(args):
+    """
+    Parses a flower filter's options - the ethernet type comes from
+    the filter's protocol, and gets added in Rtnl.encodeArgs
+    """
+    opts = ""
+    ports = None
+    while args:
+        word = args.pop()
+        if word == 'ip_proto':
+            proto = args.pop()
+            try:
+                num, ports = flowerProtos[proto]
+            except KeyError:
+                raise RtnlError("Unsupported flower ip_proto '%s'" % proto)
+            opts += attr(TCA_FLOWER_KEY_IP_PROTO, struct.pack("B", num))
+        elif word in ('src_ip', 'dst_ip'):
+            val, mask = parsePrefix(args.pop())
+            if word == 'src_ip':
+                keys = (TCA_FLOWER_KEY_IPV4_SRC, TCA_FLOWER_KEY_IPV4_SRC_MASK)
+            else:
+                keys = (TCA_FLOWER_KEY_IPV4_DST, TCA_FLOWER_KEY_IPV4_DST_MASK)
+            opts += attr(keys[0], be32.pack(val)) + attr(keys[1], be32.pack(mask))
+        elif word in ('src_port', 'dst_port'):
+            if ports is None:
+                raise RtnlError("flower %s needs an ip_proto first" % word)
+            port = parseInt(args.pop())
+            if not 0 <= port <= 0xffff:
+                raise RtnlError("Bad flower %s '%s'" % (word, port))
+            opts += attr(ports[word], be16.pack(port))
+        elif word in ('flowid', 'classid'):
+            opts += attr32(TCA_FLOWER_CLASSID, parseHandle(args.pop()))
+        elif word == 'action':
+            opts += attr(TCA_FLOWER_ACT, actionOpts(args))
+        else:
+            raise RtnlError("Unsupported flower option '%s'" % word)
+    return opts
+
+
+def bpfOpts(args):
+
+    opts = ""
+    while args:
+        word = args.pop()
+        if word == 'bytecode':
+            prog = parseBytecode(args.pop())
+            opts += attr(TCA_BPF_OPS_LEN, struct.pack("=H", len(prog)))
+            opts += attr(TCA_BPF_OPS, "".join(
+                [sockFilter.pack(*i) for i in prog]))
+        elif word in ('flowid', 'classid'):
+            opts += attr32(TCA_BPF_CLASSID, parseHandle(args.pop()))
+        elif word == 'action':
+            opts += attr(TCA_BPF_ACT, actionOpts(args))
+        else:
+            raise RtnlError("Unsupported bpf option '%s'" % word)
+    return opts
+
+
+def parseBytecode(s):
+    """
+    Parses tc's bpf bytecode - the number of instructions, then each
+    instruction as 'code jt jf k', separated by commas
+    """
+    parts = s.rstrip(",").split(",")
+    try:
+        count = int(parts[0])
+        prog = [tuple([int(n) for n in part.split()]) for part in parts[1:]]
+    except ValueError:
+        raise RtnlError("Bad bpf bytecode")
+    if count != len(prog) or [i for i in prog if len(i) != 4]:
+        raise RtnlError("Bad bpf bytecode")
+    return prog
+
+
+def fwOpts(args):
+
+    opts = ""
+    while args:
+        word = args.pop()
+        if word in ('flowid', 'classid'):
+            opts += attr32(TCA_FW_CLASSID, parseHandle(args.pop()))
+        elif word == 'police':
+            opts += attr(TCA_FW_POLICE, policeOpts(args))
+        else:
+            raise RtnlError("Unsupported fw option '%s'" % word)
+    return opts
+
+
+actionControls = {
+    'drop': TC_ACT_SHOT, 'shot': TC_ACT_SHOT,
+    'continue': TC_ACT_UNSPEC, 'pipe': TC_ACT_PIPE,
+    'pass': TC_ACT_OK, 'ok': TC_ACT_OK,
+    'reclassify': TC_ACT_RECLASSIFY,
+}
+actionKinds = {
+    'connmark': connmarkOpts,
+    'police': policeOpts,
+}
+flowerProtos = {
+    'tcp': (6, {'src_port': TCA_FLOWER_KEY_TCP_SRC,
+                'dst_port': TCA_FLOWER_KEY_TCP_DST}),
+    'udp': (17, {'src_port': TCA_FLOWER_KEY_UDP_SRC,
+                 'dst_port': TCA_FLOWER_KEY_UDP_DST}),
+}
+qdiscKinds = {
+    'htb': htbQdiscOpts,
+    'sfq': sfqQdiscOpts,
+    'prio': prioQdiscOpts,
+    'ingress': None,
+}
+classKinds = {
+    'htb': htbClassOpts,
+}
+filterKinds = {
+    'u32': u32Opts,
+    'fw': fwOpts,
+    'flower': flowerOpts,
+    'bpf': bpfOpts,
+}
+
+# the option holding each kind of filter's list of actions, and its
+# old style police - the kernel reports the counts of the first inside
+# each action, and of the second at the top of the filter
+filterActAttrs = {
+    'u32': TCA_U32_ACT,
+    'flower': TCA_FLOWER_ACT,
+    'bpf': TCA_BPF_ACT,
+}
+filterPoliceAttrs = {
+    'u32': TCA_U32_POLICE,
+    'fw': TCA_FW_POLICE,
+}
+protocols = {
+    'ip': ETH_P_IP,
+    'all': ETH_P_ALL,
+}
+
+
+# ----------------------------------------------------------------
+
+
+def ifindexIoctl(dev):
+    """
+    Looks up the index of interface dev, or returns None if there's
+    no such interface
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            ifr = fcntl.ioctl(sock.fileno(), SIOCGIFINDEX,
+                              struct.pack("16si", dev, 0))
+        except IOError:
+            return None
+    finally:
+        sock.close()
+    return struct.unpack("16si", ifr)[1]
+
+
+class Rtnl:
+    """
+    Runs tc commands by sending the equivalent rtnetlink messages
+    over a NETLINK_ROUTE socket
+
+    The socket is opened on first use and kept open. Pass in 'sock'
+    and 'ifindex' (a function mapping interface names to indexes) to
+    use something other than the real kernel (see FakeRtnlSocket)
+    """
+
+    bufsize = 65536
+
+    # how many bytes of messages to send before waiting for their ACKs
+    chunkSize = 32768
+
+    def __init__(self, sock=None, ifindex=None):
+
+        self.sock = sock
+        if ifindex is None:
+            ifindex = ifindexIoctl
+        self.ifindex = ifindex
+        self.ifindexes = {}
+        self.seq = 0
+
+    def open(self):
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, 0))
+
+        # ask for short ACKs, with the kernel's error messages if it
+        # has any - not all kernels can do these
+        for opt in (NETLINK_CAP_ACK, NETLINK_EXT_ACK):
+            try:
+                sock.setsockopt(SOL_NETLINK, opt, 1)
+            except socket.error:
+                pass
+        self.sock = sock
+
+    def close(self):
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def devIndex(self, dev):
+
+        try:
+            return self.ifindexes[dev]
+        except KeyError:
+            index = self.ifindex(dev)
+            if index is None:
+                raise NoDevice("Cannot find device \"%s\"" % dev)
+            self.ifindexes[dev] = index
+            return index
+
+    def encode(self, cmd):
+        """
+        Builds the netlink message for tc command cmd (minus the
+        leading 'tc'), as (type, flags, body) - raises RtnlError if
+        cmd isn't something we understand
+        """
+        try:
+            return self.encodeArgs(cmd, argList(cmd))
+        except IndexError:
+            raise RtnlError("Missing argument in '%s'" % cmd)
+
+    def encodeArgs(self, cmd, args):
+
+        obj = args.pop()
+        verb = args.pop()
+        try:
+            msgtype, flags = verbs[obj][verb]
+        except KeyError:
+            raise RtnlError("Unsupported command '%s %s'" % (obj, verb))
+
+        ifindex = handle = parent = info = 0
+        kind = None
+        opts = None
+        protocol = 0
+        prio = 0
+        fhandle = None
+
+        if obj == 'qdisc':
+            kinds = qdiscKinds
+        elif obj == 'class':
+            kinds = classKinds
+        else:
+            kinds = filterKinds
+
+        while args:
+            word = args.pop()
+            if word == 'dev':
+                ifindex = args.pop()
+            elif word == 'root':
+                parent = TC_H_ROOT
+            elif word == 'ingress' and obj == 'qdisc':
+                parent = TC_H_INGRESS
+                handle = 0xffff0000L
+                kind = 'ingress'
+            elif word == 'parent':
+                parent = parseHandle(args.pop())
+            elif word == 'handle' and obj == 'qdisc':
+                handle = parseHandle(args.pop())
+            elif word == 'handle':
+                fhandle = args.pop()
+            elif word == 'classid' and obj == 'class':
+                handle = parseHandle(args.pop())
+            elif word == 'protocol' and obj == 'filter':
+                try:
+                    protocol = protocols[args.pop()]
+                except KeyError:
+                    raise RtnlError("Unsupported protocol in '%s'" % cmd)
+            elif word in ('prio', 'pref', 'priority') and obj == 'filter':
+                prio = parseInt(args.pop())
+            elif word in kinds:
+                kind = word
+                if kinds[word] is not None:
+                    opts = kinds[word](args)
+            else:
+                raise RtnlError("Unsupported tc syntax '%s' in '%s'" % (
+                    word, cmd))
+
+        if not ifindex:
+            raise RtnlError("No device in '%s'" % cmd)
+        if obj == 'filter':
+            info = (prio << 16) | socket.htons(protocol)
+            if fhandle is not None:
+                if kind == 'u32':
+                    handle = parseU32Handle(fhandle)
+                elif kind == 'fw':
+                    handle, mask = parseFwHandle(fhandle)
+                    if mask is not None:
+                        opts = (opts or "") + attr32(TCA_FW_MASK, mask)
+                elif kind in ('flower', 'bpf'):
+                    handle = parseInt(fhandle, 0)
+                else:
+                    raise RtnlError("Filter handle without a kind in '%s'" % cmd)
+            if kind == 'flower' and protocol not in (0, ETH_P_ALL):
+                opts = (opts or "") + attr(TCA_FLOWER_KEY_ETH_TYPE,
+                                           be16.pack(protocol))
+
+        # looked up last, so a missing device doesn't hide bad syntax
+        ifindex = self.devIndex(ifindex)
+
+        body = tcmsg.pack(socket.AF_UNSPEC, 0, 0, ifindex, handle, parent, info)
+        if kind is not None:
+            body += attr(TCA_KIND, kind + "\0")
+        if opts is not None:
+            body += attr(TCA_OPTIONS, opts)
+        return msgtype, flags, body
+
+    def runBatch(self, cmds):
+        """
+        Runs cmds, a list of tc commands minus the leading 'tc'
+
+        Returns a list of (index, message) tuples for the commands which
+        failed, where index is the command's position in cmds, just as
+        tcbatch.runBatch does. Raises RtnlError without sending anything
+        if any command isn't one we understand, and socket.error if
+        the netlink socket can't be used
+        """
+        failed = []
+        msgs = []
+        for index, cmd in enumerate(cmds):
+            try:
+                msgs.append((index, self.encode(cmd)))
+            except NoDevice, e:
+                failed.append((index, str(e)))
+
+        if msgs and self.sock is None:
+            self.open()
+
+        chunk = []
+        chunkLen = 0
+        for index, (msgtype, flags, body) in msgs:
+            self.seq = (self.seq + 1) & 0xffffffffL
+            msg = nlmsghdr.pack(nlmsghdr.size + len(body), msgtype,
+                                NLM_F_REQUEST | NLM_F_ACK | flags,
+                                self.seq, 0) + body
+            chunk.append((self.seq, index, msg))
+            chunkLen += len(msg)
+            if chunkLen >= self.chunkSize:
+                failed.extend(self.sendChunk(chunk))
+                chunk = []
+                chunkLen = 0
+        if chunk:
+            failed.extend(self.sendChunk(chunk))
+
+        failed.sort()
+        return failed
+
+    def sendChunk(self, chunk):
+        """
+        Sends a list of (seq, index, message) in one go, and waits for
+        all their ACKs, returning (index, message) for each failure
+        """
+        try:
+            self.sock.send("".join([msg for seq, index, msg in chunk]))
+        except:
+            # don't keep a broken socket around
+            self.close()
+            raise
+
+        waiting = dict([(seq, index) for seq, index, msg in chunk])
+        failed = []
+        while waiting:
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                self.close()
+                raise socket.error("netlink socket closed while waiting for ACKs")
+            for msgtype, flags, seq, payload in splitMessages(data):
+                if msgtype != NLMSG_ERROR or seq not in waiting:
+                    continue
+                index = waiting.pop(seq)
+                errno, msg = decodeAck(flags, payload)
+                if errno:
+                    failed.append((index, msg))
+        return failed
+
+
+    def dump(self, msgtype, dev, parent=0):
+        """
+        Dumps device dev's qdiscs, classes or filters - msgtype is
+        RTM_GETQDISC, RTM_GETTCLASS or RTM_GETTFILTER, and filters get
+        dumped from qdisc parent - returning a list of them, as
+        decodeMessage has them
+
+        Raises RtnlError if the kernel won't, NoDevice if there's no
+        such device, and socket.error if the netlink socket can't be
+        used
+        """
+        ifindex = self.devIndex(dev)
+        if self.sock is None:
+            self.open()
+
+        self.seq = seq = (self.seq + 1) & 0xffffffffL
+        body = tcmsg.pack(socket.AF_UNSPEC, 0, 0, ifindex, 0, parent, 0)
+        try:
+            self.sock.send(nlmsghdr.pack(nlmsghdr.size + len(body), msgtype,
+                                         NLM_F_REQUEST | NLM_F_DUMP, seq, 0)
+                           + body)
+        except:
+            self.close()
+            raise
+
+        msgs = []
+        while True:
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                self.close()
+                raise socket.error("netlink socket closed during dump")
+            for mtype, flags, mseq, payload in splitMessages(data):
+                if mseq != seq:
+                    continue
+                if mtype == NLMSG_DONE:
+                    return msgs
+                if mtype == NLMSG_ERROR:
+                    errno, msg = decodeAck(flags, payload)
+                    if errno:
+                        raise RtnlError(msg)
+                    continue
+                msg = decodeMessage(nlmsghdr.pack(
+                    nlmsghdr.size + len(payload), mtype, flags, mseq, 0)
+                    + payload)
+                # qdisc dumps cover every device
+                if msg['ifindex'] == ifindex:
+                    msgs.append(msg)
+
+
+def splitMessages(data):
+    """
+    Splits a netlink datagram into (type, flags, seq, payload) tuples
+    """
+    offset = 0
+    while offset + nlmsghdr.size <= len(data):
+        msglen, msgtype, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+        if msglen < nlmsghdr.size:
+            break
+        yield msgtype, flags, seq, data[offset + nlmsghdr.size:offset + msglen]
+        offset += nlmsgAlign(msglen)
+
+
+def decodeAck(flags, payload):
+    """
+    Decodes the payload of an NLMSG_ERROR, returning (errno, message),
+    with errno 0 for success
+    """
+    errno = -struct.unpack_from("=l", payload, 0)[0]
+    if not errno:
+        return 0, None
+    msg = os.strerror(errno)
+
+    if flags & NLM_F_ACK_TLVS:
+        # the kernel's own message comes after the request, or just
+        # its header if the ACK's been capped
+        if flags & NLM_F_CAPPED:
+            offset = 4 + nlmsghdr.size
+        else:
+            offset = 4 + nlmsgAlign(nlmsghdr.unpack_from(payload, 4)[0])
+        for atype, value in parseAttrs(payload[offset:]):
+            if atype == NLMSGERR_ATTR_MSG:
+                msg = "Error: %s" % value.rstrip("\0")
+    return errno, msg
+
+
+def encodeAck(seq, errno=0, msg=None):
+    """
+    Builds an ACK for message seq, as the kernel would send it with
+    NETLINK_CAP_ACK - errno 0 for success
+    """
+    flags = NLM_F_CAPPED
+    body = struct.pack("=l", -errno) \
+        + nlmsghdr.pack(nlmsghdr.size, 0, 0, seq, 0)
+    if msg:
+        flags |= NLM_F_ACK_TLVS
+        body += attr(NLMSGERR_ATTR_MSG, msg + "\0")
+    return nlmsghdr.pack(nlmsghdr.size + len(body), NLMSG_ERROR, flags,
+                         seq, 0) + body
+
+
+def decodeMessage(data):
+    """
+    Decodes one rtnetlink tc message into a dict, for looking at what
+    got sent or dumped - attributes are left as (type, payload) lists,
+    with TCA_OPTIONS parsed one level down where it holds attributes.
+    Dumps come with the byte and packet counts the kernel keeps
+    """
+    msglen, msgtype, flags, seq, pid = nlmsghdr.unpack_from(data, 0)
+    family, pad1, pad2, ifindex, handle, parent, info = tcmsg.unpack_from(
+        data, nlmsghdr.size)
+    msg = {
+        'type': msgtype, 'flags': flags, 'seq': seq,
+        'ifindex': ifindex, 'handle': handle, 'parent': parent,
+        'info': info, 'kind': None, 'options': None,
+        'bytes': None, 'packets': None,
+    }
+    for atype, value in parseAttrs(data[nlmsghdr.size + tcmsg.size:msglen]):
+        if atype == TCA_KIND:
+            msg['kind'] = value.rstrip("\0")
+        elif atype == TCA_OPTIONS:
+            if msg['kind'] in ('sfq', 'prio', 'pfifo', 'bfifo', 'pfifo_fast'):
+                msg['options'] = value
+            else:
+                msg['options'] = parseAttrs(value)
+        elif atype == TCA_STATS:
+            msg['bytes'], msg['packets'] = tcStats.unpack_from(value)
+    return msg
+
+
+class FakeRtnlSocket:
+    """
+    Stands in for a NETLINK_ROUTE socket, so that Rtnl can be tried out
+    without root, or the kernel
+
+    Every message sent gets decoded (see decodeMessage) and kept in
+    self.messages, and ACKed. Set 'errors' to a dict of message number
+    (counting from 0, across everything sent) -> (errno, message) to
+    have those messages fail. Use self.ifindex as Rtnl's ifindex
+    function - interfaces are as given in 'ifaces', name -> index
+
+    The qdiscs, classes and filters set up by the messages which
+    succeed are kept in self.objects, as decodeMessage has them, and
+    dumps get answered from there. Set an object's 'bytes' (and
+    'packets') to have its dump carry those counts, where the kernel
+    would put them
+    """
+
+    def __init__(self, ifaces=None, errors=None):
+
+        if ifaces is None:
+            ifaces = {'lo': 1, 'eth0': 2}
+        self.ifaces = ifaces
+        self.errors = errors or {}
+        self.messages = []
+        self.objects = []
+        self.pending = []
+
+    def ifindex(self, dev):
+        return self.ifaces.get(dev, None)
+
+    def send(self, data):
+
+        acks = []
+        for msgtype, flags, seq, payload in splitMessages(data):
+            if flags & NLM_F_DUMP == NLM_F_DUMP:
+                self.pending.append(self.dump(msgtype, seq, payload))
+                continue
+            hdr = nlmsghdr.pack(nlmsghdr.size + len(payload), msgtype, flags,
+                                seq, 0)
+            msg = decodeMessage(hdr + payload)
+            errno, text = self.errors.get(len(self.messages), (0, None))
+            self.messages.append(msg)
+            if not errno:
+                msg['body'] = payload
+                self.update(msg)
+            acks.append(encodeAck(seq, errno, text))
+        if acks:
+            self.pending.append("".join(acks))
+        return len(data)
+
+    def update(self, msg):
+        """
+        Adds, changes or deletes the object msg is for
+        """
+        if msg['type'] in (RTM_NEWQDISC, RTM_NEWTCLASS, RTM_NEWTFILTER):
+            for i, obj in enumerate(self.objects):
+                if sameObject(obj, msg) and msg['handle']:
+                    msg['bytes'], msg['packets'] = obj['bytes'], obj['packets']
+                    self.objects[i] = msg
+                    return
+            self.objects.append(msg)
+            return
+
+        # deleting a qdisc takes its classes and filters with it
+        major = None
+        if msg['type'] == RTM_DELQDISC:
+            for obj in self.objects:
+                if sameObject(obj, msg):
+                    major = obj['handle'] >> 16
+        self.objects = [obj for obj in self.objects
+                        if not sameObject(obj, msg)
+                        and not (major is not None
+                                 and obj['type'] != RTM_NEWQDISC
+                                 and obj['ifindex'] == msg['ifindex']
+                                 and childMajor(obj) == major)]
+
+    def dump(self, msgtype, seq, payload):
+        """
+        Returns the reply to a dump request, with the counts the kernel
+        would give
+        """
+        family, pad1, pad2, ifindex, handle, parent, info = \
+            tcmsg.unpack_from(payload)
+        data = []
+        for obj in self.objects:
+            if obj['type'] != msgtype - 2 or obj['ifindex'] != ifindex:
+                continue
+            if msgtype == RTM_GETTFILTER and obj['parent'] != parent:
+                continue
+            body = withCounts(obj)
+            data.append(nlmsghdr.pack(nlmsghdr.size + len(body), obj['type'],
+                                      NLM_F_MULTI, seq, 0) + body)
+        data.append(nlmsghdr.pack(nlmsghdr.size + 4, NLMSG_DONE, NLM_F_MULTI,
+                                  seq, 0) + struct.pack("=l", 0))
+        return "".join(data)
+
+    def recv(self, bufsize):
+
+        if not self.pending:
+            return ""
+        return self.pending.pop(0)
+
+    def close(self):
+        pass
+
+
+def sameObject(obj, msg):
+    """
+    Tells whether a NEW or DEL message msg is for object obj, as kept
+    by FakeRtnlSocket
+    """
+    if obj['type'] not in (msg['type'], msg['type'] - 1) \
+            or obj['ifindex'] != msg['ifindex']:
+        return False
+    if obj['type'] == RTM_NEWQDISC:
+        if msg['handle']:
+            return obj['handle'] == msg['handle']
+        return obj['parent'] == msg['parent']
+    if obj['type'] == RTM_NEWTCLASS:
+        return obj['handle'] == msg['handle']
+    return obj['parent'] == msg['parent'] \
+        and (msg['info'] >> 16 in (0, obj['info'] >> 16)) \
+        and (msg['handle'] in (0, obj['handle']))
+
+
+def childMajor(obj):
+    """
+    Returns the major of the qdisc a class or filter belongs to
+    """
+    if obj['type'] == RTM_NEWTCLASS:
+        return obj['handle'] >> 16
+    return obj['parent'] >> 16
+
+
+def withCounts(obj):
+    """
+    Returns the body of the message dumping obj, with its counts
+    """
+    body = obj['body']
+    if obj['bytes'] is None:
+        return body
+    stats = tcStats.pack(obj['bytes'], obj['packets'] or 0)
+    kind = obj['kind']
+    opts = dict(obj['options'] or [])
+    if obj['type'] != RTM_NEWTFILTER or filterPoliceAttrs.get(kind) in opts:
+        # struct tc_stats, the rest of it left at 0
+        return body + attr(TCA_STATS, stats + "\0" * 28)
+    if filterActAttrs.get(kind) not in opts:
+        return body
+
+    # each action carries its own, as gnet_stats_basic
+    actions = "".join([attr(order, action + attr(
+        TCA_ACT_STATS, attr(TCA_STATS_BASIC, stats + "\0" * 4)))
+        for order, action in parseAttrs(opts[filterActAttrs[kind]])])
+    data = ""
+    for atype, value in parseAttrs(body[tcmsg.size:]):
+        if atype == TCA_OPTIONS:
+            value = "".join([attr(otype, otype == filterActAttrs[kind]
+                                  and actions or ovalue)
+                             for otype, ovalue in parseAttrs(value)])
+        data += attr(atype, value)
+    return body[:tcmsg.size] + data
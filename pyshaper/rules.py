@@ -0,0 +1,651 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Compiles the '.test' expressions from the config file into Python
+functions
+
+Expressions are parsed into syntax trees, checked against a whitelist
+of harmless constructs, and have their references to connection
+attributes rewritten - so a string literal which happens to contain
+'cc' or 'user' is left alone. For each interface, the tests of all its
+classes are compiled into one decision function, which returns the
+index of the class a connection belongs in
+"""
+
+import ast
+import copy
+
+from pyshaper import prefix
+
+
+# connection attributes which test expressions can refer to
+connFields = ['cc', 'country',
+              'cmd', 'args',
+              'laddr', 'lport', 'raddr', 'rport',
+              'user', 'pid']
+
+# the attributes which static classes can match on
+staticFields = ['raddr', 'rport', 'lport']
+
+# the attributes which hold a single hashable value, so can be used
+# to look classes up in a Dispatcher's index
+indexFields = ['cc', 'country', 'cmd',
+               'laddr', 'lport', 'raddr', 'rport',
+               'user', 'pid']
+
+# how many classes on an interface must be indexable before it's
+# worth classifying via a Dispatcher rather than trying every class
+dispatchThreshold = 8
+
+# other names which test expressions can use
+safeNames = {
+    'True': True,
+    'False': False,
+    'None': None,
+    'len': len,
+    'int': int,
+    'str': str,
+    'prefixes': prefix.getList,
+}
+
+# the attributes which hold addresses, which can be tested against
+# prefix lists and CIDR blocks
+addrFields = ['laddr', 'raddr']
+
+# the syntax allowed in test expressions - no lambdas, comprehensions,
+# generators or anything else that could get up to mischief
+safeNodes = (
+    ast.Expression,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.Invert, ast.UAdd, ast.USub,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod,
+    ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.IfExp,
+    ast.Name, ast.Load, ast.Num, ast.Str, ast.List, ast.Tuple,
+    ast.Subscript, ast.Index, ast.Slice,
+    ast.Attribute, ast.Call,
+)
+
+# syntax which can't raise exceptions or have side effects, so
+# expressions built only from it can be evaluated early and shared
+pureNodes = (
+    ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.Is, ast.IsNot,
+    ast.Name, ast.Load, ast.Num, ast.Str,
+)
+
+
+class RuleError(Exception):
+    pass
+
+
+def parseTest(expr):
+    """
+    Parses test expression expr, returning its syntax tree (an
+    ast.Expression). Raises RuleError if it's not valid Python, or
+    uses anything other than connection attributes, constants and
+    simple operators
+    """
+    try:
+        tree = ast.parse(expr.strip(), "<test>", "eval")
+    except SyntaxError, e:
+        raise RuleError("Invalid test expression '%s': %s" % (expr, e))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, safeNodes):
+            raise RuleError("Test expression '%s' may not contain %s" % (
+                expr, node.__class__.__name__))
+        if isinstance(node, ast.Name):
+            if node.id not in connFields and node.id not in safeNames:
+                raise RuleError("Unknown name '%s' in test expression '%s'" % (
+                    node.id, expr))
+        elif isinstance(node, ast.Attribute):
+            if node.attr.startswith("_"):
+                raise RuleError("Test expression '%s' may not use '%s'" % (
+                    expr, node.attr))
+        elif isinstance(node, ast.Call):
+            if node.starargs or node.kwargs:
+                raise RuleError("Test expression '%s' may not use * or ** args" %
+                                expr)
+            if isinstance(node.func, ast.Name) and node.func.id == 'prefixes':
+                if len(node.args) != 1 or node.keywords \
+                        or not isinstance(node.args[0], ast.Str):
+                    raise RuleError("In test expression '%s', prefixes() takes"
+                                    " the name of a prefix list" % expr)
+        elif isinstance(node, ast.Compare):
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)) \
+                        and isinstance(left, ast.Name) and left.id in addrFields \
+                        and isinstance(right, ast.Str) and "/" in right.s \
+                        and not prefix.isCidr(right.s):
+                    raise RuleError("Bad CIDR block '%s' in test expression '%s'"
+                                    % (right.s, expr))
+                left = right
+    return tree
+
+
+def testFields(tree):
+    """
+    Returns a list of the connection attributes which a parsed
+    test expression refers to
+    """
+    fields = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in connFields \
+                and node.id not in fields:
+            fields.append(node.id)
+    return fields
+
+
+class FieldRewriter(ast.NodeTransformer):
+    """
+    Turns references to connection attributes, eg 'lport', into
+    attribute lookups on the connection, eg 'f.lport'
+    """
+
+    def __init__(self, argname='f'):
+
+        self.argname = argname
+
+    def visit_Name(self, node):
+
+        if node.id not in connFields:
+            return node
+        return ast.copy_location(
+            ast.Attribute(value=ast.Name(id=self.argname, ctx=ast.Load()),
+                          attr=node.id, ctx=ast.Load()),
+            node)
+
+
+class PrefixRewriter(ast.NodeTransformer):
+    """
+    Replaces the right hand side of 'raddr in "10.0.0.0/8"', and, if
+    resolve is set, of 'raddr in prefixes("name")', with a reference
+    to a PrefixTrie. The references are Name nodes with the trie in
+    an extra 'trie' attribute - see prefixNamespace()
+
+    Without this, 'in' a string would be a substring test
+    """
+
+    def __init__(self, resolve=True):
+
+        self.resolve = resolve
+
+    def visit_Compare(self, node):
+
+        self.generic_visit(node)
+        left = node.left
+        comparators = []
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)) \
+                    and isinstance(left, ast.Name) and left.id in addrFields:
+                trie = self.prefixTrie(right)
+                if trie is not None:
+                    name = ast.copy_location(
+                        ast.Name(id="_p%x" % id(trie), ctx=ast.Load()), right)
+                    name.trie = trie
+                    right = name
+            comparators.append(right)
+            left = right
+        node.comparators = comparators
+        return node
+
+    def prefixTrie(self, node):
+
+        if isinstance(node, ast.Str) and prefix.isCidr(node.s):
+            trie = prefix.PrefixTrie(node.s)
+            trie.addCidr(node.s)
+            return trie
+        if self.resolve and isinstance(node, ast.Call) \
+                and isinstance(node.func, ast.Name) \
+                and node.func.id == 'prefixes':
+            name = node.args[0].s
+            try:
+                return prefix.getList(name)
+            except KeyError:
+                raise RuleError("No prefix list called '%s'" % name)
+        return None
+
+
+def prefixNamespace(tree):
+    """
+    Returns a dict of the names PrefixRewriter gave the tries in
+    tree, for the namespace its compiled code runs in
+    """
+    namespace = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and hasattr(node, 'trie'):
+            namespace[node.id] = node.trie
+    return namespace
+
+
+def compileTest(expr):
+    """
+    Compiles test expression expr into a function taking a
+    connection, and returning the result of the test
+
+    Prefix lists are looked up when the test runs, since they may
+    not all have been loaded yet
+    """
+    tree = PrefixRewriter(resolve=False).visit(parseTest(expr))
+    namespace = dict(safeNames)
+    namespace.update(prefixNamespace(tree))
+    body = FieldRewriter('f').visit(tree).body
+    func = ast.Expression(body=ast.Lambda(
+        args=ast.arguments(args=[ast.Name(id='f', ctx=ast.Param())],
+                           vararg=None, kwarg=None, defaults=[]),
+        body=body))
+    ast.fix_missing_locations(func)
+    return eval(compile(func, "<test %s>" % expr, "eval"), namespace)
+
+
+def staticTest(cls):
+    """
+    Builds the syntax tree for matching a static class - the same
+    comparisons as ShaperConfigClass.matches() does in static mode
+    """
+    terms = []
+    for field in staticFields:
+        val = getattr(cls, field)
+        if val is None:
+            continue
+        if isinstance(val, basestring):
+            const = ast.Str(s=val)
+        else:
+            const = ast.Num(n=val)
+        terms.append(ast.Compare(left=ast.Name(id=field, ctx=ast.Load()),
+                                 ops=[ast.Eq()], comparators=[const]))
+    if not terms:
+        # no static attributes set - matches everything
+        return ast.Name(id='True', ctx=ast.Load())
+    if len(terms) == 1:
+        return terms[0]
+    return ast.BoolOp(op=ast.And(), values=terms)
+
+
+def dynamicTest(cls):
+    """
+    Builds the syntax tree for matching any of a dynamic class's
+    test expressions, or None if it has none
+    """
+    terms = [parseTest(expr).body for expr in cls.exprs]
+    if not terms:
+        return None
+    if len(terms) == 1:
+        return terms[0]
+    return ast.BoolOp(op=ast.Or(), values=terms)
+
+
+def isPure(node):
+
+    for sub in ast.walk(node):
+        if not isinstance(sub, pureNodes):
+            return False
+    return True
+
+
+class SubexprCounter(ast.NodeVisitor):
+    """
+    Counts how many times each pure, non-trivial subexpression appears
+    """
+
+    def __init__(self):
+
+        self.counts = {}
+        self.nodes = []
+
+    def generic_visit(self, node):
+
+        if isinstance(node, (ast.Compare, ast.BoolOp, ast.UnaryOp)) \
+                and isPure(node):
+            key = ast.dump(node)
+            if key not in self.counts:
+                self.counts[key] = 0
+                self.nodes.append((key, node))
+            self.counts[key] += 1
+        ast.NodeVisitor.generic_visit(self, node)
+
+
+class SubexprHoister(ast.NodeTransformer):
+    """
+    Replaces the outermost occurrences of shared subexpressions with
+    references to the local variables they've been hoisted into
+    """
+
+    def __init__(self, names):
+
+        self.names = names
+
+    def generic_visit(self, node):
+
+        name = self.names.get(ast.dump(node), None)
+        if name is not None:
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return ast.NodeTransformer.generic_visit(self, node)
+
+
+def classOrder(iface):
+    """
+    Returns the indexes into iface.classes, in the order they should
+    be tried - static classes take precedence, then everything else
+    in config file order
+    """
+    classes = iface.classes
+    static = [i for i in range(len(classes)) if classes[i].mode == 'static']
+    dynamic = [i for i in range(len(classes)) if classes[i].mode != 'static']
+    return static + dynamic
+
+
+def classTests(iface):
+    """
+    Returns (index, syntax tree) for the test of each of an interface's
+    classes which has one, in the order they should be tried
+    """
+    classes = iface.classes
+    tests = []
+    for i in classOrder(iface):
+        cls = classes[i]
+        if cls.mode == 'static':
+            test = staticTest(cls)
+        else:
+            test = dynamicTest(cls)
+        if test is not None:
+            tests.append((i, PrefixRewriter().visit(test)))
+    return tests
+
+
+def compileIface(iface):
+    """
+    Compiles the rules of all of an interface's classes into a
+    single callable, which takes a connection and returns the index
+    into iface.classes of the first class it matches, or -1 if it
+    should go in the default class
+
+    This is a Dispatcher if enough of the classes are matched on
+    plain equality tests, otherwise one function from compileTests()
+    """
+    tests = classTests(iface)
+    dispatcher = Dispatcher(iface.name, tests)
+    if len(dispatcher.order) - len(dispatcher.residual) >= dispatchThreshold:
+        return dispatcher
+    return compileTests(iface.name, tests)
+
+
+def compileTests(label, tests):
+    """
+    Compiles a list of (index, syntax tree) tests into one function,
+    which takes a connection and returns the index of the first test
+    it passes, or -1 if none
+
+    The generated code loads each connection attribute the rules use
+    into a local just once, evaluates pure subexpressions which crop
+    up in more than one rule just once, then tries each test in turn.
+    A rule which raises an exception (eg args[0] when there are no
+    args) counts as not matching
+    """
+    # the hoisting rewrites trees in place
+    tests = [(i, copy.deepcopy(test)) for i, test in tests]
+
+    # find subexpressions used more than once, and hoist them
+    counter = SubexprCounter()
+    for i, test in tests:
+        counter.visit(test)
+    hoisted = {}
+    hoistedNodes = []
+    for key, node in counter.nodes:
+        if counter.counts[key] > 1:
+            name = hoisted[key] = "_s%d" % len(hoistedNodes)
+            hoistedNodes.append((name, node))
+    hoister = SubexprHoister(hoisted)
+    tests = [(i, hoister.visit(test)) for i, test in tests]
+
+    # a shared subexpression might only ever appear inside a bigger
+    # one which got hoisted in its place
+    used = {}
+    for i, test in tests:
+        for node in ast.walk(test):
+            if isinstance(node, ast.Name):
+                used[node.id] = 1
+    hoistedNodes = [(name, node) for name, node in hoistedNodes
+                    if name in used]
+
+    # load each attribute the rules use into a local of the same name
+    fields = []
+    for i, test in tests:
+        for field in testFields(test):
+            if field not in fields:
+                fields.append(field)
+    for name, node in hoistedNodes:
+        for field in testFields(node):
+            if field not in fields:
+                fields.append(field)
+
+    body = []
+    for field in fields:
+        body.append(ast.Assign(
+            targets=[ast.Name(id=field, ctx=ast.Store())],
+            value=ast.Attribute(value=ast.Name(id='f', ctx=ast.Load()),
+                                attr=field, ctx=ast.Load())))
+    for name, node in hoistedNodes:
+        body.append(ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())],
+                               value=node))
+    for i, test in tests:
+        check = ast.If(test=test, body=[ast.Return(value=ast.Num(n=i))],
+                       orelse=[])
+        if isPure(test):
+            body.append(check)
+        else:
+            body.append(ast.TryExcept(
+                body=[check],
+                handlers=[ast.ExceptHandler(
+                    type=ast.Name(id='Exception', ctx=ast.Load()),
+                    name=None, body=[ast.Pass()])],
+                orelse=[]))
+    body.append(ast.Return(value=ast.Num(n=-1)))
+
+    func = ast.FunctionDef(
+        name='classify',
+        args=ast.arguments(args=[ast.Name(id='f', ctx=ast.Param())],
+                           vararg=None, kwarg=None, defaults=[]),
+        body=body, decorator_list=[])
+    module = ast.Module(body=[func])
+    ast.fix_missing_locations(module)
+
+    namespace = dict(safeNames)
+    namespace['Exception'] = Exception
+    namespace.update(prefixNamespace(module))
+    exec compile(module, "<rules %s>" % label, "exec") in namespace
+    return namespace['classify']
+
+
+def constValue(node):
+    """
+    Returns (True, value) if node is a string or number literal,
+    otherwise (False, None)
+    """
+    if isinstance(node, ast.Str):
+        return True, node.s
+    if isinstance(node, ast.Num):
+        return True, node.n
+    return False, None
+
+
+def termKeys(node):
+    """
+    Returns a list of (field, value) pairs, one of which a connection
+    must have for it to pass test node, or None if there's no such list
+
+    Finds 'field == const', 'const == field' and 'field in (const, ...)',
+    either on their own or as one of the terms of an 'and'
+    """
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        for value in node.values:
+            keys = termKeys(value)
+            if keys is not None:
+                return keys
+        return None
+
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    op = node.ops[0]
+    left, right = node.left, node.comparators[0]
+
+    if isinstance(op, ast.Eq):
+        if isinstance(right, ast.Name):
+            left, right = right, left
+        if isinstance(left, ast.Name) and left.id in indexFields:
+            isConst, value = constValue(right)
+            if isConst:
+                return [(left.id, value)]
+
+    elif isinstance(op, ast.In):
+        if isinstance(left, ast.Name) and left.id in indexFields \
+                and isinstance(right, (ast.Tuple, ast.List)):
+            keys = []
+            for elt in right.elts:
+                isConst, value = constValue(elt)
+                if not isConst:
+                    return None
+                keys.append((left.id, value))
+            return keys
+
+    return None
+
+
+def testKeys(node):
+    """
+    Like termKeys, but also handles an 'or' of tests - the connection
+    must have one of the keys of any one of its terms
+
+    Returns (keys, exact), where exact is True if having any of the
+    keys is enough on its own for the connection to pass the test
+    """
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
+        terms = node.values
+    else:
+        terms = [node]
+
+    keys = []
+    exact = True
+    for term in terms:
+        termkeys = termKeys(term)
+        if termkeys is None:
+            return None, False
+        keys.extend(termkeys)
+        if isinstance(term, ast.BoolOp):
+            exact = False
+    return keys, exact
+
+
+class Dispatcher:
+    """
+    Classifies connections via per-attribute hash tables, which map
+    attribute values to the classes whose tests could possibly match
+    them, so each connection only gets its full test run against a
+    handful of candidate classes instead of every class
+
+    Classes whose tests aren't simple enough to index (see testKeys)
+    are candidates for every connection. Candidates are tried in the
+    same order the classes would be tried in anyway, so the first
+    match is the same as from compileTests(). Classes whose tests are
+    nothing but equality tests are known to match as soon as they're
+    found in the index, and nothing after them needs trying
+    """
+
+    def __init__(self, label, tests):
+
+        # (class index, full test function) in the order to try them
+        self.order = []
+
+        # positions of the classes which can't be indexed
+        self.residual = []
+
+        # field -> {value -> [positions in self.order]}
+        index = {}
+        exacts = {}
+
+        for pos in range(len(tests)):
+            i, test = tests[pos]
+            self.order.append((i, compileTests("%s:%s" % (label, i),
+                                               [(i, test)])))
+            keys, exact = testKeys(test)
+            if keys is None:
+                self.residual.append(pos)
+                continue
+            if exact:
+                exacts[pos] = 1
+            for field, value in keys:
+                positions = index.setdefault(field, {}).setdefault(value, [])
+                if not positions or positions[-1] != pos:
+                    positions.append(pos)
+
+        # field -> {value -> (positions to check, position of the first
+        # class which matches outright)}, with positions after that one
+        # dropped
+        self.none = len(self.order)
+        self.index = {}
+        for field, table in index.items():
+            entries = self.index[field] = {}
+            for value, positions in table.items():
+                checks = []
+                bound = self.none
+                for pos in positions:
+                    if pos in exacts:
+                        bound = pos
+                        break
+                    checks.append(pos)
+                entries[value] = (checks, bound)
+
+        self.fields = self.index.items()
+
+    def __call__(self, f):
+
+        bound = self.none
+        cands = self.residual
+        merged = False
+        for field, table in self.fields:
+            entry = table.get(getattr(f, field), None)
+            if entry is not None:
+                checks, exact = entry
+                if exact < bound:
+                    bound = exact
+                if checks:
+                    if cands:
+                        cands = cands + checks
+                        merged = True
+                    else:
+                        cands = checks
+        if merged:
+            cands.sort()
+
+        order = self.order
+        last = -1
+        for pos in cands:
+            if pos >= bound:
+                break
+            if pos == last:
+                continue
+            last = pos
+            i, check = order[pos]
+            if check(f) >= 0:
+                return i
+
+        if bound < self.none:
+            return order[bound][0]
+        return -1
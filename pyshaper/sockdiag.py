@@ -0,0 +1,303 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Enumerates TCP sockets in bulk via the kernel's netlink sock_diag
+interface - one SOCK_DIAG_BY_FAMILY dump request, with the binary
+inet_diag_msg replies decoded directly, rather than having the kernel
+format a text table for us to pick apart again
+"""
+
+import os
+import socket
+import struct
+
+from pyshaper import procfs
+
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x001
+NLM_F_DUMP = 0x300
+
+# every state except LISTEN, which is what netstat shows without '-a'
+allStates = 0xffe & ~(1 << procfs.TCP_LISTEN)
+
+# struct nlmsghdr: len, type, flags, seq, pid
+nlmsghdr = struct.Struct("=LHHLL")
+
+# struct inet_diag_req_v2 minus its sockid: family, protocol, ext, pad, states
+inetDiagReq = struct.Struct("=BBBBL")
+
+# struct inet_diag_sockid: ports are big-endian, addresses raw network
+# order, then interface index and a 2-word cookie in host order
+inetDiagSockid = struct.Struct("!HH16s16s")
+inetDiagSockidTail = struct.Struct("=LLL")
+
+# struct inet_diag_msg: family, state, timer, retrans, sockid,
+# then expires, rqueue, wqueue, uid, inode
+inetDiagMsgHead = struct.Struct("=BBBB")
+inetDiagMsgTail = struct.Struct("=LLLLL")
+
+sockidLen = inetDiagSockid.size + inetDiagSockidTail.size
+
+# an IPv4 address, as an int
+addrStruct = struct.Struct("!L")
+
+
+def nlmsgAlign(n):
+    return (n + 3) & ~3
+
+
+class SockDiagError(Exception):
+    pass
+
+
+class SockDiag:
+    """
+    Dumps the kernel's TCP sockets over a NETLINK_SOCK_DIAG socket
+
+    The netlink socket is opened on first use and kept open, so one
+    of these can be reused across scans. Pass in 'sock' to use
+    something other than a real netlink socket (see FakeNetlinkSocket)
+    """
+
+    bufsize = 65536
+
+    def __init__(self, sock=None):
+
+        self.sock = sock
+        self.seq = 0
+
+    def open(self):
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_SOCK_DIAG)
+        sock.bind((0, 0))
+        self.sock = sock
+
+    def close(self):
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, family=socket.AF_INET, protocol=socket.IPPROTO_TCP,
+                states=allStates):
+        """
+        Builds a SOCK_DIAG_BY_FAMILY dump request message
+        """
+        self.seq += 1
+        body = inetDiagReq.pack(family, protocol, 0, 0, states) \
+            + inetDiagSockid.pack(0, 0, "\0" * 16, "\0" * 16) \
+            + inetDiagSockidTail.pack(0, 0, 0)
+        hdr = nlmsghdr.pack(nlmsghdr.size + len(body), SOCK_DIAG_BY_FAMILY,
+                            NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        return hdr + body
+
+    def dump(self, family=socket.AF_INET, states=allStates):
+        """
+        Generator which sends one dump request, and yields
+        (laddr, lport, raddr, rport, state, uid, inode) for each
+        socket in the kernel's replies, with addresses as ints
+        """
+        if self.sock is None:
+            self.open()
+
+        try:
+            self.sock.send(self.request(family, socket.IPPROTO_TCP, states))
+        except:
+            # don't keep a broken socket around for the next scan
+            self.close()
+            raise
+        seq = self.seq
+
+        while 1:
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                raise SockDiagError("netlink socket closed mid-dump")
+            for msgtype, msgseq, payload in parseMessages(data):
+                if msgseq != seq:
+                    # leftovers from an abandoned earlier dump
+                    continue
+                if msgtype == NLMSG_DONE:
+                    return
+                if msgtype == NLMSG_ERROR:
+                    errno = -struct.unpack("=l", payload[:4])[0]
+                    if errno:
+                        raise SockDiagError("sock_diag dump failed: %s" %
+                                            os.strerror(errno))
+                    continue
+                if msgtype == SOCK_DIAG_BY_FAMILY:
+                    yield decodeDiagMsg(payload)
+
+
+def parseMessages(data):
+    """
+    Splits a netlink datagram into (type, seq, payload) tuples
+    """
+    offset = 0
+    datalen = len(data)
+    while offset + nlmsghdr.size <= datalen:
+        msglen, msgtype, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+        if msglen < nlmsghdr.size:
+            break
+        yield msgtype, seq, data[offset + nlmsghdr.size:offset + msglen]
+        offset += nlmsgAlign(msglen)
+
+
+def decodeDiagMsg(payload):
+    """
+    Decodes one inet_diag_msg into a
+    (laddr, lport, raddr, rport, state, uid, inode) tuple,
+    with addresses as ints
+    """
+    family, state, timer, retrans = inetDiagMsgHead.unpack_from(payload, 0)
+    sport, dport, src, dst = inetDiagSockid.unpack_from(
+        payload, inetDiagMsgHead.size)
+    expires, rqueue, wqueue, uid, inode = inetDiagMsgTail.unpack_from(
+        payload, inetDiagMsgHead.size + sockidLen)
+    return (addrStruct.unpack(src[:4])[0], sport,
+            addrStruct.unpack(dst[:4])[0], dport,
+            state, uid, inode)
+
+
+def encodeDiagMsg(laddr, lport, raddr, rport, state, uid, inode, seq=0):
+    """
+    The reverse of decodeDiagMsg - builds a complete netlink message
+    holding an inet_diag_msg, as the kernel would send it
+    """
+    body = inetDiagMsgHead.pack(socket.AF_INET, state, 0, 0) \
+        + inetDiagSockid.pack(lport, rport,
+                              addrStruct.pack(laddr) + "\0" * 12,
+                              addrStruct.pack(raddr) + "\0" * 12) \
+        + inetDiagSockidTail.pack(0, 0, 0) \
+        + inetDiagMsgTail.pack(0, 0, 0, uid, inode)
+    return nlmsghdr.pack(nlmsghdr.size + len(body), SOCK_DIAG_BY_FAMILY,
+                         0x2, seq, 0) + body
+
+
+def encodeDone(seq=0):
+    """
+    Builds the NLMSG_DONE message which terminates a dump
+    """
+    return nlmsghdr.pack(nlmsghdr.size + 4, NLMSG_DONE, 0x2, seq, 0) \
+        + struct.pack("=l", 0)
+
+
+class RecordingSocket:
+    """
+    Wraps a real netlink socket, keeping a copy of every datagram
+    the kernel sends back, so they can be replayed later with
+    FakeNetlinkSocket (eg, in tests, which then won't need root or
+    even Linux)
+    """
+
+    def __init__(self, sock):
+
+        self.sock = sock
+        self.replies = []
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, bufsize):
+        data = self.sock.recv(bufsize)
+        self.replies.append(data)
+        return data
+
+    def close(self):
+        self.sock.close()
+
+    def save(self, path):
+        """
+        Writes the recorded replies out to path, one hex-encoded
+        datagram per line
+        """
+        f = file(path, "w")
+        for data in self.replies:
+            f.write(data.encode("hex") + "\n")
+        f.close()
+
+
+class FakeNetlinkSocket:
+    """
+    Stands in for a NETLINK_SOCK_DIAG socket, answering each request
+    with a set of recorded reply datagrams
+
+    The sequence numbers in the replies are rewritten to match the
+    last request sent, so recordings can be replayed any number of
+    times. Requests sent are kept in self.requests
+    """
+
+    def __init__(self, replies):
+
+        self.replies = list(replies)
+        self.requests = []
+        self.pending = []
+
+    @classmethod
+    def load(cls, path):
+        """
+        Creates a fake socket from a file written by RecordingSocket.save
+        """
+        replies = [line.strip().decode("hex") for line in file(path)
+                   if line.strip()]
+        return cls(replies)
+
+    @classmethod
+    def fromRows(cls, rows):
+        """
+        Creates a fake socket whose dump reply holds the sockets given
+        as (laddr, lport, raddr, rport, state, uid, inode) tuples, in
+        the same form as SockDiag.dump() yields them
+        """
+        data = "".join([encodeDiagMsg(*row) for row in rows])
+        return cls([data, encodeDone()])
+
+    def send(self, data):
+
+        self.requests.append(data)
+        seq = nlmsghdr.unpack_from(data, 0)[3]
+        self.pending = [self.reseq(reply, seq) for reply in self.replies]
+        return len(data)
+
+    def recv(self, bufsize):
+
+        if not self.pending:
+            return ""
+        return self.pending.pop(0)
+
+    def close(self):
+        pass
+
+    def reseq(self, data, seq):
+        """
+        Rewrites the sequence number of every message in datagram data
+        """
+        data = list(data)
+        offset = 0
+        while offset + nlmsghdr.size <= len(data):
+            hdr = "".join(data[offset:offset + nlmsghdr.size])
+            msglen, msgtype, flags, oldseq, pid = nlmsghdr.unpack(hdr)
+            if msglen < nlmsghdr.size:
+                break
+            data[offset:offset + nlmsghdr.size] = list(
+                nlmsghdr.pack(msglen, msgtype, flags, seq, pid))
+            offset += nlmsgAlign(msglen)
+        return "".join(data)
@@ -0,0 +1,86 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Runs tc commands through a single 'tc -force -batch -' process, rather
+than a shell forking off one tc per command
+
+With -force, tc carries on past commands which fail, printing their
+error messages followed by 'Command failed -:<line>', which lets us
+work out which commands failed and why
+"""
+
+import re
+import subprocess
+
+# the tc binary
+tcPath = "tc"
+
+reFailed = re.compile(r"^Command failed -:(\d+)\s*$")
+
+
+def runBatch(cmds):
+    """
+    Runs cmds, a list of tc commands minus the leading 'tc'
+
+    Returns a list of (index, message) tuples for the commands which
+    failed, where index is the command's position in cmds - or None
+    if tc went wrong in a way we can't pin on any one command
+    """
+    if not cmds:
+        return []
+
+    script = "".join([cmd + "\n" for cmd in cmds])
+    try:
+        proc = subprocess.Popen([tcPath, "-force", "-batch", "-"],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                close_fds=True)
+        out = proc.communicate(script)[0]
+    except OSError, e:
+        return [(None, "can't run %s: %s" % (tcPath, e))]
+
+    return parseOutput(len(cmds), out, proc.returncode)
+
+
+def parseOutput(ncmds, out, status):
+    """
+    Picks the failures out of the output of a tc batch run of ncmds
+    commands, which exited with status - see runBatch
+    """
+    failed = []
+    msg = []
+    for line in out.splitlines():
+        m = reFailed.match(line)
+        if m:
+            index = int(m.group(1)) - 1
+            if 0 <= index < ncmds:
+                failed.append((index, " ".join(msg) or "failed"))
+            else:
+                failed.append((None, " ".join(msg) or line))
+            msg = []
+        elif line.startswith("Warning:"):
+            # these come from commands which worked
+            continue
+        elif line.strip():
+            msg.append(line.strip())
+
+    # anything left over is only a failure if tc says so - otherwise
+    # it's just warnings
+    if status and not failed:
+        failed.append((None, " ".join(msg) or "%s exited with status %s" % (
+            tcPath, status)))
+
+    return failed
@@ -0,0 +1,804 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+In-memory model of the qdiscs, classes and filters we want on each
+device, so that each shaping run only has to issue the tc commands
+which turn the last run's setup into this one's
+
+Filters live in u32 hash tables of our own for each parent and prio,
+linked from the table u32 creates itself. This means every filter has
+a handle we chose, and can be deleted on its own
+
+Filters on a single remote address - which is all the per-connection
+ones - go in a table with 256 buckets, hashed on the low byte of that
+address, so the kernel only has to try the filters in one bucket for
+each packet, however many connections we're shaping. The rest go in a
+plain table, which gets tried after the hashed one
+
+Filters of other kinds - like the fw filters which go with the 'mark'
+classifier, and the flower filters the 'flower' one uses for each
+connection - sit at prios of their own, from 0x300 up
+
+A device can instead be set up to be rebuilt make-before-break. Its
+root is then a prio qdisc with two bands, each with room for an htb
+tree of its own (majors 2: and 3:), and a u32 filter on the root - the
+selector - sending everything to one of them. When the device has to
+be rebuilt, the new tree gets built in the idle band while the old one
+carries on shaping, and only once all of it is in place does the
+selector get switched over to it. Ingress filters can't be kept apart
+like that, so the second tree's sit 0x100 prios further down, behind
+the first's, and the old ones get deleted after the switch. The old
+egress tree gets left to drain, until the next rebuild clears it out
+"""
+
+import re
+
+from collections import OrderedDict
+
+
+# make-before-break setup - the band and htb major of each tree, and
+# how far its ingress filters' prios get moved
+swapBands = ["1:1", "1:2"]
+swapMajors = [2, 3]
+ingressOffsets = [0, 0x100]
+
+# class prios double as u32 filter prios, so have to stay below 0x300
+# with whichever tree's ingress offset added
+maxFilterPrio = 0x300 - max(ingressOffsets)
+swapRoot = "root handle 1: prio bands 2 priomap %s" % " ".join(["0"] * 16)
+
+# where an empty u32 filter goes, for deleting u32 tables left behind
+anchorPrio = 0xfffe
+
+
+class TcModelError(Exception):
+    pass
+
+
+class Qdisc:
+    """
+    A qdisc - 'text' is everything after 'tc qdisc add dev <dev>',
+    eg 'parent 1:101 handle 101: sfq perturb 10'
+    """
+
+    def __init__(self, dev, text):
+
+        self.dev = dev
+        self.text = text
+
+        words = text.split()
+        if words[0] == 'parent':
+            self.parent = words[1]
+        else:
+            # 'root' or 'ingress'
+            self.parent = words[0]
+
+        self.key = ('qdisc', self.parent)
+
+    def add(self):
+        return "qdisc add dev %s %s" % (self.dev, self.text)
+
+    def change(self):
+        return "qdisc replace dev %s %s" % (self.dev, self.text)
+
+    def delete(self):
+        if self.parent in ('root', 'ingress'):
+            return "qdisc del dev %s %s" % (self.dev, self.parent)
+        return "qdisc del dev %s parent %s" % (self.dev, self.parent)
+
+
+class TcClass:
+    """
+    A class - 'text' is everything after 'tc class add dev <dev>',
+    eg 'parent 1:1 classid 1:101 htb rate 65536 burst 6k prio 1'
+    """
+
+    def __init__(self, dev, text):
+
+        self.dev = dev
+        self.text = text
+
+        words = text.split()
+        self.classid = words[words.index('classid') + 1]
+
+        self.key = ('class', self.classid)
+
+    def add(self):
+        return "class add dev %s %s" % (self.dev, self.text)
+
+    def change(self):
+        return "class change dev %s %s" % (self.dev, self.text)
+
+    def delete(self):
+        return "class del dev %s classid %s" % (self.dev, self.classid)
+
+
+class FilterTable:
+    """
+    The u32 hash tables holding all our filters for one parent and
+    prio, and the filters in u32's own root table which link to them
+
+    hashOn is 'src' or 'dst' - the address field to hash filters on -
+    or None to put them all in the plain table
+    """
+
+    divisor = 256
+
+    # where the addresses are in the IP header
+    hashOffsets = {'src': 12, 'dst': 16}
+
+    def __init__(self, dev, parent, prio, hashOn=None):
+
+        self.dev = dev
+        self.parent = parent
+        self.prio = prio
+        self.hashOn = hashOn
+        if not 0 <= prio < 0x300:
+            raise TcModelError("Filter prio %s out of range" % prio)
+
+        # keep clear of the ids u32 gives its own tables, from 800:
+        self.htid = 0x100 + prio
+        self.hashHtid = 0x400 + prio
+
+        if hashOn is not None:
+            self.reHashAddr = re.compile(
+                r"match ip %s \d+\.\d+\.\d+\.(\d+)(/32)?(\s|$)" % hashOn)
+
+        self.key = (parent, prio)
+
+    def prefix(self):
+        return "dev %s parent %s protocol ip prio %s" % (
+            self.dev, self.parent, self.prio)
+
+    def htids(self):
+        if self.hashOn is not None:
+            return [self.hashHtid, self.htid]
+        return [self.htid]
+
+    def place(self, filt):
+        """
+        Works out which table and bucket filter filt goes in
+        """
+        if self.hashOn is not None:
+            m = self.reHashAddr.search(filt.selector)
+            if m:
+                filt.htid = self.hashHtid
+                filt.bucket = int(m.group(1)) % self.divisor
+                return
+        filt.htid = self.htid
+        filt.bucket = 0
+
+    def add(self):
+        """
+        Returns the commands to create the tables and their links
+        """
+        cmds = []
+        if self.hashOn is not None:
+            cmds.append("filter add %s handle %x: u32 divisor %d" % (
+                self.prefix(), self.hashHtid, self.divisor))
+        cmds.append("filter add %s handle %x: u32 divisor 1" % (
+            self.prefix(), self.htid))
+        if self.hashOn is not None:
+            cmds.append(
+                "filter add %s u32 match u32 0 0 "
+                "hashkey mask 0x%08x at %d link %x:" % (
+                    self.prefix(), self.divisor - 1,
+                    self.hashOffsets[self.hashOn], self.hashHtid))
+        cmds.append("filter add %s u32 match u32 0 0 link %x:" % (
+            self.prefix(), self.htid))
+        return cmds
+
+    def delete(self):
+        """
+        Deletes the tables and every filter in them
+        """
+        return "filter del %s" % self.prefix()
+
+
+class Filter:
+    """
+    A u32 filter - matching on 'selector' (the 'match ...' clauses),
+    and doing 'action' (eg 'flowid 1:101', or a police action)
+
+    Filters are identified by their parent, prio and selector. Their
+    table and bucket get filled in by FilterTable.place, and their node
+    only when the model gets applied
+    """
+
+    maxNode = 0xfff
+
+    def __init__(self, dev, parent, prio, selector, action):
+
+        self.dev = dev
+        self.parent = parent
+        self.prio = prio
+        self.selector = selector
+        self.action = action
+        self.htid = None
+        self.bucket = 0
+        self.node = None
+
+        self.key = (parent, prio, selector)
+
+    def handle(self, table):
+        return "%x:%x:%x" % (self.htid, self.bucket, self.node)
+
+    def add(self, table):
+        return "filter add %s handle %s u32 ht %x:%x: %s %s" % (
+            table.prefix(), self.handle(table), self.htid, self.bucket,
+            self.selector, self.action)
+
+    def change(self, table):
+        return "filter replace %s handle %s u32 ht %x:%x: %s %s" % (
+            table.prefix(), self.handle(table), self.htid, self.bucket,
+            self.selector, self.action)
+
+    def delete(self, table):
+        return "filter del %s handle %s u32" % (
+            table.prefix(), self.handle(table))
+
+
+class FlowerFilter:
+    """
+    A flower filter - matching on 'selector' (eg 'ip_proto tcp src_ip
+    10.0.0.1 src_port 80'), and doing 'action'
+
+    Like u32 Filters, these are identified by their parent, prio and
+    selector, and only get their handle when the model gets applied
+    """
+
+    maxHandle = 0xffffffffL
+
+    def __init__(self, dev, parent, prio, selector, action):
+
+        if not 0x300 <= prio < 0x10000:
+            raise TcModelError("Filter prio %s out of range" % prio)
+
+        self.dev = dev
+        self.parent = parent
+        self.prio = prio
+        self.selector = selector
+        self.action = action
+        self.handle = None
+
+        self.key = (parent, prio, selector)
+
+    def prefix(self):
+        return "dev %s parent %s protocol ip prio %s" % (
+            self.dev, self.parent, self.prio)
+
+    def add(self):
+        return "filter add %s handle 0x%x flower %s %s" % (
+            self.prefix(), self.handle, self.selector, self.action)
+
+    def change(self):
+        return "filter replace %s handle 0x%x flower %s %s" % (
+            self.prefix(), self.handle, self.selector, self.action)
+
+    def delete(self):
+        return "filter del %s handle 0x%x flower" % (
+            self.prefix(), self.handle)
+
+
+class KindFilter:
+    """
+    A filter of some other kind than u32 - 'kind' is eg 'fw', and
+    'text' is everything after it, eg 'flowid 1:101'. 'handle' is
+    whatever the kind takes as a handle, or None, for a filter which
+    has its prio to itself
+
+    These are identified by their parent, prio and handle, and their
+    prios are from 0x300 up, clear of the ones our u32 tables use
+    """
+
+    def __init__(self, dev, parent, prio, kind, handle, text):
+
+        if not 0x300 <= prio < 0x10000:
+            raise TcModelError("Filter prio %s out of range" % prio)
+
+        self.dev = dev
+        self.parent = parent
+        self.prio = prio
+        self.kind = kind
+        self.handle = handle
+        self.text = text
+
+        self.key = (parent, prio, handle)
+
+    def prefix(self):
+        return "dev %s parent %s protocol ip prio %s" % (
+            self.dev, self.parent, self.prio)
+
+    def add(self):
+        if self.handle is None:
+            return ["filter add %s %s %s" % (
+                self.prefix(), self.kind, self.text)]
+        return ["filter add %s handle %s %s %s" % (
+            self.prefix(), self.handle, self.kind, self.text)]
+
+    def change(self):
+        if self.handle is None:
+            # nothing to say which filter to replace
+            return [self.delete()] + self.add()
+        return ["filter replace %s handle %s %s %s" % (
+            self.prefix(), self.handle, self.kind, self.text)]
+
+    def delete(self):
+        if self.handle is None:
+            return "filter del %s" % self.prefix()
+        return "filter del %s handle %s %s" % (
+            self.prefix(), self.handle, self.kind)
+
+
+class DevModel:
+    """
+    Everything we want on one device
+    """
+
+    def __init__(self, dev):
+
+        self.dev = dev
+
+        # which tree (0 or 1) we're using, when rebuilding
+        # make-before-break, or None
+        self.gen = None
+
+        # set when applying the model failed part way, so we don't
+        # know quite what's on the device
+        self.broken = False
+
+        # qdiscs and classes, parents before children
+        self.objects = OrderedDict()
+
+        # (parent, prio) -> FilterTable
+        self.tables = OrderedDict()
+
+        # (parent, prio, selector) -> Filter
+        self.filters = OrderedDict()
+
+        # (parent, prio, selector) -> FlowerFilter
+        self.flowerFilters = OrderedDict()
+
+        # (parent, prio, handle) -> KindFilter
+        self.kindFilters = OrderedDict()
+
+        # commands which put right things on the device that aren't in
+        # the model, found by tcstate - run before anything else
+        self.repairs = []
+
+    def add(self, obj):
+
+        if obj.key in self.objects:
+            raise TcModelError("%s: duplicate %s %s" % (
+                self.dev, obj.key[0], obj.key[1]))
+        self.objects[obj.key] = obj
+
+    def ingressPrio(self, parent, prio):
+        """
+        Returns where a filter at prio on parent goes, given which
+        tree we're using
+        """
+        if parent == 'ffff:' and self.gen is not None:
+            return prio + ingressOffsets[self.gen]
+        return prio
+
+    def ingressPrios(self):
+        """
+        Returns the prios of all our ingress filters
+        """
+        prios = {}
+        for filters in [self.tables, self.flowerFilters, self.kindFilters]:
+            for key in filters:
+                if key[0] == 'ffff:':
+                    prios[key[1]] = 1
+        prios = prios.keys()
+        prios.sort()
+        return prios
+
+    def addFilter(self, filt, hashOn=None):
+
+        key = (filt.parent, filt.prio)
+        if key not in self.tables:
+            self.tables[key] = FilterTable(self.dev, filt.parent, filt.prio,
+                                           hashOn)
+        self.tables[key].place(filt)
+        # a duplicate replaces the earlier one, same as tc would have it
+        self.filters[filt.key] = filt
+
+    def addFlowerFilter(self, filt):
+        self.flowerFilters[filt.key] = filt
+
+    def addKindFilter(self, filt):
+        self.kindFilters[filt.key] = filt
+
+    def roots(self):
+        """
+        Returns the text of the root and ingress qdiscs - if either
+        changes, the whole device has to be rebuilt
+        """
+        return [self.objects[key].text
+                for key in [('qdisc', 'root'), ('qdisc', 'ingress')]
+                if key in self.objects]
+
+    def swapsFrom(self, odev):
+        """
+        Returns True if we get to replace odev make-before-break
+        """
+        return odev is not None and odev.gen is not None \
+            and self.gen is not None and odev.gen != self.gen \
+            and odev.roots()[:1] == self.roots()[:1]
+
+    def selector(self, verb):
+        """
+        Returns the command which points the selector at our tree
+        """
+        return "filter %s dev %s parent 1: protocol all prio 1 " \
+            "handle 800::800 u32 match u32 0 0 flowid %s" % (
+                verb, self.dev, swapBands[self.gen])
+
+    def clearCmds(self):
+        """
+        Returns the commands which clear out our tree's band and
+        ingress prios, in case anything of an earlier tree is left
+        there - all quiet
+        """
+        cmds = [("qdisc del dev %s parent %s" % (
+            self.dev, swapBands[self.gen]), True)]
+        for prio in self.ingressPrios():
+            cmds.append(("filter del dev %s parent ffff: protocol ip prio %s" % (
+                self.dev, prio), True))
+        cmds.extend(orphanCmds(self.dev, [
+            table for key, table in self.tables.items() if key[0] == 'ffff:']))
+        return cmds
+
+
+class TcModel:
+    """
+    The qdiscs, classes and filters wanted on every device
+    """
+
+    def __init__(self):
+
+        self.devs = OrderedDict()
+
+    def dev(self, dev):
+
+        try:
+            return self.devs[dev]
+        except KeyError:
+            model = self.devs[dev] = DevModel(dev)
+            return model
+
+    def setGen(self, dev, gen):
+        """
+        Says which tree device dev uses - see nextGen. This has to be
+        done before adding anything to it
+        """
+        self.dev(dev).gen = gen
+
+    def addQdisc(self, dev, text):
+        self.dev(dev).add(Qdisc(dev, text))
+
+    def addClass(self, dev, text):
+        self.dev(dev).add(TcClass(dev, text))
+
+    def addFilter(self, dev, parent, prio, selector, action, hashOn=None):
+        if not 0 <= prio < maxFilterPrio:
+            raise TcModelError("Filter prio %s out of range" % prio)
+        model = self.dev(dev)
+        prio = model.ingressPrio(parent, prio)
+        model.addFilter(Filter(dev, parent, prio, selector, action), hashOn)
+
+    def addFlowerFilter(self, dev, parent, prio, selector, action):
+        model = self.dev(dev)
+        prio = model.ingressPrio(parent, prio)
+        model.addFlowerFilter(FlowerFilter(dev, parent, prio, selector, action))
+
+    def addKindFilter(self, dev, parent, prio, kind, handle, text):
+        model = self.dev(dev)
+        prio = model.ingressPrio(parent, prio)
+        model.addKindFilter(KindFilter(dev, parent, prio, kind, handle, text))
+
+    def diff(self, old):
+        """
+        Returns the tc commands (minus the leading 'tc') which turn
+        the setup in model old into this one, as a list of
+        (command, quiet) tuples - quiet commands are ones which are
+        allowed to fail
+
+        old may be None, when we don't know what's there, in which case
+        every device gets cleared out and built from scratch, as do
+        devices whose model in old is broken. Filters we already have
+        keep their handles from old, and new ones get given free handles
+
+        Devices being rebuilt make-before-break only get their new tree
+        built here - switching over to it is left to swapCmds
+        """
+        cmds = []
+
+        if old is None:
+            oldDevs = {}
+        else:
+            oldDevs = old.devs
+
+        # devices we're no longer shaping
+        for dev, odev in oldDevs.items():
+            if dev not in self.devs:
+                for key in [('qdisc', 'root'), ('qdisc', 'ingress')]:
+                    if key in odev.objects:
+                        cmds.append((odev.objects[key].delete(), False))
+
+        for dev, ndev in self.devs.items():
+            odev = oldDevs.get(dev, None)
+            if ndev.swapsFrom(odev):
+                # build the new tree next to the old one, which is
+                # left running - only the root and ingress qdiscs stay
+                cmds.extend(ndev.clearCmds())
+                base = DevModel(dev)
+                for key in [('qdisc', 'root'), ('qdisc', 'ingress')]:
+                    if key in odev.objects:
+                        base.add(odev.objects[key])
+                cmds.extend([(cmd, False) for cmd in devDiff(base, ndev)])
+            elif odev is None or odev.broken or odev.gen != ndev.gen \
+                    or odev.roots() != ndev.roots():
+                # start from a clean slate
+                cmds.append(("qdisc del dev %s root" % dev, True))
+                cmds.append(("qdisc del dev %s ingress" % dev, True))
+                cmds.extend([(cmd, False)
+                             for cmd in devDiff(DevModel(dev), ndev)])
+                if ndev.gen is not None:
+                    cmds.append((ndev.selector("add"), False))
+            else:
+                cmds.extend([(cmd, False) for cmd in odev.repairs])
+                cmds.extend(orphanCmds(dev, [
+                    table for key, table in ndev.tables.items()
+                    if key not in odev.tables]))
+                cmds.extend([(cmd, False) for cmd in devDiff(odev, ndev)])
+
+        return cmds
+
+    def swapCmds(self, old):
+        """
+        Returns what switches devices being rebuilt make-before-break
+        over to their new trees, once diff's commands have all worked,
+        as a list of (dev, selector, retire) - selector is the command
+        pointing the device's selector at the new tree, to be run on its
+        own, and retire the commands which get rid of the old tree's
+        ingress filters, which are only to be run once selector has
+        worked. Everything is a (command, quiet) tuple
+        """
+        if old is None:
+            return []
+        swaps = []
+        for dev, ndev in self.devs.items():
+            odev = old.devs.get(dev, None)
+            if not ndev.swapsFrom(odev):
+                continue
+            retire = []
+            if ('qdisc', 'ingress') not in ndev.objects:
+                if ('qdisc', 'ingress') in odev.objects:
+                    retire.append(("qdisc del dev %s ingress" % dev, True))
+            else:
+                for prio in odev.ingressPrios():
+                    retire.append((
+                        "filter del dev %s parent ffff: protocol ip prio %s" % (
+                            dev, prio), True))
+            swaps.append((dev, (ndev.selector("replace"), False), retire))
+        return swaps
+
+    def abandonCmds(self, old, devs=None):
+        """
+        Returns the commands which get rid of what there is of the new
+        trees of devices being rebuilt make-before-break, when they
+        can't be switched over to - just those of devs, if given
+        """
+        if old is None:
+            return []
+        cmds = []
+        for dev, ndev in self.devs.items():
+            if devs is not None and dev not in devs:
+                continue
+            if ndev.swapsFrom(old.devs.get(dev, None)):
+                cmds.extend(ndev.clearCmds())
+        return cmds
+
+    def failed(self, old, swapped):
+        """
+        Returns the model to go on from when applying this one failed -
+        swapped is None if diff's commands didn't all work, and
+        otherwise lists the devices whose selectors got switched over
+        to their new trees
+
+        Devices still on their old tree keep old's model of it - their
+        selectors still point there, so it has to be left alone. If
+        diff's commands didn't all work, the rest get marked as broken
+        """
+        if old is None:
+            oldDevs = {}
+        else:
+            oldDevs = old.devs
+
+        model = TcModel()
+        for dev, ndev in self.devs.items():
+            odev = oldDevs.get(dev, None)
+            if ndev.swapsFrom(odev) and (swapped is None or dev not in swapped):
+                model.devs[dev] = odev
+            else:
+                if swapped is None:
+                    ndev.broken = True
+                model.devs[dev] = ndev
+        return model
+
+
+def nextGen(old, dev):
+    """
+    Returns which tree device dev should use when rebuilding it
+    make-before-break, given the setup in model old - the one it's
+    already using, unless it's broken, when it gets the other one
+    """
+    odev = old is not None and old.devs.get(dev, None) or None
+    if odev is None or odev.gen is None:
+        return 0
+    if odev.broken:
+        return 1 - odev.gen
+    return odev.gen
+
+
+def orphanCmds(dev, tables):
+    """
+    Returns the commands which get rid of any u32 hash tables of
+    tables left over from before - all quiet
+
+    u32's hash tables belong to the qdisc, rather than the prio they
+    were made at, so deleting a prio while the qdisc has other u32
+    filters leaves its tables behind, and stops them being made again.
+    They can still be deleted through any u32 filter on the qdisc, so
+    an empty one gets put at anchorPrio to do it with
+    """
+    parents = []
+    for table in tables:
+        if table.parent not in parents:
+            parents.append(table.parent)
+
+    cmds = []
+    for parent in parents:
+        prefix = "dev %s parent %s protocol ip prio %s" % (
+            dev, parent, anchorPrio)
+        cmds.append(("filter add %s u32" % prefix, True))
+        for table in tables:
+            if table.parent == parent:
+                for htid in table.htids():
+                    cmds.append(("filter del %s handle %x: u32" % (
+                        prefix, htid), True))
+        cmds.append(("filter del %s" % prefix, True))
+    return cmds
+
+
+def devDiff(odev, ndev):
+    """
+    Returns the commands to turn device model odev into ndev
+    """
+    cmds = []
+
+    # tables we can keep
+    kept = {}
+    for key, table in odev.tables.items():
+        if key in ndev.tables and ndev.tables[key].hashOn == table.hashOn:
+            kept[key] = 1
+
+    # filters which have gone
+    for key, table in odev.tables.items():
+        if key not in kept:
+            cmds.append(table.delete())
+    for key, filt in odev.filters.items():
+        if key not in ndev.filters and key[:2] in kept:
+            cmds.append(filt.delete(odev.tables[key[:2]]))
+    for key, filt in odev.flowerFilters.items():
+        if key not in ndev.flowerFilters:
+            cmds.append(filt.delete())
+    for key, filt in odev.kindFilters.items():
+        if key not in ndev.kindFilters:
+            cmds.append(filt.delete())
+
+    # new and changed qdiscs and classes, parents first
+    for key, obj in ndev.objects.items():
+        oldobj = odev.objects.get(key, None)
+        if oldobj is None:
+            cmds.append(obj.add())
+        elif oldobj.text != obj.text:
+            cmds.append(obj.change())
+
+    # new filter tables
+    for key, table in ndev.tables.items():
+        if key not in kept:
+            cmds.extend(table.add())
+
+    # keep the handles of filters we already have, and find free ones
+    # for new filters - node numbers only have to be unique within
+    # each bucket
+    used = {}
+    for key, filt in ndev.filters.items():
+        oldfilt = odev.filters.get(key, None)
+        if oldfilt is not None and key[:2] in kept:
+            filt.node = oldfilt.node
+            used.setdefault((key[:2], filt.htid, filt.bucket), {})[filt.node] = 1
+    nextNode = {}
+    for key, filt in ndev.filters.items():
+        table = ndev.tables[key[:2]]
+        if filt.node is None:
+            bucket = (key[:2], filt.htid, filt.bucket)
+            bucketUsed = used.setdefault(bucket, {})
+            node = nextNode.get(bucket, 1)
+            while node in bucketUsed:
+                node += 1
+            if node > Filter.maxNode:
+                raise TcModelError("%s: too many filters at parent %s prio %s" % (
+                    ndev.dev, table.parent, table.prio))
+            filt.node = node
+            bucketUsed[node] = 1
+            nextNode[bucket] = node + 1
+            cmds.append(filt.add(table))
+        elif filt.action != odev.filters[key].action:
+            cmds.append(filt.change(table))
+    # likewise for flower filters, whose handles only have to be
+    # unique within each parent and prio
+    used = {}
+    for key, filt in ndev.flowerFilters.items():
+        oldfilt = odev.flowerFilters.get(key, None)
+        if oldfilt is not None:
+            filt.handle = oldfilt.handle
+            used.setdefault(key[:2], {})[filt.handle] = 1
+    nextHandle = {}
+    for key, filt in ndev.flowerFilters.items():
+        if filt.handle is None:
+            prioUsed = used.setdefault(key[:2], {})
+            handle = nextHandle.get(key[:2], 1)
+            while handle in prioUsed:
+                handle += 1
+            if handle > FlowerFilter.maxHandle:
+                raise TcModelError("%s: too many filters at parent %s prio %s" % (
+                    ndev.dev, filt.parent, filt.prio))
+            filt.handle = handle
+            prioUsed[handle] = 1
+            nextHandle[key[:2]] = handle + 1
+            cmds.append(filt.add())
+        elif filt.action != odev.flowerFilters[key].action:
+            cmds.append(filt.change())
+
+    for key, filt in ndev.kindFilters.items():
+        oldfilt = odev.kindFilters.get(key, None)
+        if oldfilt is None:
+            cmds.extend(filt.add())
+        elif oldfilt.kind != filt.kind:
+            cmds.append(oldfilt.delete())
+            cmds.extend(filt.add())
+        elif oldfilt.text != filt.text:
+            cmds.extend(filt.change())
+
+    # classes which have gone, children first - their leaf qdiscs go
+    # with them. This has to wait until no filters point at them, or
+    # htb won't let go
+    gone = {}
+    for key in reversed(odev.objects.keys()):
+        obj = odev.objects[key]
+        if key not in ndev.objects and isinstance(obj, TcClass):
+            gone[obj.classid] = 1
+            cmds.append(obj.delete())
+    for key, obj in odev.objects.items():
+        if key not in ndev.objects and isinstance(obj, Qdisc) \
+                and obj.parent not in gone:
+            cmds.append(obj.delete())
+
+    return cmds
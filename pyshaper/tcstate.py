@@ -0,0 +1,478 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Reads back the qdiscs, classes and filters on our devices over
+rtnetlink, and compares them with the model we last applied
+
+Anything changed behind our back - a flushed qdisc, a deleted filter,
+a class someone's given another rate - shows up as drift, and comes
+back as a model of what's actually there, which TcModel.diff can take
+as its old model to put just those things right. Things we never asked
+for, like classes or filters someone's added under our qdiscs, get
+deleted first. A device whose root or ingress qdisc has gone or
+changed, or whose filter tables are damaged, gets built afresh
+
+What we expect of each object comes from encoding the command which
+adds it, just as the netlink backend would, so it can be compared
+with the kernel's dump attribute by attribute
+"""
+
+import cPickle
+import os
+import struct
+from collections import OrderedDict
+
+from pyshaper import rtnl
+from pyshaper.rtnl import RtnlError, NoDevice, decodeMessage, nlmsghdr, \
+    parseAttrs, parseHandle, parseFwHandle, parseInt
+from pyshaper.tcmodel import DevModel, Filter, FlowerFilter, KindFilter, \
+    Qdisc, TcClass, TcModel, swapBands
+
+
+class LiveDev:
+    """
+    What's on one device - qdiscs keyed on parent, classes on classid,
+    and filters on (parent, prio), as rtnl.decodeMessage has them
+    """
+
+    def __init__(self, dev):
+
+        self.dev = dev
+        self.qdiscs = {}
+        self.classes = {}
+        self.filters = {}
+
+
+def formatHandle(handle):
+    return "%x:%x" % (handle >> 16, handle & 0xffff)
+
+
+def formatParent(parent):
+
+    if parent == rtnl.TC_H_ROOT:
+        return 'root'
+    if parent == rtnl.TC_H_INGRESS:
+        return 'ingress'
+    return formatHandle(parent)
+
+
+def readDev(sock, dev, parents):
+    """
+    Dumps device dev's qdiscs and classes, and its filters at each
+    of parents, over Rtnl sock
+    """
+    live = LiveDev(dev)
+    for msg in sock.dump(rtnl.RTM_GETQDISC, dev):
+        live.qdiscs[formatParent(msg['parent'])] = msg
+    for msg in sock.dump(rtnl.RTM_GETTCLASS, dev):
+        live.classes[formatHandle(msg['handle'])] = msg
+    for parent in parents:
+        if not [1 for msg in live.qdiscs.values()
+                if msg['handle'] == parseHandle(parent)]:
+            continue
+        for msg in sock.dump(rtnl.RTM_GETTFILTER, dev, parseHandle(parent)):
+            live.filters.setdefault((parent, msg['info'] >> 16), []).append(msg)
+    return live
+
+
+def parents(devModel):
+    """
+    Returns the qdiscs device model devModel has filters at
+    """
+    found = {}
+    for filters in [devModel.tables, devModel.filters,
+                    devModel.flowerFilters, devModel.kindFilters]:
+        for key in filters:
+            found[key[0]] = 1
+    if devModel.gen is not None:
+        found['1:'] = 1
+    return found.keys()
+
+
+def encoded(sock, cmd):
+    """
+    Returns the message the netlink backend would send for cmd, as
+    decodeMessage has it - or None if it can't be encoded
+    """
+    try:
+        msgtype, flags, body = sock.encode(cmd)
+    except RtnlError:
+        return None
+    return decodeMessage(nlmsghdr.pack(nlmsghdr.size + len(body), msgtype,
+                                       flags, 0, 0) + body)
+
+
+def policeRate(data):
+
+    if data is None:
+        return None
+    rate = None
+    for atype, value in parseAttrs(data):
+        if atype == rtnl.TCA_POLICE_TBF:
+            rate = struct.unpack_from("=L", value, rtnl.policeHead.size + 8)[0]
+        elif atype == rtnl.TCA_POLICE_RATE64:
+            return struct.unpack_from("=Q", value)[0]
+    return rate
+
+
+def signature(msg):
+    """
+    Returns the parts of a class or filter which say what it does -
+    those we set, as the kernel gives them back
+    """
+    if msg is None:
+        return None
+    opts = dict(msg['options'] or [])
+    kind = msg['kind']
+    if kind == 'htb':
+        parms = opts.get(rtnl.TCA_HTB_PARMS, "")
+        if len(parms) < 44:
+            return None
+        rate = struct.unpack_from("=L", parms, 8)[0]
+        ceil = struct.unpack_from("=L", parms, 20)[0]
+        prio = min(struct.unpack_from("=L", parms, 40)[0],
+                   rtnl.TC_HTB_NUMPRIO - 1)
+        if rtnl.TCA_HTB_RATE64 in opts:
+            rate = struct.unpack_from("=Q", opts[rtnl.TCA_HTB_RATE64])[0]
+        if rtnl.TCA_HTB_CEIL64 in opts:
+            ceil = struct.unpack_from("=Q", opts[rtnl.TCA_HTB_CEIL64])[0]
+        return kind, rate, ceil, prio
+    if kind == 'u32':
+        return (kind, opts.get(rtnl.TCA_U32_CLASSID),
+                opts.get(rtnl.TCA_U32_LINK), opts.get(rtnl.TCA_U32_DIVISOR),
+                opts.get(rtnl.TCA_U32_SEL),
+                policeRate(opts.get(rtnl.TCA_U32_POLICE)))
+    if kind == 'fw':
+        return (kind, opts.get(rtnl.TCA_FW_CLASSID),
+                policeRate(opts.get(rtnl.TCA_FW_POLICE)))
+    if kind == 'flower':
+        return (kind, opts.get(rtnl.TCA_FLOWER_CLASSID)) + tuple([
+            opts.get(atype) for atype in [
+                rtnl.TCA_FLOWER_KEY_IP_PROTO,
+                rtnl.TCA_FLOWER_KEY_IPV4_SRC, rtnl.TCA_FLOWER_KEY_IPV4_DST,
+                rtnl.TCA_FLOWER_KEY_TCP_SRC, rtnl.TCA_FLOWER_KEY_TCP_DST,
+                rtnl.TCA_FLOWER_KEY_UDP_SRC, rtnl.TCA_FLOWER_KEY_UDP_DST]])
+    if kind == 'bpf':
+        return (kind, opts.get(rtnl.TCA_BPF_CLASSID),
+                opts.get(rtnl.TCA_BPF_OPS))
+    return (kind,)
+
+
+def qdiscKind(text):
+    """
+    Returns the kind and handle (or None) of the qdisc in Qdisc text
+    """
+    words = text.split()
+    handle = None
+    while words:
+        word = words.pop(0)
+        if word in ('parent', 'handle') and words:
+            value = words.pop(0)
+            if word == 'handle':
+                handle = parseHandle(value)
+        elif word not in ('root', 'ingress'):
+            return word, handle
+    return 'ingress', handle
+
+
+def sameQdisc(obj, msg):
+
+    kind, handle = qdiscKind(obj.text)
+    return msg['kind'] == kind and handle in (None, msg['handle'])
+
+
+def kindHandle(filt):
+    """
+    Returns the handle the kernel gives KindFilter filt, or None if
+    it doesn't have one
+    """
+    if filt.handle is None:
+        return None
+    if filt.kind == 'fw':
+        return parseFwHandle(filt.handle)[0]
+    if filt.kind == 'u32':
+        return rtnl.parseU32Handle(filt.handle)
+    return parseInt(filt.handle, 0)
+
+
+def isKnode(msg):
+    """
+    Tells u32 filters from u32 hash tables, and the entry each
+    filter prio has in a dump for itself
+    """
+    return msg['kind'] != 'u32' or rtnl.TCA_U32_SEL in dict(msg['options'] or [])
+
+
+def checkTable(table, msgs):
+    """
+    Returns True if FilterTable table's hash tables are there, with
+    the filters linking to them
+    """
+    divisors = {}
+    links = {}
+    for msg in msgs:
+        opts = dict(msg['options'] or [])
+        if rtnl.TCA_U32_DIVISOR in opts:
+            divisors[msg['handle'] >> 20] = struct.unpack(
+                "=L", opts[rtnl.TCA_U32_DIVISOR])[0]
+        if rtnl.TCA_U32_LINK in opts:
+            links[struct.unpack("=L", opts[rtnl.TCA_U32_LINK])[0] >> 20] = 1
+    if divisors.get(table.htid) != 1 or table.htid not in links:
+        return False
+    if table.hashOn is not None:
+        if divisors.get(table.hashHtid) != table.divisor \
+                or table.hashHtid not in links:
+            return False
+    return True
+
+
+def reconcileDev(sock, edev, live):
+    """
+    Compares device model edev with LiveDev live, returning a model of
+    what's there for TcModel.diff, and a list of the differences
+    """
+    dev = edev.dev
+    fdev = DevModel(dev)
+    fdev.gen = edev.gen
+    drift = []
+
+    # without the root or ingress qdisc, there's nothing of ours left
+    roots = [key for key in [('qdisc', 'root'), ('qdisc', 'ingress')]
+             if key in edev.objects]
+    for key in roots:
+        msg = live.qdiscs.get(key[1], None)
+        if msg is None:
+            drift.append("%s: %s qdisc missing" % (dev, key[1]))
+        elif not sameQdisc(edev.objects[key], msg):
+            drift.append("%s: %s qdisc is %s" % (dev, key[1], msg['kind']))
+        else:
+            fdev.add(edev.objects[key])
+    if len(fdev.objects) != len(roots):
+        return fdev, drift
+
+    # qdiscs and classes
+    majors = {}
+    for key, obj in edev.objects.items():
+        if key in roots:
+            continue
+        if isinstance(obj, Qdisc):
+            msg = live.qdiscs.get(obj.parent, None)
+            if msg is None:
+                drift.append("%s: qdisc at %s missing" % (dev, obj.parent))
+            elif not sameQdisc(obj, msg):
+                drift.append("%s: qdisc at %s is %s" % (
+                    dev, obj.parent, msg['kind']))
+                fdev.add(Qdisc(dev, "parent %s %s" % (obj.parent, msg['kind'])))
+            else:
+                fdev.add(obj)
+            continue
+        majors[obj.classid.split(":")[0]] = 1
+        msg = live.classes.get(obj.classid, None)
+        if msg is None:
+            drift.append("%s: class %s missing" % (dev, obj.classid))
+        elif signature(msg) != signature(encoded(sock, obj.add())):
+            drift.append("%s: class %s changed" % (dev, obj.classid))
+            fdev.add(TcClass(dev, "classid %s %s" % (obj.classid, msg['kind'])))
+        else:
+            fdev.add(obj)
+
+    # classes under our qdiscs which aren't ours, children first
+    depth = {}
+    for classid, msg in live.classes.items():
+        if classid.split(":")[0] in majors and ('class', classid) not in edev.objects:
+            n = 0
+            parent = formatHandle(msg['parent'])
+            while parent in live.classes and n < 8:
+                parent = formatHandle(live.classes[parent]['parent'])
+                n += 1
+            depth[classid] = n
+    strays = depth.keys()
+    strays.sort(lambda a, b: cmp(depth[b], depth[a]))
+    for classid in strays:
+        drift.append("%s: class %s isn't ours" % (dev, classid))
+
+    prios = {}
+
+    # u32 tables and the filters in them
+    for key, table in edev.tables.items():
+        prios[key] = 1
+        msgs = live.filters.get(key, [])
+        if not checkTable(table, msgs):
+            drift.append("%s: filter table at %s prio %s damaged" % (
+                dev, key[0], key[1]))
+            fdev.broken = True
+            continue
+        fdev.tables[key] = table
+
+        byHandle = dict([(msg['handle'], msg) for msg in msgs if isKnode(msg)])
+        ours = {}
+        for fkey, filt in edev.filters.items():
+            if fkey[:2] != key:
+                continue
+            handle = (filt.htid << 20) | (filt.bucket << 12) | filt.node
+            ours[handle] = 1
+            msg = byHandle.get(handle, None)
+            if msg is None:
+                drift.append("%s: filter %s at %s prio %s missing" % (
+                    dev, filt.handle(table), key[0], key[1]))
+                continue
+            if signature(msg) != signature(encoded(sock, filt.add(table))):
+                drift.append("%s: filter %s at %s prio %s changed" % (
+                    dev, filt.handle(table), key[0], key[1]))
+                found = Filter(dev, filt.parent, filt.prio, filt.selector, "?")
+                found.htid, found.bucket, found.node = \
+                    filt.htid, filt.bucket, filt.node
+                filt = found
+            fdev.filters[fkey] = filt
+        for handle in byHandle:
+            if handle >> 20 in table.htids() and handle not in ours:
+                drift.append("%s: filter %x:%x:%x at %s prio %s isn't ours" % (
+                    dev, handle >> 20, (handle >> 12) & 0xff, handle & 0xfff,
+                    key[0], key[1]))
+                fdev.repairs.append(
+                    "filter del %s handle %x:%x:%x u32" % (
+                        table.prefix(), handle >> 20, (handle >> 12) & 0xff,
+                        handle & 0xfff))
+
+    # flower and other filters, which go by their handles
+    others = [(fkey, filt, filt.handle)
+              for fkey, filt in edev.flowerFilters.items()] \
+        + [(fkey, filt, kindHandle(filt))
+           for fkey, filt in edev.kindFilters.items()]
+    byKey = {}
+    for fkey, filt, handle in others:
+        key = fkey[:2]
+        if key not in byKey:
+            byKey[key] = OrderedDict([(msg['handle'], msg)
+                                      for msg in live.filters.get(key, [])
+                                      if isKnode(msg)])
+    ours = {}
+    for fkey, filt, handle in others:
+        key = fkey[:2]
+        prios[key] = 1
+        if handle is None:
+            match = byKey[key].values()[:1]
+        elif handle in byKey[key]:
+            match = [byKey[key][handle]]
+        else:
+            match = []
+        if not match:
+            drift.append("%s: %s filter at %s prio %s missing" % (
+                dev, isinstance(filt, FlowerFilter) and 'flower' or filt.kind,
+                key[0], key[1]))
+            continue
+        msg = match[0]
+        ours[(key, msg['handle'])] = 1
+        if isinstance(filt, FlowerFilter):
+            same = signature(msg) == signature(encoded(sock, filt.add()))
+            found = FlowerFilter(dev, filt.parent, filt.prio, filt.selector, "?")
+            found.handle = filt.handle
+        else:
+            same = signature(msg) == signature(encoded(sock, filt.add()[0]))
+            found = KindFilter(dev, filt.parent, filt.prio, filt.kind,
+                               filt.handle, "?")
+        if not same:
+            drift.append("%s: %s filter at %s prio %s changed" % (
+                dev, msg['kind'], key[0], key[1]))
+            filt = found
+        if isinstance(filt, FlowerFilter):
+            fdev.flowerFilters[fkey] = filt
+        else:
+            fdev.kindFilters[fkey] = filt
+    for key, msgs in byKey.items():
+        for handle, msg in msgs.items():
+            if handle and msg['kind'] != 'u32' and (key, handle) not in ours:
+                drift.append("%s: %s filter 0x%x at %s prio %s isn't ours" % (
+                    dev, msg['kind'], handle, key[0], key[1]))
+                fdev.repairs.append(
+                    "filter del dev %s parent %s prio %s handle 0x%x %s" % (
+                        dev, key[0], key[1], handle, msg['kind']))
+
+    # after any filters pointing at them
+    for classid in strays:
+        fdev.repairs.append("class del dev %s classid %s" % (dev, classid))
+
+    # the selector, when rebuilding make-before-break
+    if edev.gen is not None:
+        prios[('1:', 1)] = 1
+        classid = struct.pack("=L", parseHandle(swapBands[edev.gen]))
+        if not [1 for msg in live.filters.get(('1:', 1), [])
+                if dict(msg['options'] or []).get(rtnl.TCA_U32_CLASSID) == classid]:
+            drift.append("%s: selector isn't on %s" % (dev, swapBands[edev.gen]))
+            fdev.repairs.append(edev.selector("replace"))
+
+    # filters at prios we don't use
+    for key in live.filters:
+        if key not in prios:
+            drift.append("%s: filters at %s prio %s aren't ours" % (
+                dev, key[0], key[1]))
+            fdev.repairs.insert(0, "filter del dev %s parent %s prio %s" % (
+                dev, key[0], key[1]))
+
+    return fdev, drift
+
+
+def verify(sock, model):
+    """
+    Reads back what's on the devices in TcModel model, over Rtnl sock,
+    returning (found, drift) - a model of what's there, for
+    TcModel.diff, and a list of the ways it differs from model, which
+    is empty if it doesn't
+
+    Raises RtnlError or socket.error if the devices can't be read
+    """
+    found = TcModel()
+    drift = []
+    for dev, edev in model.devs.items():
+        if edev.broken:
+            # getting built afresh anyway
+            found.devs[dev] = edev
+            continue
+        try:
+            live = readDev(sock, dev, parents(edev))
+        except NoDevice:
+            drift.append("%s: no such device" % dev)
+            found.devs[dev] = edev
+            continue
+        fdev, devDrift = reconcileDev(sock, edev, live)
+        found.devs[dev] = fdev
+        drift.extend(devDrift)
+    return found, drift
+
+
+def saveModel(model, path):
+    """
+    Saves TcModel model in the file at path, for 'pyshaper verify' -
+    raises IOError if it can't
+    """
+    pathNew = path + ".new"
+    f = file(pathNew, "wb")
+    cPickle.dump(model, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(pathNew, path)
+
+
+def loadModel(path):
+    """
+    Returns the TcModel saved in the file at path, or None
+    """
+    try:
+        f = file(path, "rb")
+    except IOError:
+        return None
+    try:
+        return cPickle.load(f)
+    finally:
+        f.close()
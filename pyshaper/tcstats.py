@@ -0,0 +1,221 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Works out how fast each class and connection is going, from the byte
+counts the kernel keeps for tc, rather than by capturing packets
+
+Going out, each class's htb class counts what it sends. Coming in,
+there are no classes, but the police action on each ingress filter
+counts what it sees, so a class gets the sum of its filters' counts.
+The kernel reports those counts at the top of the filter for the u32
+and fw filters' old style 'police', and inside the action for the
+'action police' of flower and bpf filters. Connections with filters
+of their own - u32 or flower ones, with the connection's addresses
+and ports in their keys - get their filter's counts, which means only
+coming in, as our outgoing filters have no actions to count with
+
+Counts get read in bulk, with an rtnetlink dump per qdisc
+"""
+
+import struct
+import time
+
+from pyshaper import rtnl
+from pyshaper.rtnl import NoDevice, Rtnl, parseAttrs, tcStats, \
+    u32KeyHead, u32KeyTail
+
+# directions, as indexes into (rateIn, rateOut)
+IN, OUT = range(2)
+
+# the filter option holding each kind of filter's classid
+classidAttrs = {
+    'u32': rtnl.TCA_U32_CLASSID,
+    'fw': rtnl.TCA_FW_CLASSID,
+    'flower': rtnl.TCA_FLOWER_CLASSID,
+    'bpf': rtnl.TCA_BPF_CLASSID,
+}
+
+# the size of a u32 selector before its keys, and of each key
+u32SelSize = 16
+u32KeySize = u32KeyHead.size + u32KeyTail.size
+
+
+class TcStats:
+    """
+    Reads the counters on a set of devices each time poll gets called,
+    keeping rates in bytes/sec averaged over the last 'window' seconds
+    """
+
+    def __init__(self, sock=None, window=5.0):
+
+        # an Rtnl, opened on first use
+        self.rtnl = sock
+        self.window = window
+
+        # (time, counts) of each poll in the window, oldest first -
+        # counts are keyed on ('class', dev, minor, direction) and
+        # ('conn', (laddr, lport, raddr, rport), direction)
+        self.samples = []
+
+        # same keys -> bytes/sec
+        self.rates = {}
+
+    def poll(self, devs):
+        """
+        Reads the counters on devices devs, and works out the rates -
+        raises RtnlError or socket.error if they can't be read
+        """
+        if self.rtnl is None:
+            self.rtnl = Rtnl()
+
+        counts = {}
+        for dev in devs:
+            try:
+                readCounts(self.rtnl, dev, counts)
+            except NoDevice:
+                pass
+        now = time.time()
+
+        # the oldest sample in the window we can go from - counts go
+        # back down when classes and filters get rebuilt, so after
+        # that, a later one
+        samples = [sample for sample in self.samples
+                   if sample[0] >= now - self.window] or self.samples[-1:]
+        rates = {}
+        for key, count in counts.items():
+            for then, old in samples:
+                if old.get(key, count + 1) <= count and now > then:
+                    rates[key] = (count - old[key]) / (now - then)
+                    break
+
+        self.samples = samples + [(now, counts)]
+        self.rates = rates
+
+    def classRates(self, dev, classIds):
+        """
+        Returns {class name: (rateIn, rateOut)} for the classes on
+        device dev, naming them through ClassIds classIds
+        """
+        found = {}
+        for key, rate in self.rates.items():
+            if key[0] != 'class' or key[1] != dev:
+                continue
+            name = classIds.name(dev, key[2])
+            if name is None:
+                continue
+            rates = found.setdefault(name, [0.0, 0.0])
+            rates[key[3]] += rate
+        return dict([(name, tuple(rates)) for name, rates in found.items()])
+
+    def connRates(self, conn):
+        """
+        Returns (rateIn, rateOut) for connection conn - either of which
+        is None if its filters don't count it
+        """
+        key = conn.key[:4]
+        return (self.rates.get(('conn', key, IN), None),
+                self.rates.get(('conn', key, OUT), None))
+
+
+def readCounts(sock, dev, counts):
+    """
+    Adds the counts on device dev, read over Rtnl sock, to counts
+    """
+    for msg in sock.dump(rtnl.RTM_GETTCLASS, dev):
+        if msg['kind'] == 'htb' and msg['bytes'] is not None:
+            addCount(counts, ('class', dev, msg['handle'] & 0xffff, OUT),
+                     msg['bytes'])
+
+    for qdisc in sock.dump(rtnl.RTM_GETQDISC, dev):
+        if qdisc['kind'] not in ('htb', 'ingress'):
+            continue
+        ingress = qdisc['kind'] == 'ingress'
+        if ingress:
+            direction = IN
+        else:
+            direction = OUT
+        for msg in sock.dump(rtnl.RTM_GETTFILTER, dev, qdisc['handle']):
+            opts = dict(msg['options'] or [])
+            count = msg['bytes']
+            actAttr = rtnl.filterActAttrs.get(msg['kind'], None)
+            if count is None and actAttr is not None:
+                count = actionBytes(opts.get(actAttr, None))
+            if count is None:
+                continue
+            attr = classidAttrs.get(msg['kind'], None)
+            if ingress and attr in opts:
+                # outgoing, the classes do the counting
+                classid = struct.unpack("=L", opts[attr])[0]
+                addCount(counts, ('class', dev, classid & 0xffff, IN), count)
+            conn = filterConn(msg['kind'], opts, ingress)
+            if conn is not None:
+                addCount(counts, ('conn', conn, direction), count)
+
+
+def addCount(counts, key, count):
+    counts[key] = counts.get(key, 0) + count
+
+
+def actionBytes(data):
+    """
+    Returns the bytes counted by the police actions in a filter's list
+    of actions, or None if it has none
+    """
+    if data is None:
+        return None
+    count = None
+    for order, action in parseAttrs(data):
+        action = dict(parseAttrs(action))
+        if action.get(rtnl.TCA_ACT_KIND, "").rstrip("\0") != 'police':
+            continue
+        for atype, value in parseAttrs(action.get(rtnl.TCA_ACT_STATS, "")):
+            if atype == rtnl.TCA_STATS_BASIC:
+                count = (count or 0) + tcStats.unpack_from(value)[0]
+    return count
+
+
+def filterConn(kind, opts, ingress):
+    """
+    Returns the (laddr, lport, raddr, rport) of the connection a filter
+    with options opts is for, or None if it's not for just one
+    """
+    if kind == 'u32':
+        sel = opts.get(rtnl.TCA_U32_SEL, None)
+        if sel is None:
+            return None
+        keys = {}
+        for i in range(ord(sel[2])):
+            pos = u32SelSize + i * u32KeySize
+            mask, val = u32KeyHead.unpack_from(sel, pos)
+            off = u32KeyTail.unpack_from(sel, pos + u32KeyHead.size)[0]
+            if mask == 0xffffffffL:
+                keys[off] = val
+        if 12 not in keys or 16 not in keys or 20 not in keys:
+            return None
+        src, dst = keys[12], keys[16]
+        sport, dport = keys[20] >> 16, keys[20] & 0xffff
+    elif kind == 'flower':
+        try:
+            src = struct.unpack("!L", opts[rtnl.TCA_FLOWER_KEY_IPV4_SRC])[0]
+            dst = struct.unpack("!L", opts[rtnl.TCA_FLOWER_KEY_IPV4_DST])[0]
+            sport = struct.unpack("!H", opts[rtnl.TCA_FLOWER_KEY_TCP_SRC])[0]
+            dport = struct.unpack("!H", opts[rtnl.TCA_FLOWER_KEY_TCP_DST])[0]
+        except KeyError:
+            return None
+    else:
+        return None
+    if ingress:
+        return dst, dport, src, sport
+    return src, sport, dst, dport
@@ -12,18 +12,27 @@
 # GNU website, at http://gnu.org
 #
 
-import commands
 import getopt
-import popen2
-import sha
 import signal
+import socket
 import time
 import traceback
 import os
 import re
 import sys
 
-from pyshaper import configDir, configPath, shaperPeriod, verbosity
+from pyshaper import __version__ as version
+from pyshaper import classIdsPath, configDir, configPath, pidfile, shaperPeriod
+from pyshaper import makeBeforeBreak, tcStatePath, verifyPeriod
+from pyshaper import verbosity
+from pyshaper import bpf, tcBackend, tcbatch, tcstate
+from pyshaper.classids import ClassIds, ClassIdError
+from pyshaper.config import ShaperConfig
+from pyshaper.conn import TCPConns
+from pyshaper.nft import Nft, NftModel, clearScript, markMask
+from pyshaper.rtnl import Rtnl, RtnlError
+from pyshaper.tcmodel import TcModel, TcModelError, nextGen
+from pyshaper.tcmodel import swapBands, swapMajors, swapRoot
 
 
 class TShaper:
@@ -39,6 +48,30 @@ class TShaper:
     debug = False
     verbosity = verbosity
 
+    tcBackend = tcBackend
+
+    makeBeforeBreak = makeBeforeBreak
+
+    verifyPeriod = verifyPeriod
+    tcStatePath = tcStatePath
+
+    # netlink socket for the 'netlink' backend, opened on first use
+    rtnl = None
+
+    # runs nft scripts for interfaces using the 'mark' classifier
+    nft = None
+
+    # where the fw filters and the connmark action go, for interfaces
+    # using the 'mark' classifier - after our u32 filters
+    markPrio = 0x300
+
+    # where the per-connection filters go, for interfaces using the
+    # 'flower' classifier
+    flowerPrio = 0x310
+
+    # and the programs, for interfaces using the 'bpf' classifier
+    bpfPrio = 0x320
+
     def __init__(self, *args, **kw):
 
         # ensure we are root
@@ -55,13 +88,26 @@ class TShaper:
         self.verbosity = kw.get('verbosity', self.verbosity)
         self.debug = kw.get('debug', self.debug)
 
+        # previous scan's connections, how each was classified, and
+        # which connections each class ended up with
+        self.resetConnState()
+
+        # the qdiscs, classes and filters we last set up - None until
+        # we've cleared out whatever was there before us
+        self.tcModel = None
+
+        # when to next check that's still what's there
+        self.nextVerify = 0
+
+        # likewise the nftables sets and rules, for marking connections
+        self.nftModel = None
+
+        # each class's tc class id
+        self.classIds = ClassIds(classIdsPath)
+
         # set up 'queue' of commands to execute, if not verbose
-        if not self.debug:
-            self.cmdq = []
-            self.cmdBuf = ''
-            self.cmdBufOld = ''
-            self.cmdBufHash = ''
-            self.cmdBufHashOld = ''
+        self.cmdq = []
+        self.cmdBuf = ''
 
     def run(self):
         """
@@ -107,8 +153,10 @@ class TShaper:
                     # reload config if needed
                     if self.reloadFlag:
                         self.log(2, "RELOADING CONFIG")
+                        # this also flushes the classification cache
                         self.config.load()
                         self.shaperPeriod = self.config.shaperPeriod
+                        self.resetConnState()
                         self.reloadFlag = False
                         break
                     if self.quitFlag:
@@ -141,16 +189,30 @@ class TShaper:
         elif signum == signal.SIGHUP:
             self.reloadFlag = True
 
+    def resetConnState(self):
+        """
+        Forgets the previous cycle's connections and class membership,
+        so the next cycle rebuilds everything afresh
+        """
+        self.prevConns = None
+        self.membership = None
+
     def setupShaping(self):
         """
         Generates and executes actual tc shaping commands,
         according to current setup
         """
-        # get table of current connections
-        self.currentConns = TCPConns()
+        # get table of current connections, with just the details
+        # our rules need
+        self.currentConns = TCPConns(fields=self.config.fields)
 
         # self.currentConns.dump()
 
+        # put right anything changed behind our back
+        if self.verifyPeriod and time.time() >= self.nextVerify:
+            self.nextVerify = time.time() + self.verifyPeriod
+            self.verifyState()
+
         # set up the dynamic shaping
         self.setupDynamic()
 
@@ -175,55 +237,88 @@ class TShaper:
             iface.staticClasses = filter(lambda c: c.mode == 'static',
                                          iface.classes)
 
-        # second pass - classify all connections
-        for conn in self.currentConns:
-            # print conn.laddr, conn.lport, conn.raddr, conn.rport
-            try:
-                localip = conn.laddr
-
-                # match against each rule
-                for iface in self.config.interfaces:
-                    # ditch connections that aren't on this interface
-                    if iface.ipaddr != localip:
-                        continue
-
-                    # ignore connection if it matches a static class
-                    for cls in iface.staticClasses:
-                        if cls.matches(conn):
-                            raise MatchedConnectionException
-
-                    # try to match against all classes
-                    for cls in iface.classes:
-                        if cls.matches(conn):
-                            self.log(3, "MATCH:\n  %s\n  %s" % (
-                                str(conn), str(cls).replace("\n", "\n    ")))
-                            cls.conns.append(conn)
-                            raise MatchedConnectionException  # bail out to uppermost loop
-                    # no rule found for conn, add to default
-                    iface.default.conns.append(conn)
-                    break  # quicker than raising exception
-
-            except MatchedConnectionException:
-                pass
-
-        # third pass - generate/execute shaping commands
+        # second pass - classify the connections which are new since
+        # last time, and reuse the previous results for the rest
+        delta = self.currentConns.delta(self.prevConns)
+        self.log(3, "connections: %s" % delta)
+
+        for conn in delta.removed:
+            self.config.classCache.discard(conn.ident)
+        added = dict.fromkeys([conn.key for conn in delta.added])
+        classes = self.config.classifyAll(self.currentConns)
+
+        membership = {}
+        for conn, res in zip(self.currentConns, classes):
+            if res is None or res.mode == 'static':
+                # not on a shaped interface, or covered by a static class
+                continue
+            key = conn.key
+            if key in added and res is not res.parent.default:
+                self.log(3, "MATCH:\n  %s\n  %s" % (
+                    str(conn), str(res).replace("\n", "\n    ")))
+            res.conns.append(conn)
+            clsKey = (res.parent.name, res.name)
+            if clsKey not in membership:
+                membership[clsKey] = {}
+            membership[clsKey][key] = 1
+
+        self.prevConns = self.currentConns
+
+        # bail out before generating any tc commands if every class
+        # has the same connections as last time
+        if membership == self.membership:
+            self.log(3, "setupDynamic: no change to class membership - bailing")
+            return
+        self.membership = membership
+
+        # third pass - build a model of the shaping setup we want
+        self.model = TcModel()
+        self.marks = NftModel()
         for iface in self.config.interfaces:
             dev = iface.name
-
-            # clear out dev
-            self.tcResetDev(dev)
-
-            # basic interface setup
-            self.tcAddQdisc(dev, "root handle 1: htb default 1000")
-            self.tcAddClassHtb(dev=dev, parent="1:", classid="1:1", pri=1,
+            marking = iface.filterMode == 'mark'
+
+            # basic interface setup - when rebuilding make-before-break,
+            # our htb tree goes under whichever band of the root it's
+            # being built in, and leaf qdiscs get whatever handle the
+            # kernel gives them, so they don't clash with the other tree's
+            if self.makeBeforeBreak:
+                gen = nextGen(self.tcModel, dev)
+                self.model.setGen(dev, gen)
+                major = swapMajors[gen]
+                self.tcAddQdisc(dev, swapRoot)
+                self.tcAddQdisc(dev, "parent %s handle %x: htb default 1000" % (
+                    swapBands[gen], major))
+            else:
+                major = 1
+                self.tcAddQdisc(dev, "root handle 1: htb default 1000")
+            root = "%x:" % major
+            self.tcAddClassHtb(dev=dev, parent=root, classid=root + "1", pri=1,
                                rate=iface.bwOut)
             self.tcAddQdisc(dev, "ingress handle ffff:")
 
-            nextCls = 100
+            if marking:
+                self.marks.addIface(dev)
+                self.tcAddFilterConnmark(dev)
+
+            # a bpf program does the work of all the class's filters
+            progs = None
+            if iface.filterMode == 'bpf':
+                progs = self.bpfPrograms(iface, major)
 
             # set up shaping for each class
             for cls in iface.classes:
-                nextCls += 1
+                try:
+                    minor = self.classIds.get(dev, cls.name)
+                except ClassIdError, e:
+                    self.log(1, "can't shape %s.%s: %s" % (dev, cls.name, e))
+                    continue
+                clsId = "%x" % minor
+
+                # every class gets a set, so it's only the set's elements
+                # which change as connections come and go
+                if marking:
+                    nftset = self.marks.addSet(dev, cls.name, minor)
 
                 # bail if not static and no matching rules
                 if cls.mode != 'static' and not cls.conns:
@@ -234,54 +329,75 @@ class TShaper:
                 # create an htb class with sfq
                 self.tcAddHtbAndSfq(
                     dev=dev,
-                    parent="1:1",
-                    classid="1:%s" % nextCls,
-                    handle="%s:" % nextCls,
+                    parent=root + "1",
+                    classid=root + clsId,
+                    handle=self.leafHandle(clsId),
                     pri=cls.pri,
                     rate=cls.bwOutRate,
                     ceil=cls.bwOutCeil,
                 )
 
-                if cls.mode == 'static':
-                    # add egress filter
-                    matches = []
-                    if cls.raddr:
-                        matches.append("dst %s" % cls.raddr)
-                    if cls.rport:
-                        matches.append("dport %s 0xffff" % cls.rport)
+                if cls.mode == 'static' and progs is None:
+                    # matching on local port takes a pair of filters
+                    # per local address
                     if cls.lport:
-                        matches.append("src %s" % iface.ipaddr)
-                        matches.append("sport %s 0xffff" % cls.lport)
-
-                    self.tcAddFilterOut(
-                        dev=dev,
-                        parent="1:",
-                        flowid="1:%s" % nextCls,
-                        pri=cls.pri,
-                        matches=matches
-                    )
-
-                    # add ingress policer
-                    matches = []
-                    if cls.raddr:
-                        matches.append("src %s" % cls.raddr)
-                    if cls.rport:
-                        matches.append("sport %s 0xffff" % cls.rport)
-                    if cls.lport:
-                        matches.append("dst %s" % iface.ipaddr)
-                        matches.append("dport %s 0xffff" % cls.lport)
-
-                    self.tcAddFilterIngressPolice(
-                        dev=dev,
-                        rate=cls.bwIn,
-                        pri=cls.pri,
-                        flowid=nextCls,
-                        matches=matches,
-                        index=nextCls,
-                    )
+                        localAddrs = iface.ipaddrs
+                    else:
+                        localAddrs = [None]
+
+                    for localAddr in localAddrs:
+                        # add egress filter
+                        matches = []
+                        if cls.raddr:
+                            matches.append("dst %s" % cls.raddr)
+                        if cls.rport:
+                            matches.append("dport %s 0xffff" % cls.rport)
+                        if cls.lport:
+                            matches.append("src %s" % localAddr)
+                            matches.append("sport %s 0xffff" % cls.lport)
+
+                        self.tcAddFilterOut(
+                            dev=dev,
+                            parent=root,
+                            flowid=root + clsId,
+                            pri=cls.pri,
+                            matches=matches
+                        )
+
+                        # add ingress policer
+                        matches = []
+                        if cls.raddr:
+                            matches.append("src %s" % cls.raddr)
+                        if cls.rport:
+                            matches.append("sport %s 0xffff" % cls.rport)
+                        if cls.lport:
+                            matches.append("dst %s" % localAddr)
+                            matches.append("dport %s 0xffff" % cls.lport)
+
+                        self.tcAddFilterIngressPolice(
+                            dev=dev,
+                            rate=cls.bwIn,
+                            pri=cls.pri,
+                            flowid=clsId,
+                            matches=matches,
+                            index=clsId,
+                        )
+
+                # mark the connections, and have one filter for the
+                # mark in each direction
+                if cls.conns and marking:
+                    for conn in cls.conns:
+                        nftset.add(conn.laddr, conn.lport, conn.raddr, conn.rport)
+
+                    self.tcAddFilterMark(dev, root, minor,
+                                         "flowid %s%s" % (root, clsId))
+                    self.tcAddFilterMark(
+                        dev, "ffff:", minor,
+                        "police rate %s burst 10k drop flowid ffff:%s" % (
+                            int(cls.bwIn * 1024), clsId))
 
                 # set up dynamic rules, if current conns match
-                if cls.conns:
+                elif cls.conns and progs is None:
 
                     # put the connections into a deterministic order
                     cls.sortConnections()
@@ -292,11 +408,36 @@ class TShaper:
                     for conn in cls.conns:
                         self.log(4, "%s.%s" % (dev, cls.name))
 
+                        if iface.filterMode == 'flower':
+                            self.tcAddFlowerOut(
+                                dev=dev,
+                                parent=root,
+                                flowid=root + clsId,
+                                matches=[
+                                    "src_ip %s" % conn.laddr,
+                                    "src_port %s" % conn.lport,
+                                    "dst_ip %s" % conn.raddr,
+                                    "dst_port %s" % conn.rport,
+                                ],
+                            )
+                            self.tcAddFlowerIngressPolice(
+                                dev=dev,
+                                rate=bwInPerConn,
+                                flowid=clsId,
+                                matches=[
+                                    "src_ip %s" % conn.raddr,
+                                    "src_port %s" % conn.rport,
+                                    "dst_ip %s" % conn.laddr,
+                                    "dst_port %s" % conn.lport,
+                                ],
+                            )
+                            continue
+
                         # add egress filter
                         self.tcAddFilterOut(
                             dev=dev,
-                            parent="1:",
-                            flowid="1:%s" % nextCls,
+                            parent=root,
+                            flowid=root + clsId,
                             pri=cls.pri,
                             matches=[
                                 "src %s" % conn.laddr,
@@ -311,21 +452,32 @@ class TShaper:
                             dev=dev,
                             rate=bwInPerConn,
                             pri=cls.pri,
-                            flowid=nextCls,
+                            flowid=clsId,
                             matches=[
                                 "src %s" % conn.raddr,
                                 "sport %s 0xffff" % conn.rport,
                                 "dst %s" % conn.laddr,
                                 "dport %s 0xffff" % conn.lport,
                             ],
-                            index=nextCls,
+                            index=clsId,
                         )
 
+            if progs is not None:
+                egress, ingress = progs
+                if egress is not None:
+                    self.tcAddFilterBpf(dev, root, 1, egress, "")
+                for minor, prog, rate in ingress:
+                    self.tcAddFilterBpf(
+                        dev, "ffff:", minor, prog,
+                        " classid ffff:%x action police rate %s burst 10k drop" % (
+                            minor, int(rate * 1024)))
+
             # set up interface default
             self.log(4, "DEFAULT for %s" % dev)
             default = iface.default
             self.tcAddHtbAndSfq(
-                dev=dev, parent="1:1", classid="1:1000", handle="1000:",
+                dev=dev, parent=root + "1", classid=root + "1000",
+                handle=self.leafHandle("1000"),
                 pri=default.pri, rate=default.bwOutRate, ceil=default.bwOutCeil)
 
             # self.tcAddFilterOut(
@@ -333,40 +485,257 @@ class TShaper:
             #    pri=default.pri, matches=["dst 0.0.0.0/0"])
             self.log(4, "DONE DEFAULT for %s" % dev)
 
-            # if non-verbose, then we've got a shitload of commands to execute
-            # and we need to pipe them in bulk to a shell
-            if not self.debug:
+        # hang on to any new class ids
+        try:
+            self.classIds.save()
+        except IOError, e:
+            self.log(2, "can't save class ids: %s" % e)
+
+        # and issue just the commands which get us there from what
+        # we set up last time
+        self.applyModel()
+        self.applyMarks()
+
+    def leafHandle(self, clsId):
+        """
+        Returns the handle for the leaf qdisc of class clsId - None
+        when rebuilding make-before-break
+        """
+        if self.makeBeforeBreak:
+            return None
+        return "%s:" % clsId
+
+    def bpfPrograms(self, iface, major):
+        """
+        Builds the bpf programs for interface iface - one going out,
+        which returns each packet's classid (or None if no class needs
+        one), and one coming in for each class, as (minor, program,
+        inbound rate), picking out the class's packets for policing.
+        Classids going out are under htb major major
+
+        Returns None if the programs would be too long, for iface to
+        get u32 filters instead
+        """
+        egress = bpf.Classifier(egress=True)
+        ingress = []
+
+        for cls in iface.classes:
+            if cls.mode != 'static' and not cls.conns:
+                continue
+            try:
+                minor = self.classIds.get(iface.name, cls.name)
+            except ClassIdError:
+                continue
+
+            classid = (major << 16) | minor
+            classIn = bpf.Classifier(egress=False)
+
+            if cls.mode == 'static':
+                if cls.lport:
+                    localAddrs = iface.ipaddrs
+                else:
+                    localAddrs = [None]
+                for localAddr in localAddrs:
+                    egress.addRule(classid, cls.raddr, cls.rport,
+                                   localAddr, cls.lport)
+                    classIn.addRule(bpf.inClass, cls.raddr, cls.rport,
+                                    localAddr, cls.lport)
+
+            for conn in cls.conns:
+                egress.addConn(classid, conn.laddr, conn.lport,
+                               conn.raddr, conn.rport)
+                classIn.addConn(bpf.inClass, conn.laddr, conn.lport,
+                                conn.raddr, conn.rport)
+
+            ingress.append((minor, classIn, cls.bwIn))
+
+        try:
+            if len(egress):
+                egress = egress.program()
+            else:
+                egress = None
+            return egress, [(minor, classIn.program(), rate)
+                            for minor, classIn, rate in ingress]
+        except bpf.BpfError, e:
+            self.log(2, "%s: %s - using u32 filters" % (iface.name, e))
+            return None
+
+    def applyModel(self):
+        """
+        Works out the tc commands which turn the setup in self.tcModel
+        into that in self.model, and runs them
+        """
+        model = self.model
+        old = self.tcModel
+        try:
+            cmds = model.diff(old)
+            swaps = model.swapCmds(old)
+        except TcModelError, e:
+            self.log(1, "can't set up shaping: %s" % e)
+            return
+
+        for cmd, quiet in cmds:
+            self.tc(cmd, quiet=quiet)
+        ok = self.runCmdQ()
+
+        # switch over to any new trees only once they're all there, a
+        # device at a time, so we know which selectors got switched -
+        # the old trees' ingress filters only go once they have
+        swapped = None
+        if ok:
+            swapped = []
+            for dev, selector, retire in swaps:
+                self.log(2, "%s: switching over to rebuilt qdiscs" % dev)
+                self.tc(selector[0], quiet=selector[1])
+                if not self.runCmdQ():
+                    ok = False
+                    continue
+                swapped.append(dev)
+                for cmd, quiet in retire:
+                    self.tc(cmd, quiet=quiet)
                 self.runCmdQ()
 
-    def runCmdQ(self):
+        if ok:
+            self.tcModel = model
+            self.saveState()
+            return
 
-        # build a single string out of all the queued cmds
-        self.cmdBuf = "\n".join(self.cmdq) + "\n"
-        self.cmdBufHash = sha.new(self.cmdBuf).hexdigest()
-        self.cmdq = []
+        # we no longer know quite what's there, so rebuild next time
+        # round - any old trees we didn't switch away from are still
+        # intact, and still in use, so just what there is of the new
+        # ones goes
+        self.log(2, "tc commands failed - will rebuild qdiscs")
+        if swapped is None:
+            abandon = model.abandonCmds(old)
+        else:
+            abandon = model.abandonCmds(old, [dev for dev, selector, retire
+                                              in swaps if dev not in swapped])
+        for cmd, quiet in abandon:
+            self.tc(cmd, quiet=quiet)
+        self.runCmdQ()
+        self.tcModel = model.failed(old, swapped)
+        self.membership = None
+        self.saveState()
+
+    def verifyState(self):
+        """
+        Reads back what's on our devices, and if anything's not as we
+        left it, has the next run put just that right
+        """
+        if self.tcModel is None:
+            return
+        try:
+            if self.rtnl is None:
+                self.rtnl = Rtnl()
+            found, drift = tcstate.verify(self.rtnl, self.tcModel)
+        except (socket.error, RtnlError), e:
+            self.log(2, "can't read back tc setup: %s" % e)
+            return
+        if not drift:
+            self.log(3, "verifyState: tc setup as we left it")
+            return
+        for line in drift:
+            self.log(2, "tc setup changed: %s" % line)
+        self.tcModel = found
+        self.membership = None
 
-        # bail if the command set hasn't changed
-        self.log(4, "oldCmdBuf=%s" % self.cmdBufHashOld)
-        self.log(4, "newCmdBuf=%s" % self.cmdBufHash)
+    def saveState(self):
+        """
+        Saves the tc setup we last applied, for 'pyshaper verify'
+        """
+        try:
+            tcstate.saveModel(self.tcModel, self.tcStatePath)
+        except IOError, e:
+            self.log(3, "can't save tc setup: %s" % e)
 
-        if self.cmdBuf == self.cmdBufOld:
-            self.log(3, "runCmdQ: no change to tc command set - bailing")
+    def applyMarks(self):
+        """
+        Brings the nftables sets and rules for marking connections
+        from self.nftModel to self.marks, in one nft batch
+        """
+        marks = self.marks
+        if marks.ifaces:
+            script = marks.diff(self.nftModel)
+        elif self.nftModel is not None:
+            # no interface is using marks any more
+            script = clearScript()
+            marks = None
+        else:
+            return
+        if not script:
             return
-        if self.cmdBufOld != '':
-            self.log(2, "connections have changed, rebuilding qdiscs")
 
-        # fire off the commands to a shell child proc
-        shOut, shIn = popen2.popen4("/bin/sh")
-        shIn.write(self.cmdBuf)
-        shIn.close()
-        out = shOut.read()
-        shOut.close()
+        if self.debug:
+            self.log(1, "NFT SCRIPT:\n%s" % script)
+        else:
+            self.log(3, "NFT SCRIPT:\n%s" % script)
 
-        # save the command buf for future comparison
-        self.cmdBufOld = self.cmdBuf
+        if self.nft is None:
+            self.nft = Nft()
+        error = self.nft.run(script)
+        if error is None:
+            self.nftModel = marks
+        else:
+            self.log(2, "nft failed: %s - will rebuild marks" % error)
+            self.nftModel = None
+            self.membership = None
+
+    def runCmdQ(self):
+        """
+        Runs the queued tc commands, returning False if any of
+        them failed
+        """
+        if not self.cmdq:
+            self.log(3, "runCmdQ: no change to tc setup - bailing")
+            return True
+        if self.tcModel is not None:
+            self.log(2, "connections have changed, updating qdiscs")
+
+        cmdq = self.cmdq
+        self.cmdq = []
+
+        # we've likely got a shitload of commands to execute, so feed
+        # them all to one tc process
+        cmds = [cmd for cmd, quiet in cmdq]
+        self.cmdBuf = "\n".join(cmds) + "\n"
+        failures = self.runBatch(cmds)
 
         # for debugging
-        self.log(3, "SCRIPT:\n%sOUT:\n%s" % (self.cmdBuf, out))
+        if self.debug:
+            self.log(1, "SCRIPT:\n%s" % self.cmdBuf)
+        else:
+            self.log(3, "SCRIPT:\n%s" % self.cmdBuf)
+
+        ok = True
+        for index, msg in failures:
+            if index is None:
+                self.log(2, "tc failed: %s" % msg)
+                ok = False
+            elif cmdq[index][1]:
+                self.log(4, "tc %s: %s (ignored)" % (cmds[index], msg))
+            else:
+                self.log(2, "tc %s: %s" % (cmds[index], msg))
+                ok = False
+        return ok
+
+    def runBatch(self, cmds):
+        """
+        Runs a list of tc commands (minus the leading 'tc') with
+        whichever backend we're using, returning (index, message) for
+        each which failed
+        """
+        if self.tcBackend == 'netlink':
+            try:
+                if self.rtnl is None:
+                    self.rtnl = Rtnl()
+                return self.rtnl.runBatch(cmds)
+            except (socket.error, RtnlError), e:
+                # something we can't do over netlink - if we got as far
+                # as sending anything, tc will complain about it, and
+                # we'll start again from scratch
+                self.log(2, "can't use netlink (%s) - falling back on tc" % e)
+
+        return tcbatch.runBatch(cmds)
 
     def terminateShaping(self, immediate=False):
         """clean existing down- and uplink qdiscs, hide errors"""
@@ -374,6 +743,19 @@ class TShaper:
 
         for iface in self.config.interfaces:
             self.tcResetDev(iface.name, immediate=immediate)
+        self.tcModel = None
+        try:
+            os.unlink(self.tcStatePath)
+        except OSError:
+            pass
+
+        if self.nftModel is not None:
+            if self.nft is None:
+                self.nft = Nft()
+            error = self.nft.run(clearScript())
+            if error is not None:
+                self.log(2, "nft failed: %s" % error)
+            self.nftModel = None
 
         # tc("qdisc del DEV root")
         # tc("qdisc del DEV ingress")
@@ -387,19 +769,25 @@ class TShaper:
         return raw
 
     def tc(self, cmd, **kw):
-        # cmd = "tc "+(cmd.replace("DEV", "dev "+self.dev))
-        cmd = "tc " + cmd
+        """
+        Queues tc command cmd (minus the leading 'tc') for the next
+        runCmdQ. Quiet commands are allowed to fail
 
-        # creating a queue of commands
-        self.cmdq.append(cmd)
+        Immediate commands get run straight away, returning tc's error
+        message, or None if it worked
+        """
+        quiet = kw.get('quiet', False)
 
-        # in debug mode, we execute commands and report their results one at a time
-        if self.debug or kw.get('immediate', False):
-            self.log(3, cmd)
-            res = commands.getoutput(cmd)
-            if res:
-                self.log(3, res)
-            return res
+        if kw.get('immediate', False):
+            self.log(3, "tc " + cmd)
+            for index, msg in self.runBatch([cmd]):
+                if not quiet:
+                    self.log(3, msg)
+                return msg
+            return None
+
+        # creating a queue of commands
+        self.cmdq.append((cmd, quiet))
 
     def tcResetDev(self, dev, immediate=False):
 
@@ -410,20 +798,24 @@ class TShaper:
 
     def tcDelQdisc(self, dev, name, immediate=False):
 
-        self.tc("qdisc del dev %s %s" % (dev, name), immediate=immediate)
+        self.tc("qdisc del dev %s %s" % (dev, name), immediate=immediate,
+                quiet=True)
 
     def tcAddQdisc(self, dev, *args):
 
-        self.tc("qdisc add dev %s %s" % (dev, " ".join(args)))
+        self.model.addQdisc(dev, " ".join(args))
 
     def tcAddQdiscSfq(self, dev, parent, handle, perturb=10):
 
+        if handle is None:
+            self.tcAddQdisc(dev, "parent %s sfq perturb %s" % (parent, perturb))
+            return
         self.tcAddQdisc(dev, "parent %s handle %s sfq perturb %s" % (
         parent, handle, perturb))
 
     def tcAddClass(self, dev, *args):
 
-        self.tc("class add dev %s %s" % (dev, " ".join(args)))
+        self.model.addClass(dev, " ".join(args))
 
     def tcAddClassHtb(self, dev, parent, classid, pri, rate, ceil=None):
 
@@ -450,19 +842,21 @@ class TShaper:
                            rate=rate, ceil=ceil)
         self.tcAddQdiscSfq(dev=dev, parent=classid, handle=handle)
 
-    def tcAddFilter(self, dev, *args):
+    def tcAddFilter(self, dev, parent, pri, matches, action, hashOn=None):
 
-        self.tc("filter add dev %s %s" % (dev, " ".join(args)))
+        self.model.addFilter(
+            dev, parent, pri,
+            " ".join(["match ip " + m for m in matches]),
+            action,
+            hashOn,
+        )
 
     def tcAddFilterOut(self, dev, parent, flowid, pri, matches):
 
-        self.tcAddFilter(
-            dev,
-            "parent %s" % parent,
-            "protocol ip prio %s u32" % pri,
-            " ".join(["match ip " + m for m in matches]),
-            "flowid %s" % flowid,
-        )
+        # hashed on the remote address, so the kernel doesn't have to
+        # go through every connection's filter for each packet
+        self.tcAddFilter(dev, parent, pri, matches, "flowid %s" % flowid,
+                         hashOn="dst")
 
         # tcAddFilter(self.dev, "parent 1: protocol ip prio 18 u32 match ip dst 0.0.0.0/0 flowid 1:10")
 
@@ -474,15 +868,50 @@ class TShaper:
         #    indexfld = ''
 
         self.tcAddFilter(
-            dev,
-            "parent ffff: protocol ip prio %s" % pri,
-            "u32",
-            " ".join(["match ip " + m for m in matches]),
-            "police rate %s" % int(rate * 1024),
-            # indexfld,
-            "burst 10k drop flowid ffff:%s" % flowid,
+            dev, "ffff:", pri, matches,
+            "police rate %s burst 10k drop flowid ffff:%s" % (
+                int(rate * 1024), flowid),
+            hashOn="src",
+        )
+
+    def tcAddFlower(self, dev, parent, matches, action):
+
+        self.model.addFlowerFilter(
+            dev, parent, self.flowerPrio,
+            "ip_proto tcp " + " ".join(matches),
+            action,
         )
 
+    def tcAddFlowerOut(self, dev, parent, flowid, matches):
+
+        self.tcAddFlower(dev, parent, matches, "classid %s" % flowid)
+
+    def tcAddFlowerIngressPolice(self, dev, rate, flowid, matches):
+
+        self.tcAddFlower(
+            dev, "ffff:", matches,
+            "classid ffff:%s action police rate %s burst 10k drop" % (
+                flowid, int(rate * 1024)),
+        )
+
+    def tcAddFilterBpf(self, dev, parent, handle, prog, action):
+
+        self.model.addKindFilter(
+            dev, parent, self.bpfPrio, "bpf", "0x%x" % handle,
+            'bytecode "%s"%s' % (bpf.bytecode(prog), action))
+
+    def tcAddFilterMark(self, dev, parent, mark, action):
+
+        self.model.addKindFilter(dev, parent, self.markPrio + 1, "fw",
+                                 "0x%x/0x%x" % (mark, markMask), action)
+
+    def tcAddFilterConnmark(self, dev):
+
+        # copies each incoming packet's connection mark onto it, for the
+        # fw filters after it
+        self.model.addKindFilter(dev, "ffff:", self.markPrio, "u32", None,
+                                 "match u32 0 0 action connmark continue")
+
     def log(self, level, msg):
 
         if level > self.verbosity:
@@ -13,6 +13,9 @@
 #
 
 
+import socket
+import struct
+
 import pyshaper
 
 
@@ -43,3 +46,17 @@ def splitflds(s):
         return []
     else:
         return pyshaper.reDelim.split(s)
+
+
+def addrToInt(addr):
+    """
+    Converts a dotted quad address string to a 32-bit int
+    """
+    return struct.unpack("!L", socket.inet_aton(addr))[0]
+
+
+def intToAddr(n):
+    """
+    Converts a 32-bit int address back to a dotted quad string
+    """
+    return socket.inet_ntoa(struct.pack("!L", n))
@@ -0,0 +1,320 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Classifies a whole table of connections in one go with NumPy, for
+boxes with so many sockets that even the compiled per-connection
+rules take too long
+
+Rules which only compare ports, addresses and pids against constants,
+or test addresses against prefix lists, are evaluated as boolean masks
+over the table's columns. Anything else (eg substring tests on cmd or
+args) falls back to running the compiled rule on each connection which
+hasn't already found a class
+
+Only used if NumPy is installed
+"""
+
+import ast
+import socket
+
+from pyshaper import rules
+from pyshaper.conn import Conn
+from pyshaper.util import addrToInt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# columns which can be compared against number literals
+intFields = ['lport', 'rport', 'pid']
+
+# columns holding addresses, which can be compared against dotted quads
+addrFields = ['laddr', 'raddr']
+
+compareOps = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+}
+
+
+class Columns:
+    """
+    The columns of a ConnTable which the masks get built from,
+    restricted to the rows being classified, and converted to NumPy
+    arrays only as they're needed
+    """
+
+    def __init__(self, table, rows):
+
+        self.table = table
+        self.rows = rows
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, field):
+
+        try:
+            return self.arrays[field]
+        except KeyError:
+            col = getattr(self.table, field)
+            arr = numpy.frombuffer(col, dtype=col.typecode)[self.rows]
+            self.arrays[field] = arr
+            return arr
+
+    def const(self, value):
+        """
+        Returns a mask which is value for every row
+        """
+        if value:
+            return numpy.ones(len(self.rows), dtype=bool)
+        return numpy.zeros(len(self.rows), dtype=bool)
+
+
+def fieldConst(field, node):
+    """
+    Converts literal node into a value which can be compared against
+    column field, or raises ValueError if it can't be
+    """
+    if field in intFields and isinstance(node, ast.Num):
+        return node.n
+    if field in addrFields and isinstance(node, ast.Str):
+        try:
+            return addrToInt(node.s)
+        except socket.error:
+            raise ValueError(node.s)
+    raise ValueError(node)
+
+
+def compileCompare(node):
+    """
+    Builds the mask function for a comparison, eg 'lport < 1024',
+    'raddr == "1.2.3.4"' or 'rport in (80, 443)'
+    """
+    terms = []
+    left = node.left
+    for op, right in zip(node.ops, node.comparators):
+        # get the field on the left, flipping the comparison if need be
+        if isinstance(left, ast.Name) and left.id in intFields + addrFields:
+            field, const = left.id, right
+        elif isinstance(right, ast.Name) and right.id in intFields + addrFields:
+            field, const = right.id, left
+            op = {ast.Lt: ast.Gt(), ast.LtE: ast.GtE(),
+                  ast.Gt: ast.Lt(), ast.GtE: ast.LtE()}.get(op.__class__, op)
+        else:
+            return None
+
+        if field in addrFields and not isinstance(op, (ast.Eq, ast.NotEq,
+                                                       ast.In, ast.NotIn)):
+            # addresses compare as strings, which isn't their numeric order
+            return None
+
+        try:
+            if isinstance(op, (ast.In, ast.NotIn)):
+                negate = isinstance(op, ast.NotIn)
+                if const is not right:
+                    return None
+                if field in addrFields and hasattr(const, 'trie'):
+                    # a prefix list or CIDR block - see rules.PrefixRewriter
+                    terms.append(rangeMask(field, const.trie.ranges(), negate))
+                elif isinstance(const, (ast.Tuple, ast.List)):
+                    values = [fieldConst(field, elt) for elt in const.elts]
+                    terms.append(memberMask(field, values, negate))
+                else:
+                    return None
+            else:
+                terms.append(compareMask(field, compareOps[op.__class__],
+                                         fieldConst(field, const)))
+        except (ValueError, KeyError):
+            return None
+        left = right
+
+    return andMasks(terms)
+
+
+def compareMask(field, compare, value):
+
+    def mask(cols):
+        return compare(cols.get(field), value)
+    return mask
+
+
+def memberMask(field, values, negate):
+
+    values = numpy.array(values)
+
+    def mask(cols):
+        m = numpy.in1d(cols.get(field), values)
+        if negate:
+            return ~m
+        return m
+    return mask
+
+
+def rangeMask(field, ranges, negate):
+
+    starts = numpy.array([first for first, last in ranges], dtype=numpy.uint64)
+    ends = numpy.array([last for first, last in ranges], dtype=numpy.uint64)
+
+    def mask(cols):
+        col = cols.get(field)
+        if not len(starts):
+            m = cols.const(False)
+        else:
+            # the range starting at or below each address, if any
+            idx = numpy.searchsorted(starts, col, side='right') - 1
+            m = (idx >= 0) & (col <= ends[idx.clip(0)])
+        if negate:
+            return ~m
+        return m
+    return mask
+
+
+def andMasks(terms):
+
+    def mask(cols):
+        m = terms[0](cols)
+        for term in terms[1:]:
+            m = m & term(cols)
+        return m
+    return mask
+
+
+def orMasks(terms):
+
+    def mask(cols):
+        m = terms[0](cols)
+        for term in terms[1:]:
+            m = m | term(cols)
+        return m
+    return mask
+
+
+def notMask(term):
+
+    def mask(cols):
+        return ~term(cols)
+    return mask
+
+
+def constMask(value):
+
+    def mask(cols):
+        return cols.const(value)
+    return mask
+
+
+def compileMask(node):
+    """
+    Compiles a test's syntax tree into a function which takes a
+    Columns and returns a boolean array, True for each row which
+    passes the test - or returns None if the test can't be vectorised
+    """
+    if isinstance(node, ast.BoolOp):
+        terms = [compileMask(value) for value in node.values]
+        if None in terms:
+            return None
+        if isinstance(node.op, ast.And):
+            return andMasks(terms)
+        return orMasks(terms)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        term = compileMask(node.operand)
+        if term is None:
+            return None
+        return notMask(term)
+
+    if isinstance(node, ast.Compare):
+        return compileCompare(node)
+
+    if isinstance(node, ast.Name) and node.id in ('True', 'False'):
+        return constMask(node.id == 'True')
+
+    return None
+
+
+class VectorClassifier:
+    """
+    Classifies many connections on one interface at a time
+
+    The interface's classes are split into runs of consecutive classes
+    whose tests can be vectorised, and the classes in between which
+    can't. The masks for each run get stacked, and an argmax down them
+    gives each row the first class in the run it matches. The other
+    classes have their compiled rule run per connection, on just the
+    rows which haven't matched anything yet
+    """
+
+    def __init__(self, iface):
+
+        # list of ('mask', [(class index, mask func), ...]) and
+        # ('row', class index, test func) steps, in the order to try them
+        self.steps = []
+
+        run = None
+        for i, test in rules.classTests(iface):
+            mask = compileMask(test)
+            if mask is not None:
+                if run is None:
+                    run = []
+                    self.steps.append(('mask', run))
+                run.append((i, mask))
+            else:
+                run = None
+                self.steps.append(('row', i, rules.compileTests(
+                    "%s:%s" % (iface.name, i), [(i, test)])))
+
+    def classify(self, table, rows):
+        """
+        Classifies the connections in the given rows of ConnTable table,
+        returning an array of the index of the class each belongs in,
+        or -1 for the default class
+        """
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        cols = Columns(table, rows)
+        result = numpy.empty(len(rows), dtype=numpy.intp)
+        result.fill(-1)
+        if not len(rows):
+            return result
+        todo = numpy.ones(len(rows), dtype=bool)
+
+        for step in self.steps:
+            if not todo.any():
+                break
+
+            if step[0] == 'mask':
+                run = step[1]
+                stacked = numpy.vstack([mask(cols) for i, mask in run])
+                matched = stacked.any(axis=0) & todo
+                first = stacked.argmax(axis=0)
+                indexes = numpy.array([i for i, mask in run], dtype=numpy.intp)
+                result[matched] = indexes[first[matched]]
+                todo &= ~matched
+
+            else:
+                i, check = step[1], step[2]
+                for pos in numpy.flatnonzero(todo):
+                    if check(Conn(table, int(rows[pos]))) >= 0:
+                        result[pos] = i
+                        todo[pos] = False
+
+        return result
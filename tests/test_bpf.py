@@ -0,0 +1,196 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for the bpf programs, run on made up packets by a small classic
+BPF interpreter
+"""
+
+import socket
+import struct
+import unittest
+
+from pyshaper import bpf
+from pyshaper.bpf import BpfError, Classifier
+
+
+def packet(src, sport, dst, dport, proto=bpf.IPPROTO_TCP, frag=0, ihl=5):
+    """
+    Builds the network header end of an IPv4 packet
+    """
+    hdr = struct.pack("!BBHHHBBH4s4s", 0x40 | ihl, 0, 40, 0, frag, 64, proto,
+                      0, socket.inet_aton(src), socket.inet_aton(dst))
+    hdr += "\0" * (ihl * 4 - len(hdr))
+    return hdr + struct.pack("!HH", sport, dport) + "\0" * 16
+
+
+def run(prog, pkt):
+    """
+    Runs prog on pkt the way the kernel does, returning what it returns
+    """
+    sizes = {bpf.BPF_W: "!L", bpf.BPF_H: "!H", bpf.BPF_B: "!B"}
+
+    def load(size, off):
+        fmt = sizes[size]
+        if off < 0 or off + struct.calcsize(fmt) > len(pkt):
+            return None
+        return struct.unpack_from(fmt, pkt, off)[0]
+
+    def netOff(k):
+        if k >= 0x80000000L:
+            k -= 0x100000000L
+        return k - bpf.SKF_NET_OFF
+
+    a = x = 0
+    mem = [0] * 16
+    pc = 0
+    steps = 0
+    while True:
+        steps += 1
+        assert steps <= len(prog), "program loops"
+        code, jt, jf, k = prog[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls == bpf.BPF_RET:
+            return k
+        elif cls == bpf.BPF_LD:
+            mode = code & 0xe0
+            if mode == bpf.BPF_MEM:
+                a = mem[k]
+            else:
+                off = netOff(k)
+                if mode == bpf.BPF_IND:
+                    off += x
+                a = load(code & 0x18, off)
+                if a is None:
+                    return 0
+        elif cls == bpf.BPF_LDX:
+            x = (load(bpf.BPF_B, netOff(k)) & 0xf) * 4
+        elif cls == bpf.BPF_ST:
+            mem[k] = a
+        elif cls == bpf.BPF_ALU:
+            assert code & 0xf0 == bpf.BPF_AND
+            a &= k
+        elif cls == bpf.BPF_JMP:
+            # jumps only ever go forwards
+            assert 0 <= jt <= 255 and 0 <= jf <= 255
+            op = code & 0xf0
+            if op == bpf.BPF_JA:
+                pc += k
+                continue
+            if op == bpf.BPF_JEQ:
+                taken = a == k
+            elif op == bpf.BPF_JGE:
+                taken = a >= k
+            else:
+                taken = a & k != 0
+            if taken:
+                pc += jt
+            else:
+                pc += jf
+        else:
+            raise AssertionError("unexpected instruction %r" % (prog[pc - 1],))
+
+
+def conns(n):
+    """
+    Returns n made up connections, (laddr, lport, raddr, rport), some
+    of them sharing a remote address
+    """
+    found = []
+    for i in range(n):
+        raddr = "10.%d.%d.%d" % (i % 7, i / 7 % 250, i % 3 + 1)
+        found.append(("192.168.1.%d" % (i % 2 + 1), 1024 + i,
+                      raddr, [80, 443, 22][i % 3]))
+    return found
+
+
+class ProgramTest(unittest.TestCase):
+
+    def testConnections(self):
+        # enough connections that the search tree needs long jumps
+        egress = Classifier(True)
+        ingress = Classifier(False)
+        connList = conns(200)
+        for i, (laddr, lport, raddr, rport) in enumerate(connList):
+            egress.addConn(0x10100 + i, laddr, lport, raddr, rport)
+            ingress.addConn(bpf.inClass, laddr, lport, raddr, rport)
+        out = egress.program()
+        into = ingress.program()
+        self.assertTrue([i for i in out if i[0] == bpf.BPF_JMP | bpf.BPF_JA])
+
+        for i, (laddr, lport, raddr, rport) in enumerate(connList):
+            self.assertEqual(run(out, packet(laddr, lport, raddr, rport)),
+                             0x10100 + i)
+            self.assertEqual(run(into, packet(raddr, rport, laddr, lport)),
+                             bpf.inClass)
+
+            # the same connection the other way round isn't a match
+            self.assertEqual(run(out, packet(raddr, rport, laddr, lport)), 0)
+            self.assertEqual(run(into, packet(laddr, lport, raddr, rport)), 0)
+
+        # nor are near misses
+        laddr, lport, raddr, rport = connList[10]
+        for pkt in [packet(laddr, lport + 1, raddr, rport),
+                    packet(laddr, lport, raddr, rport + 1),
+                    packet("192.168.1.9", lport, raddr, rport),
+                    packet(laddr, lport, "10.9.9.9", rport)]:
+            self.assertEqual(run(out, pkt), 0)
+
+    def testHeader(self):
+        prog = Classifier(True)
+        prog.addConn(7, "192.168.1.1", 1024, "10.0.0.1", 80)
+        prog = prog.program(nomatch=3)
+        self.assertEqual(run(prog, packet("192.168.1.1", 1024, "10.0.0.1", 80,
+                                          ihl=6)), 7)
+        self.assertEqual(run(prog, packet("192.168.1.1", 1024, "10.0.0.1", 80,
+                                          proto=17)), 3)
+        self.assertEqual(run(prog, packet("192.168.1.1", 1024, "10.0.0.1", 80,
+                                          frag=0x20)), 3)
+
+    def testRules(self):
+        prog = Classifier(True)
+        prog.addRule(1, raddr="10.1.0.0/16", rport=80)
+        prog.addRule(2, lport=22)
+        prog.addConn(3, "192.168.1.1", 22, "10.1.2.3", 80)
+        prog = prog.program()
+
+        # rules come first, in order
+        self.assertEqual(run(prog, packet("192.168.1.1", 22, "10.1.2.3", 80)), 1)
+        self.assertEqual(run(prog, packet("192.168.1.1", 22, "10.2.2.3", 80)), 2)
+        self.assertEqual(run(prog, packet("192.168.1.1", 23, "10.1.9.9", 80)), 1)
+        self.assertEqual(run(prog, packet("192.168.1.1", 23, "10.1.9.9", 81)), 0)
+
+        prog = Classifier(False)
+        prog.addRule(bpf.inClass, raddr="10.1.0.0/16", lport=8080)
+        prog = prog.program()
+        self.assertEqual(run(prog, packet("10.1.2.3", 5000, "192.168.1.1",
+                                          8080)), bpf.inClass)
+        self.assertEqual(run(prog, packet("192.168.1.1", 8080, "10.1.2.3",
+                                          5000)), 0)
+
+    def testTooLong(self):
+        prog = Classifier(True)
+        for i, (laddr, lport, raddr, rport) in enumerate(conns(400)):
+            prog.addConn(i, laddr, lport, raddr, rport)
+        self.assertRaises(BpfError, prog.program)
+        self.assertRaises(BpfError, prog.addRule, 1, raddr="10.0.0.0/33")
+
+    def testBytecode(self):
+        self.assertEqual(bpf.bytecode([(6, 0, 0, 0), (6, 0, 0, 0xffffffffL)]),
+                         "2,6 0 0 0,6 0 0 4294967295")
+
+
+if __name__ == '__main__':
+    unittest.main()
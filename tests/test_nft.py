@@ -0,0 +1,153 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for marking connections via nftables, run against FakeNft
+"""
+
+import unittest
+
+from pyshaper import nft
+from pyshaper.nft import FakeNft, NftModel, clearScript
+from pyshaper.tshaper import TShaper
+
+
+def model(conns):
+    """
+    Builds an NftModel for eth0, with classes 'web-in' and 'ssh', from
+    conns, a list of (class name, connection) pairs
+    """
+    marks = NftModel()
+    sets = {'web-in': marks.addSet('eth0', 'web-in', 0x101),
+            'ssh': marks.addSet('eth0', 'ssh', 0x102)}
+    for name, conn in conns:
+        sets[name].add(*conn)
+    return marks
+
+
+web1 = ('web-in', ('10.0.0.1', 80, '10.0.0.2', 40000))
+web2 = ('web-in', ('10.0.0.1', 80, '10.0.0.3', 40001))
+ssh1 = ('ssh', ('10.0.0.1', 22, '10.0.0.9', 50000))
+
+
+class Shaper(TShaper):
+    """
+    Just enough of a TShaper to apply marks, without root
+    """
+
+    def __init__(self):
+
+        self.verbosity = 0
+        self.debug = False
+        self.membership = {}
+        self.nftModel = None
+        self.nft = FakeNft()
+
+
+class NftModelTest(unittest.TestCase):
+
+    def testBuild(self):
+        script = model([web1, ssh1]).build()
+        lines = script.splitlines()
+        self.assertEqual(lines[:3], ["add table ip pyshaper",
+                                     "delete table ip pyshaper",
+                                     "add table ip pyshaper"])
+
+        # set names are cleaned up for nft
+        self.assertTrue("add set ip pyshaper eth0_web_in { type %s ; }"
+                        % nft.setType in lines)
+        self.assertTrue("add element ip pyshaper eth0_web_in "
+                        "{ 10.0.0.1 . 80 . 10.0.0.2 . 40000 }" in lines)
+        rules = [line for line in lines if "@eth0_ssh" in line]
+        self.assertEqual(len(rules), 2)
+        for rule in rules:
+            self.assertTrue("ct mark set ct mark and 0xffff0000 or 0x102"
+                            in rule)
+        self.assertTrue("meta mark set" in rules[0])
+
+    def testDiff(self):
+        old = model([web1, ssh1])
+        self.assertEqual(model([web1, ssh1]).diff(old), "")
+        self.assertEqual(model([web1, web2]).diff(old),
+                         "add element ip pyshaper eth0_web_in "
+                         "{ 10.0.0.1 . 80 . 10.0.0.3 . 40001 }\n"
+                         "delete element ip pyshaper eth0_ssh "
+                         "{ 10.0.0.1 . 22 . 10.0.0.9 . 50000 }\n")
+
+        # not knowing what's there, or a change of classes, means
+        # starting again
+        new = model([web1])
+        self.assertEqual(new.diff(None), new.build())
+        new.addSet('eth0', 'mail', 0x103)
+        self.assertEqual(new.diff(old), new.build())
+
+    def testElementCmds(self):
+        elements = ["1.2.3.4 . %d . 5.6.7.8 . 80" % port
+                    for port in range(2500)]
+        cmds = nft.elementCmds("add", "eth0_x", elements)
+        self.assertEqual(len(cmds), 3)
+        self.assertEqual([cmd.count(", ") + 1 for cmd in cmds],
+                         [1000, 1000, 500])
+
+
+class ApplyMarksTest(unittest.TestCase):
+
+    def testBatches(self):
+        shaper = Shaper()
+        batches = shaper.nft.batches
+
+        shaper.marks = model([web1])
+        shaper.applyMarks()
+        self.assertEqual(batches, [shaper.marks.build()])
+
+        # then only the changes
+        shaper.marks = model([web1, ssh1])
+        shaper.applyMarks()
+        self.assertEqual(batches[1].splitlines(), [
+            "add element ip pyshaper eth0_ssh "
+            "{ 10.0.0.1 . 22 . 10.0.0.9 . 50000 }"])
+
+        # and nothing at all when nothing's changed
+        shaper.marks = model([web1, ssh1])
+        shaper.applyMarks()
+        self.assertEqual(len(batches), 2)
+
+        # till no interface uses marks
+        shaper.marks = NftModel()
+        shaper.applyMarks()
+        self.assertEqual(batches[2], clearScript())
+        self.assertEqual(shaper.nftModel, None)
+        shaper.applyMarks()
+        self.assertEqual(len(batches), 3)
+
+    def testFailure(self):
+        shaper = Shaper()
+        shaper.marks = model([web1])
+        shaper.applyMarks()
+
+        # a failed batch means not knowing what's there, so the next
+        # one rebuilds the lot
+        shaper.nft.error = "Error: No such file or directory"
+        shaper.marks = model([web1, ssh1])
+        shaper.applyMarks()
+        self.assertEqual(shaper.nftModel, None)
+        self.assertEqual(shaper.membership, None)
+
+        shaper.applyMarks()
+        self.assertEqual(shaper.nft.batches[-1], shaper.marks.build())
+        self.assertTrue(shaper.nftModel is shaper.marks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for the socket inode index, run on a made up /proc
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyshaper.procfs import InodeIndex
+
+
+class InodeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.procdir = tempfile.mkdtemp()
+        self.uid = os.getuid()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.procdir)
+
+    def addProc(self, pid, inodes, starttime=100):
+        """
+        Makes process pid, with an fd for each socket inode in inodes
+        """
+        os.makedirs("%s/%d/fd" % (self.procdir, pid))
+        f = file("%s/%d/stat" % (self.procdir, pid), "w")
+        f.write("%d (x) S %s %d 0\n" % (pid, " ".join(["0"] * 18), starttime))
+        f.close()
+        for fd, inode in enumerate(inodes):
+            self.setFd(pid, fd, inode)
+
+    def setFd(self, pid, fd, inode):
+
+        path = "%s/%d/fd/%d" % (self.procdir, pid, fd)
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink("socket:[%d]" % inode, path)
+
+    def index(self):
+        """
+        Returns an InodeIndex on our /proc, and a list of the pids read
+        again by each rescan it does
+        """
+        index = InodeIndex(self.procdir)
+        rescans = []
+        rescan = index.rescan
+
+        def recordRescan(pids):
+            pids = list(pids)
+            pids.sort()
+            if pids:
+                rescans.append(pids)
+            rescan(pids)
+        index.rescan = recordRescan
+        return index, rescans
+
+    def testRefresh(self):
+        self.addProc(10, [1, 2])
+        self.addProc(11, [3])
+        index, rescans = self.index()
+        index.refresh([(1, self.uid), (3, self.uid)])
+        self.assertEqual((index.get(1), index.get(2), index.get(3)),
+                         (10, 10, 11))
+        self.assertEqual(rescans, [])
+
+        # closed fds, and exited processes, take their sockets with them
+        os.unlink("%s/10/fd/1" % self.procdir)
+        shutil.rmtree("%s/11" % self.procdir)
+        index.refresh()
+        self.assertEqual((index.get(1), index.get(2), index.get(3)),
+                         (10, None, None))
+
+        # as does a pid getting reused
+        shutil.rmtree("%s/10" % self.procdir)
+        self.addProc(10, [4], starttime=200)
+        index.refresh()
+        self.assertEqual((index.get(1), index.get(4)), (None, 10))
+        self.assertEqual(index.starttime(10), 200)
+
+    def testReusedFd(self):
+        self.addProc(10, [1])
+        self.addProc(11, [2])
+        index, rescans = self.index()
+        index.refresh()
+
+        # a new socket on an fd number we've seen gets found by reading
+        # the fds of its owner's processes again
+        self.setFd(11, 0, 5)
+        index.refresh([(5, self.uid)])
+        self.assertEqual(index.get(5), 11)
+        self.assertEqual(index.get(2), None)
+        self.assertEqual(rescans, [[10, 11]])
+
+        self.assertEqual(index.ownedBy({self.uid: 1}), index.procs.keys())
+        self.assertEqual(index.ownedBy({self.uid + 1: 1}), [])
+
+    def testOrphans(self):
+        self.addProc(10, [1])
+        index, rescans = self.index()
+
+        # sockets nobody owns get looked for once, not on every refresh
+        index.refresh([(1, self.uid), (500, self.uid)])
+        index.refresh([(1, self.uid), (500, self.uid), (600, None)])
+        self.assertEqual(rescans, [[10], [10]])
+        self.assertEqual(index.orphans, {500: 1, 600: 1})
+        index.refresh([(1, self.uid), (500, self.uid), (600, None)])
+        self.assertEqual(len(rescans), 2)
+
+        # and are forgotten once they're gone
+        index.refresh([(600, None)])
+        self.assertEqual(index.orphans, {600: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
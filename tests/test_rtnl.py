@@ -0,0 +1,391 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for the rtnetlink backend - the messages built for tc commands,
+batches run against FakeRtnlSocket, and dumps read back from it
+"""
+
+import errno
+import os
+import socket
+import struct
+import unittest
+
+from pyshaper import rtnl
+from pyshaper.rtnl import FakeRtnlSocket, NoDevice, Rtnl, RtnlError, \
+    decodeMessage, nlmsghdr, parseAttrs
+
+
+def fakeRtnl(errors=None):
+
+    fake = FakeRtnlSocket(errors=errors)
+    return fake, Rtnl(fake, fake.ifindex)
+
+
+def roundTrip(cmd):
+    """
+    Encodes tc command cmd, and decodes the message again
+    """
+    fake, sock = fakeRtnl()
+    msgtype, flags, body = sock.encode(cmd)
+    return decodeMessage(nlmsghdr.pack(nlmsghdr.size + len(body), msgtype,
+                                       flags, 0, 0) + body)
+
+
+def u32Keys(msg):
+    """
+    Returns the (mask, val, off, offmask) keys of a u32 filter message
+    """
+    sel = dict(msg['options'])[rtnl.TCA_U32_SEL]
+    keys = []
+    for i in range(ord(sel[2])):
+        pos = 16 + i * 16
+        keys.append(rtnl.u32KeyHead.unpack_from(sel, pos)
+                    + rtnl.u32KeyTail.unpack_from(sel, pos + 8))
+    return keys
+
+
+def actions(data):
+    """
+    Returns the actions in a filter's action list, as attribute dicts
+    """
+    return [dict(parseAttrs(action)) for order, action in parseAttrs(data)]
+
+
+class EncodeTest(unittest.TestCase):
+
+    def testHtbQdisc(self):
+        msg = roundTrip("qdisc add dev eth0 root handle 1: htb default 1000")
+        self.assertEqual(msg['type'], rtnl.RTM_NEWQDISC)
+        self.assertEqual(msg['flags'], rtnl.NLM_F_CREATE | rtnl.NLM_F_EXCL)
+        self.assertEqual(msg['ifindex'], 2)
+        self.assertEqual(msg['handle'], 0x10000)
+        self.assertEqual(msg['parent'], rtnl.TC_H_ROOT)
+        self.assertEqual(msg['kind'], 'htb')
+        glob = dict(msg['options'])[rtnl.TCA_HTB_INIT]
+        self.assertEqual(rtnl.htbGlob.unpack(glob)[:3], (3, 10, 0x1000))
+
+    def testIngressQdisc(self):
+        msg = roundTrip("qdisc add dev lo ingress handle ffff:")
+        self.assertEqual(msg['ifindex'], 1)
+        self.assertEqual(msg['handle'], 0xffff0000L)
+        self.assertEqual(msg['parent'], rtnl.TC_H_INGRESS)
+        self.assertEqual(msg['kind'], 'ingress')
+        self.assertEqual(msg['options'], None)
+
+    def testPrioQdisc(self):
+        msg = roundTrip("qdisc replace dev eth0 root handle 1: prio bands 2 "
+                        "priomap " + " ".join(["0"] * 16))
+        self.assertEqual(msg['flags'], rtnl.NLM_F_CREATE | rtnl.NLM_F_REPLACE)
+        self.assertEqual(rtnl.prioQopt.unpack(msg['options']),
+                         (2,) + (0,) * 16)
+        self.assertRaises(RtnlError, roundTrip,
+                          "qdisc add dev eth0 root prio bands 2 priomap "
+                          + " ".join(["2"] * 16))
+
+    def testHtbClass(self):
+        msg = roundTrip("class add dev eth0 parent 1:1 classid 1:101 htb "
+                        "rate 65536bit ceil 131072bit prio 3")
+        self.assertEqual(msg['type'], rtnl.RTM_NEWTCLASS)
+        self.assertEqual(msg['handle'], 0x10101)
+        self.assertEqual(msg['parent'], 0x10001)
+        opts = dict(msg['options'])
+        parms = opts[rtnl.TCA_HTB_PARMS]
+        self.assertEqual(struct.unpack_from("=L", parms, 8)[0], 8192)
+        self.assertEqual(struct.unpack_from("=L", parms, 20)[0], 16384)
+        self.assertEqual(struct.unpack_from("=L", parms, 40)[0], 3)
+        self.assertEqual(len(opts[rtnl.TCA_HTB_RTAB]), 1024)
+        self.assertEqual(len(opts[rtnl.TCA_HTB_CTAB]), 1024)
+
+        # rates too big for 32 bits go in attributes of their own
+        msg = roundTrip("class add dev eth0 parent 1: classid 1:1 htb "
+                        "rate 40gbit")
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=Q", opts[rtnl.TCA_HTB_RATE64])[0],
+                         5000000000L)
+
+    def testU32Filter(self):
+        msg = roundTrip("filter add dev eth0 parent 1: protocol ip prio 5 "
+                        "u32 match ip src 10.0.0.1 match ip sport 80 0xffff "
+                        "match ip dport 1234 0xffff flowid 1:101")
+        self.assertEqual(msg['type'], rtnl.RTM_NEWTFILTER)
+        self.assertEqual(msg['info'], (5 << 16) | socket.htons(rtnl.ETH_P_IP))
+        self.assertEqual(msg['kind'], 'u32')
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=L", opts[rtnl.TCA_U32_CLASSID])[0],
+                         0x10101)
+        self.assertEqual(ord(opts[rtnl.TCA_U32_SEL][0]), rtnl.TC_U32_TERMINAL)
+
+        # the ports share a word, so get merged into one key
+        self.assertEqual(u32Keys(msg), [
+            (0xffffffffL, 0x0a000001, 12, 0),
+            (0xffffffffL, (80 << 16) | 1234, 20, 0),
+        ])
+
+    def testU32Matches(self):
+        msg = roundTrip("filter add dev eth0 parent 1: prio 1 u32 "
+                        "match ip protocol 6 0xff match ip dst 10.1.0.0/16 "
+                        "match u32 0x12 0xff at 8")
+        # the protocol byte is at 9, in the word starting at 8
+        self.assertEqual(u32Keys(msg), [
+            (0x00ff00ffL, 0x00060012, 8, 0),
+            (0xffff0000L, 0x0a010000, 16, 0),
+        ])
+
+        self.assertRaises(RtnlError, roundTrip,
+                          "filter add dev eth0 parent 1: prio 1 u32 "
+                          "match ip sport 80 0xffff match ip sport 81 0xffff")
+        self.assertRaises(RtnlError, roundTrip,
+                          "filter add dev eth0 parent 1: prio 1 u32 "
+                          "match u32 1 1 at 2")
+        self.assertRaises(RtnlError, roundTrip,
+                          "filter add dev eth0 parent 1: prio 1 u32 "
+                          "match ip src 10.0.0.300")
+
+    def testU32Tables(self):
+        msg = roundTrip("filter add dev eth0 parent 1: prio 5 handle 100: "
+                        "u32 divisor 256")
+        self.assertEqual(msg['handle'], 0x10000000)
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=L", opts[rtnl.TCA_U32_DIVISOR])[0],
+                         256)
+
+        msg = roundTrip("filter add dev eth0 parent 1: prio 5 handle 800::1 "
+                        "u32 ht 800:: match u32 0 0 hashkey mask 0x000000ff "
+                        "at 16 link 100:")
+        self.assertEqual(msg['handle'], 0x80000001)
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=L", opts[rtnl.TCA_U32_LINK])[0],
+                         0x10000000)
+        self.assertEqual(struct.unpack("=L", opts[rtnl.TCA_U32_HASH])[0],
+                         0x80000000)
+        sel = opts[rtnl.TCA_U32_SEL]
+        self.assertEqual(struct.unpack_from("!L", sel, 12)[0], 0xff)
+        self.assertEqual(struct.unpack_from("=h", sel, 10)[0], 16)
+
+    def testPolice(self):
+        msg = roundTrip("filter add dev eth0 parent ffff: protocol ip prio 5 "
+                        "u32 match ip src 10.0.0.2 "
+                        "police rate 65536 burst 10k drop flowid ffff:101")
+        opts = dict(msg['options'])
+        police = dict(parseAttrs(opts[rtnl.TCA_U32_POLICE]))
+        tbf = police[rtnl.TCA_POLICE_TBF]
+        self.assertEqual(rtnl.policeHead.unpack_from(tbf)[1], rtnl.TC_ACT_SHOT)
+        self.assertEqual(struct.unpack_from("=L", tbf,
+                                            rtnl.policeHead.size + 8)[0], 8192)
+        self.assertEqual(len(police[rtnl.TCA_POLICE_RATE]), 1024)
+
+        self.assertRaises(RtnlError, roundTrip,
+                          "filter add dev eth0 parent ffff: prio 5 u32 "
+                          "match ip src 10.0.0.2 police burst 10k drop")
+
+    def testFlower(self):
+        msg = roundTrip("filter add dev eth0 parent ffff: protocol ip "
+                        "prio 784 flower ip_proto tcp src_ip 10.0.0.2 "
+                        "src_port 80 dst_ip 10.0.0.1 dst_port 1234 "
+                        "classid ffff:101 action police rate 65536 burst 10k "
+                        "drop")
+        self.assertEqual(msg['kind'], 'flower')
+        opts = dict(msg['options'])
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_ETH_TYPE], "\x08\x00")
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_IP_PROTO], "\x06")
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_IPV4_SRC],
+                         socket.inet_aton("10.0.0.2"))
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_IPV4_DST_MASK], "\xff" * 4)
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_TCP_SRC], "\x00\x50")
+        self.assertEqual(opts[rtnl.TCA_FLOWER_KEY_TCP_DST], "\x04\xd2")
+        acts = actions(opts[rtnl.TCA_FLOWER_ACT])
+        self.assertEqual([act[rtnl.TCA_ACT_KIND] for act in acts],
+                         ["police\0"])
+
+        self.assertRaises(RtnlError, roundTrip,
+                          "filter add dev eth0 parent 1: prio 784 flower "
+                          "src_port 80 ip_proto tcp")
+
+    def testBpf(self):
+        msg = roundTrip('filter add dev eth0 parent 1: prio 800 handle 0x1 '
+                        'bpf bytecode "2,6 0 0 0,6 0 0 65537," classid 1:1')
+        self.assertEqual(msg['handle'], 1)
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=H", opts[rtnl.TCA_BPF_OPS_LEN])[0], 2)
+        self.assertEqual(opts[rtnl.TCA_BPF_OPS],
+                         rtnl.sockFilter.pack(6, 0, 0, 0)
+                         + rtnl.sockFilter.pack(6, 0, 0, 65537))
+
+        self.assertRaises(RtnlError, roundTrip,
+                          'filter add dev eth0 parent 1: prio 800 bpf '
+                          'bytecode "3,6 0 0 0,6 0 0 1,"')
+
+    def testFw(self):
+        msg = roundTrip("filter add dev eth0 parent ffff: prio 769 "
+                        "handle 0x101/0xffff fw police rate 65536 burst 10k "
+                        "drop flowid ffff:101")
+        self.assertEqual(msg['handle'], 0x101)
+        opts = dict(msg['options'])
+        self.assertEqual(struct.unpack("=L", opts[rtnl.TCA_FW_MASK])[0], 0xffff)
+        self.assertTrue(rtnl.TCA_FW_POLICE in opts)
+
+    def testDelete(self):
+        msg = roundTrip("filter del dev eth0 parent 1: prio 5 handle 800::1 u32")
+        self.assertEqual(msg['type'], rtnl.RTM_DELTFILTER)
+        self.assertEqual(msg['flags'], 0)
+        self.assertEqual(msg['handle'], 0x80000001)
+        self.assertEqual(msg['options'], None)
+
+        msg = roundTrip("qdisc del dev eth0 root")
+        self.assertEqual(msg['type'], rtnl.RTM_DELQDISC)
+        self.assertEqual((msg['handle'], msg['parent']), (0, rtnl.TC_H_ROOT))
+
+    def testBadCommands(self):
+        fake, sock = fakeRtnl()
+        for cmd in ["qdisc add dev eth0 root tbf",
+                    "class add dev eth0 parent 1: classid 1:2 htb",
+                    "filter add dev eth0 parent 1: prio 1 u32 flowid",
+                    "filter add parent 1: prio 1 u32 flowid 1:1",
+                    "filter frob dev eth0 parent 1: prio 1 u32",
+                    "filter add dev eth0 parent 1: protocol ipv6 prio 1 u32"]:
+            self.assertRaises(RtnlError, sock.encode, cmd)
+        self.assertRaises(NoDevice, sock.encode,
+                          "qdisc add dev eth9 root handle 1: htb")
+
+
+class BatchTest(unittest.TestCase):
+
+    cmds = [
+        "qdisc add dev eth0 root handle 1: htb default 1000",
+        "class add dev eth0 parent 1: classid 1:1 htb rate 1mbit",
+        "class add dev eth0 parent 1:1 classid 1:101 htb rate 64kbit",
+        "filter add dev eth0 parent 1: protocol ip prio 1 u32 "
+        "match ip dst 10.0.0.1 flowid 1:101",
+        "qdisc add dev eth0 ingress handle ffff:",
+    ]
+
+    def testBatch(self):
+        fake, sock = fakeRtnl()
+        self.assertEqual(sock.runBatch(self.cmds), [])
+        self.assertEqual([msg['type'] for msg in fake.messages], [
+            rtnl.RTM_NEWQDISC, rtnl.RTM_NEWTCLASS, rtnl.RTM_NEWTCLASS,
+            rtnl.RTM_NEWTFILTER, rtnl.RTM_NEWQDISC])
+        for msg in fake.messages:
+            self.assertTrue(msg['flags'] & rtnl.NLM_F_ACK)
+        seqs = [msg['seq'] for msg in fake.messages]
+        self.assertEqual(len(dict.fromkeys(seqs)), len(seqs))
+
+    def testErrors(self):
+        fake, sock = fakeRtnl({1: (errno.EEXIST, None),
+                               3: (errno.EINVAL, "Invalid handle")})
+        self.assertEqual(sock.runBatch(self.cmds), [
+            (1, os.strerror(errno.EEXIST)),
+            (3, "Error: Invalid handle"),
+        ])
+
+        # the rest still get sent
+        self.assertEqual(len(fake.messages), len(self.cmds))
+
+    def testChunks(self):
+        fake, sock = fakeRtnl({2: (errno.ENOENT, None)})
+        sock.chunkSize = 1
+        self.assertEqual(sock.runBatch(self.cmds),
+                         [(2, os.strerror(errno.ENOENT))])
+        self.assertEqual(len(fake.messages), len(self.cmds))
+
+    def testNoDevice(self):
+        fake, sock = fakeRtnl({1: (errno.EINVAL, None)})
+        cmds = self.cmds[:1] + ["qdisc add dev eth9 root handle 1: htb"] \
+            + self.cmds[1:2]
+        self.assertEqual(sock.runBatch(cmds), [
+            (1, 'Cannot find device "eth9"'),
+            (2, os.strerror(errno.EINVAL)),
+        ])
+        self.assertEqual(len(fake.messages), 2)
+
+    def testBadSyntax(self):
+        # nothing gets sent if any command can't be encoded
+        fake, sock = fakeRtnl()
+        self.assertRaises(RtnlError, sock.runBatch,
+                          self.cmds + ["qdisc add dev eth0 root tbf"])
+        self.assertEqual(fake.messages, [])
+
+    def testClosed(self):
+        fake, sock = fakeRtnl()
+        fake.recv = lambda bufsize: ""
+        self.assertRaises(socket.error, sock.runBatch, self.cmds)
+        self.assertEqual(sock.sock, None)
+
+
+class DumpTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.fake, self.sock = fakeRtnl()
+        self.assertEqual(self.sock.runBatch(BatchTest.cmds + [
+            "filter add dev eth0 parent ffff: protocol ip prio 784 flower "
+            "ip_proto tcp src_ip 10.0.0.2 classid ffff:101 "
+            "action police rate 64kbit burst 10k drop",
+            "qdisc add dev lo root handle 1: htb",
+        ]), [])
+
+    def testDump(self):
+        sock = self.sock
+        qdiscs = sock.dump(rtnl.RTM_GETQDISC, 'eth0')
+        self.assertEqual([(msg['kind'], msg['handle']) for msg in qdiscs],
+                         [('htb', 0x10000), ('ingress', 0xffff0000L)])
+        classes = sock.dump(rtnl.RTM_GETTCLASS, 'eth0')
+        self.assertEqual([msg['handle'] for msg in classes],
+                         [0x10001, 0x10101])
+        filters = sock.dump(rtnl.RTM_GETTFILTER, 'eth0', 0x10000)
+        self.assertEqual([msg['kind'] for msg in filters], ['u32'])
+        filters = sock.dump(rtnl.RTM_GETTFILTER, 'eth0', 0xffff0000L)
+        self.assertEqual([msg['kind'] for msg in filters], ['flower'])
+        self.assertEqual(filters[0]['bytes'], None)
+
+        self.assertRaises(NoDevice, sock.dump, rtnl.RTM_GETQDISC, 'eth9')
+
+    def testCounts(self):
+        for obj in self.fake.objects:
+            obj['bytes'] = obj['handle'] & 0xffff
+
+        classes = self.sock.dump(rtnl.RTM_GETTCLASS, 'eth0')
+        self.assertEqual([msg['bytes'] for msg in classes], [1, 0x101])
+
+        # counts of an action go inside it, not at the top
+        filt = self.sock.dump(rtnl.RTM_GETTFILTER, 'eth0', 0xffff0000L)[0]
+        self.assertEqual(filt['bytes'], None)
+        act = actions(dict(filt['options'])[rtnl.TCA_FLOWER_ACT])[0]
+        stats = dict(parseAttrs(act[rtnl.TCA_ACT_STATS]))
+        self.assertEqual(rtnl.tcStats.unpack_from(
+            stats[rtnl.TCA_STATS_BASIC])[0], filt['handle'] & 0xffff)
+
+    def testChanges(self):
+        sock = self.sock
+        self.assertEqual(sock.runBatch([
+            "class change dev eth0 parent 1:1 classid 1:101 htb rate 128kbit",
+            "filter del dev eth0 parent 1: prio 1",
+        ]), [])
+        classes = sock.dump(rtnl.RTM_GETTCLASS, 'eth0')
+        self.assertEqual(len(classes), 2)
+        parms = dict(classes[1]['options'])[rtnl.TCA_HTB_PARMS]
+        self.assertEqual(struct.unpack_from("=L", parms, 8)[0], 16000)
+        self.assertEqual(sock.dump(rtnl.RTM_GETTFILTER, 'eth0', 0x10000), [])
+
+        # and deleting a qdisc takes everything under it
+        self.assertEqual(sock.runBatch(["qdisc del dev eth0 root"]), [])
+        self.assertEqual(sock.dump(rtnl.RTM_GETTCLASS, 'eth0'), [])
+        self.assertEqual(len(sock.dump(rtnl.RTM_GETQDISC, 'eth0')), 1)
+        self.assertEqual(len(sock.dump(rtnl.RTM_GETQDISC, 'lo')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
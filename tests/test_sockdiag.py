@@ -0,0 +1,126 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for the sock_diag backend, run against FakeNetlinkSocket
+"""
+
+import errno
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pyshaper import procfs, sockdiag
+from pyshaper.sockdiag import FakeNetlinkSocket, RecordingSocket, SockDiag, \
+    SockDiagError, nlmsghdr
+
+
+rows = [
+    (0x7f000001, 40001, 0x7f000001, 51234, procfs.TCP_ESTABLISHED, 1000, 4321),
+    (0xc0a80102, 22, 0x0a000001, 60000, procfs.TCP_CLOSE_WAIT, 0, 99),
+    (0xc0a80102, 8080, 0xffffffffL, 65535, procfs.TCP_TIME_WAIT, 65534, 0),
+]
+
+
+def errorMsg(err, seq=0):
+    """
+    Builds the NLMSG_ERROR the kernel sends back for a failed request
+    """
+    body = struct.pack("=l", -err) + nlmsghdr.pack(nlmsghdr.size, 0, 0, seq, 0)
+    return nlmsghdr.pack(nlmsghdr.size + len(body), sockdiag.NLMSG_ERROR, 0,
+                         seq, 0) + body
+
+
+class SockDiagTest(unittest.TestCase):
+
+    def testEncodeDecode(self):
+        for row in rows:
+            msg = sockdiag.encodeDiagMsg(*row)
+            self.assertEqual(nlmsghdr.unpack_from(msg)[0], len(msg))
+            self.assertEqual(sockdiag.decodeDiagMsg(msg[nlmsghdr.size:]), row)
+
+    def testRequest(self):
+        diag = SockDiag(FakeNetlinkSocket([]))
+        msg = diag.request(states=1 << procfs.TCP_ESTABLISHED)
+        msglen, msgtype, flags, seq, pid = nlmsghdr.unpack_from(msg)
+        self.assertEqual(msglen, len(msg))
+        self.assertEqual(msgtype, sockdiag.SOCK_DIAG_BY_FAMILY)
+        self.assertEqual(flags, sockdiag.NLM_F_REQUEST | sockdiag.NLM_F_DUMP)
+        self.assertEqual(seq, 1)
+        self.assertEqual(diag.request()[8:12], struct.pack("=L", 2))
+
+        family, protocol, ext, pad, states = sockdiag.inetDiagReq.unpack_from(
+            msg, nlmsghdr.size)
+        self.assertEqual(protocol, 6)
+        self.assertEqual(states, 1 << procfs.TCP_ESTABLISHED)
+
+    def testDump(self):
+        fake = FakeNetlinkSocket.fromRows(rows)
+        diag = SockDiag(fake)
+        self.assertEqual(list(diag.dump()), rows)
+
+        # replies get the sequence number of each new request
+        self.assertEqual(list(diag.dump()), rows)
+        self.assertEqual(len(fake.requests), 2)
+
+    def testSplitReplies(self):
+        # one message per datagram, as a big dump arrives
+        replies = [sockdiag.encodeDiagMsg(*row) for row in rows]
+        diag = SockDiag(FakeNetlinkSocket(replies + [sockdiag.encodeDone()]))
+        self.assertEqual(list(diag.dump()), rows)
+
+    def testStaleReplies(self):
+        # leftovers of an earlier dump, with another sequence number,
+        # get skipped
+        fake = FakeNetlinkSocket.fromRows(rows[:1])
+        diag = SockDiag(fake)
+        stale = sockdiag.encodeDiagMsg(*rows[1])
+        fake.reseq = lambda data, seq: data
+        fake.replies = [stale, sockdiag.encodeDiagMsg(*rows[0], seq=1)
+                        + sockdiag.encodeDone(1)]
+        self.assertEqual(list(diag.dump()), rows[:1])
+
+    def testError(self):
+        diag = SockDiag(FakeNetlinkSocket([errorMsg(errno.EPERM)]))
+        self.assertRaises(SockDiagError, list, diag.dump())
+
+        # an ACK with no error doesn't end the dump
+        replies = [errorMsg(0), sockdiag.encodeDiagMsg(*rows[0])
+                   + sockdiag.encodeDone()]
+        diag = SockDiag(FakeNetlinkSocket(replies))
+        self.assertEqual(list(diag.dump()), rows[:1])
+
+    def testClosed(self):
+        diag = SockDiag(FakeNetlinkSocket([sockdiag.encodeDiagMsg(*rows[0])]))
+        self.assertRaises(SockDiagError, list, diag.dump())
+
+    def testRecording(self):
+        # record a dump, and replay it
+        recorder = RecordingSocket(FakeNetlinkSocket.fromRows(rows))
+        self.assertEqual(list(SockDiag(recorder).dump()), rows)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "dump")
+            recorder.save(path)
+            diag = SockDiag(FakeNetlinkSocket.load(path))
+            self.assertEqual(list(diag.dump()), rows)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for the tc model, and the commands its diffs come up with
+"""
+
+import unittest
+
+from pyshaper import tcmodel
+from pyshaper.tcmodel import TcModel, TcModelError
+
+
+ingressPolice = "police rate 32768 burst 10k drop flowid ffff:101"
+
+
+def model(conns, gen=None, rate="64kbit"):
+    """
+    Builds a model for eth0, with class 1:101 shaping conns, a list of
+    (raddr, rport) pairs, in both directions
+    """
+    tc = TcModel()
+    if gen is not None:
+        tc.setGen('eth0', gen)
+        root = "%s:" % tcmodel.swapMajors[gen]
+        tc.addQdisc('eth0', tcmodel.swapRoot)
+        tc.addQdisc('eth0', "parent %s handle %s htb default 1000" % (
+            tcmodel.swapBands[gen], root))
+    else:
+        root = "1:"
+        tc.addQdisc('eth0', "root handle 1: htb default 1000")
+    tc.addQdisc('eth0', "ingress")
+    tc.addClass('eth0', "parent %s classid %s1 htb rate 1mbit" % (root, root))
+    tc.addClass('eth0', "parent %s1 classid %s101 htb rate %s" % (
+        root, root, rate))
+    for raddr, rport in conns:
+        tc.addFilter('eth0', root, 1,
+                     "match ip dst %s match ip dport %s 0xffff" % (raddr, rport),
+                     "flowid %s101" % root, hashOn="dst")
+        tc.addFilter('eth0', "ffff:", 1,
+                     "match ip src %s match ip sport %s 0xffff" % (raddr, rport),
+                     ingressPolice, hashOn="src")
+    return tc
+
+
+def commands(cmds):
+    return [cmd for cmd, quiet in cmds]
+
+
+class DiffTest(unittest.TestCase):
+
+    def testBuild(self):
+        cmds = model([("10.0.0.2", 80)]).diff(None)
+        self.assertEqual(cmds[:2], [("qdisc del dev eth0 root", True),
+                                    ("qdisc del dev eth0 ingress", True)])
+        self.assertEqual([quiet for cmd, quiet in cmds[2:]],
+                         [False] * (len(cmds) - 2))
+        cmds = commands(cmds)
+        self.assertEqual(cmds[2:6], [
+            "qdisc add dev eth0 root handle 1: htb default 1000",
+            "qdisc add dev eth0 ingress",
+            "class add dev eth0 parent 1: classid 1:1 htb rate 1mbit",
+            "class add dev eth0 parent 1:1 classid 1:101 htb rate 64kbit",
+        ])
+
+        # filters on one address go in its bucket of the hashed table
+        self.assertTrue("filter add dev eth0 parent 1: protocol ip prio 1 "
+                        "handle 401:2:1 u32 ht 401:2: match ip dst 10.0.0.2 "
+                        "match ip dport 80 0xffff flowid 1:101" in cmds)
+        self.assertTrue("filter add dev eth0 parent ffff: protocol ip prio 1 "
+                        "handle 401:2:1 u32 ht 401:2: match ip src 10.0.0.2 "
+                        "match ip sport 80 0xffff " + ingressPolice in cmds)
+
+    def testNoChange(self):
+        old = model([("10.0.0.2", 80)])
+        old.diff(None)
+        self.assertEqual(model([("10.0.0.2", 80)]).diff(old), [])
+
+    def testFilters(self):
+        old = model([("10.0.0.2", 80), ("10.0.1.2", 443)])
+        old.diff(None)
+        new = model([("10.0.1.2", 443), ("10.0.2.2", 22)])
+        cmds = commands(new.diff(old))
+        self.assertEqual(cmds, [
+            "filter del dev eth0 parent 1: protocol ip prio 1 "
+            "handle 401:2:1 u32",
+            "filter del dev eth0 parent ffff: protocol ip prio 1 "
+            "handle 401:2:1 u32",
+            # the connection we still have keeps its handle, 401:2:2,
+            # and the new one gets the first free node in the bucket
+            "filter add dev eth0 parent 1: protocol ip prio 1 "
+            "handle 401:2:1 u32 ht 401:2: match ip dst 10.0.2.2 "
+            "match ip dport 22 0xffff flowid 1:101",
+            "filter add dev eth0 parent ffff: protocol ip prio 1 "
+            "handle 401:2:1 u32 ht 401:2: match ip src 10.0.2.2 "
+            "match ip sport 22 0xffff " + ingressPolice,
+        ])
+
+        # changes of action are made in place
+        newer = model([("10.0.1.2", 443), ("10.0.2.2", 22)], rate="128kbit")
+        newer.addFilter('eth0', "ffff:", 1,
+                        "match ip src 10.0.1.2 match ip sport 443 0xffff",
+                        ingressPolice.replace("32768", "65536"), hashOn="src")
+        self.assertEqual(commands(newer.diff(new)), [
+            "class change dev eth0 parent 1:1 classid 1:101 htb rate 128kbit",
+            "filter replace dev eth0 parent ffff: protocol ip prio 1 "
+            "handle 401:2:2 u32 ht 401:2: match ip src 10.0.1.2 "
+            "match ip sport 443 0xffff "
+            + ingressPolice.replace("32768", "65536"),
+        ])
+
+    def testClassGone(self):
+        old = model([("10.0.0.2", 80)])
+        old.diff(None)
+        new = TcModel()
+        new.addQdisc('eth0', "root handle 1: htb default 1000")
+        new.addQdisc('eth0', "ingress")
+        new.addClass('eth0', "parent 1: classid 1:1 htb rate 1mbit")
+        cmds = commands(new.diff(old))
+
+        # the filters pointing at the class go first
+        self.assertEqual(cmds, [
+            "filter del dev eth0 parent 1: protocol ip prio 1",
+            "filter del dev eth0 parent ffff: protocol ip prio 1",
+            "class del dev eth0 classid 1:101",
+        ])
+
+    def testFlower(self):
+        old = TcModel()
+        old.addQdisc('eth0', "ingress")
+        for port in [80, 443]:
+            old.addFlowerFilter('eth0', "ffff:", 0x310,
+                                "ip_proto tcp src_port %s" % port,
+                                "classid ffff:101")
+        old.diff(None)
+        new = TcModel()
+        new.addQdisc('eth0', "ingress")
+        for port in [443, 22]:
+            new.addFlowerFilter('eth0', "ffff:", 0x310,
+                                "ip_proto tcp src_port %s" % port,
+                                "classid ffff:101")
+        self.assertEqual(commands(new.diff(old)), [
+            "filter del dev eth0 parent ffff: protocol ip prio 784 "
+            "handle 0x1 flower",
+            "filter add dev eth0 parent ffff: protocol ip prio 784 "
+            "handle 0x1 flower ip_proto tcp src_port 22 classid ffff:101",
+        ])
+
+    def testPrios(self):
+        tc = TcModel()
+        self.assertRaises(TcModelError, tc.addFilter, 'eth0', "1:", -1,
+                          "match ip dst 10.0.0.2", "flowid 1:101")
+        self.assertRaises(TcModelError, tc.addFilter, 'eth0', "1:",
+                          tcmodel.maxFilterPrio, "match ip dst 10.0.0.2",
+                          "flowid 1:101")
+        self.assertRaises(TcModelError, tc.addKindFilter, 'eth0', "1:", 0x2ff,
+                          "fw", "0x101/0xffff", "flowid 1:101")
+
+        # the second tree's ingress filters sit further down, which
+        # has to stay clear of the kind filters' prios
+        tc.setGen('eth0', 1)
+        tc.addFilter('eth0', "ffff:", tcmodel.maxFilterPrio - 1,
+                     "match ip src 10.0.0.2", ingressPolice)
+        self.assertEqual(tc.dev('eth0').ingressPrios(), [0x2ff])
+
+
+class SwapTest(unittest.TestCase):
+
+    def testSwap(self):
+        old = model([("10.0.0.2", 80)], gen=0)
+        cmds = commands(old.diff(None))
+        self.assertEqual(cmds[-1], "filter add dev eth0 parent 1: protocol all "
+                         "prio 1 handle 800::800 u32 match u32 0 0 flowid 1:1")
+        self.assertEqual(tcmodel.nextGen(old, 'eth0'), 0)
+
+        # the next tree gets built next to the old one, which is left
+        # alone
+        new = model([("10.0.0.2", 80)], gen=1)
+        cmds = new.diff(old)
+        self.assertEqual(cmds[:2], [
+            ("qdisc del dev eth0 parent 1:2", True),
+            ("filter del dev eth0 parent ffff: protocol ip prio 257", True),
+        ])
+        for cmd, quiet in cmds:
+            self.assertFalse("qdisc del dev eth0 root" in cmd)
+            self.assertFalse("parent 2:" in cmd)
+            self.assertFalse("ffff: protocol ip prio 1 " in cmd)
+        self.assertTrue(("qdisc add dev eth0 parent 1:2 handle 3: htb "
+                         "default 1000", False) in cmds)
+
+        # then switched over to, and the old ingress filters retired
+        self.assertEqual(new.swapCmds(old), [(
+            'eth0',
+            ("filter replace dev eth0 parent 1: protocol all prio 1 "
+             "handle 800::800 u32 match u32 0 0 flowid 1:2", False),
+            [("filter del dev eth0 parent ffff: protocol ip prio 1", True)],
+        )])
+
+    def testFailed(self):
+        old = model([("10.0.0.2", 80)], gen=0)
+        old.diff(None)
+        new = model([("10.0.0.2", 80)], gen=1)
+        new.diff(old)
+
+        # not switched over, so still on the old tree
+        self.assertTrue(new.failed(old, []).devs['eth0'] is old.devs['eth0'])
+        self.assertTrue(new.failed(old, ['eth0']).devs['eth0']
+                        is new.devs['eth0'])
+
+        # the new tree only part built, which the next run has to
+        # start again on
+        self.assertTrue(new.failed(old, None).devs['eth0'] is old.devs['eth0'])
+        self.assertEqual(commands(new.abandonCmds(old))[0],
+                         "qdisc del dev eth0 parent 1:2")
+
+        broken = model([("10.0.0.2", 80)], gen=0)
+        broken.diff(None)
+        broken = broken.failed(None, None)
+        self.assertTrue(broken.devs['eth0'].broken)
+        self.assertEqual(tcmodel.nextGen(broken, 'eth0'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for reading back the tc setup and finding drift, run against
+FakeRtnlSocket
+"""
+
+import unittest
+
+from pyshaper import tcstate
+from pyshaper.rtnl import FakeRtnlSocket, Rtnl
+from pyshaper.tcmodel import TcModel
+
+
+def model(prio=1):
+    """
+    Builds a model for eth0, with class 1:101 shaping one connection
+    """
+    tc = TcModel()
+    tc.addQdisc('eth0', "root handle 1: htb default 1000")
+    tc.addQdisc('eth0', "ingress")
+    tc.addClass('eth0', "parent 1: classid 1:1 htb rate 1mbit")
+    tc.addClass('eth0', "parent 1:1 classid 1:101 htb rate 64kbit prio %s"
+                % prio)
+    tc.addFilter('eth0', "1:", 1, "match ip dst 10.0.0.2 match ip dport 80 "
+                 "0xffff", "flowid 1:101", hashOn="dst")
+    tc.addFilter('eth0', "ffff:", 1, "match ip src 10.0.0.2 match ip sport 80 "
+                 "0xffff", "police rate 32768 burst 10k drop flowid ffff:101",
+                 hashOn="src")
+    return tc
+
+
+class VerifyTest(unittest.TestCase):
+
+    def apply(self, prio=1):
+        """
+        Applies a model to a FakeRtnlSocket, returning the model and an
+        Rtnl talking to the fake
+        """
+        fake = FakeRtnlSocket()
+        sock = Rtnl(fake, fake.ifindex)
+        applied = model(prio)
+        self.assertEqual(sock.runBatch([cmd for cmd, quiet
+                                        in applied.diff(None)]), [])
+        return applied, sock
+
+    def testNoDrift(self):
+        applied, sock = self.apply()
+        found, drift = tcstate.verify(sock, applied)
+        self.assertEqual(drift, [])
+        self.assertEqual(model().diff(found), [])
+
+    def testDrift(self):
+        applied, sock = self.apply()
+        self.assertEqual(sock.runBatch([
+            "class change dev eth0 parent 1:1 classid 1:101 htb rate 128kbit",
+            "filter del dev eth0 parent ffff: protocol ip prio 1 "
+            "handle 401:2:1 u32",
+        ]), [])
+        found, drift = tcstate.verify(sock, applied)
+        self.assertEqual(drift, [
+            "eth0: class 1:101 changed",
+            "eth0: filter 401:2:1 at ffff: prio 1 missing",
+        ])
+
+        # and diffing against what's there puts just those right
+        cmds = [cmd for cmd, quiet in model().diff(found)]
+        self.assertEqual(len(cmds), 2)
+        self.assertEqual(cmds[0], "class change dev eth0 parent 1:1 "
+                         "classid 1:101 htb rate 64kbit prio 1")
+        self.assertTrue(cmds[1].startswith("filter add dev eth0 parent ffff: "
+                                           "protocol ip prio 1 handle 401:2:1"))
+
+    def testHtbPrio(self):
+        # htb keeps prios above 7 as 7, which isn't drift
+        applied, sock = self.apply(prio=10)
+        self.assertEqual(sock.runBatch([
+            "class change dev eth0 parent 1:1 classid 1:101 htb rate 64kbit "
+            "prio 7"]), [])
+        self.assertEqual(tcstate.verify(sock, applied)[1], [])
+
+    def testNoDevice(self):
+        applied, sock = self.apply()
+        applied.addQdisc('eth9', "root handle 1: htb default 1000")
+        found, drift = tcstate.verify(sock, applied)
+        self.assertEqual(drift, ["eth9: no such device"])
+        self.assertTrue(found.devs['eth9'] is applied.devs['eth9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
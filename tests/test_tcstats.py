@@ -0,0 +1,202 @@
+# encoding: utf8
+#
+# pyshaper - a dynamic traffic-shaper for Linux 2.4-2.6 based systems.
+#
+# Written in March 2004 by David McNab <david@freenet.org.nz>
+# Copyright (c) 2004 by David McNab
+#
+# Released under the terms of the GNU General Public License.
+#
+# You should have received a file named 'COPYING' with this
+# program. If not, you can review a copy of the GPL at the
+# GNU website, at http://gnu.org
+#
+
+"""
+Tests for working out rates from the tc counts, read from
+FakeRtnlSocket as each filter mode sets things up
+"""
+
+import unittest
+
+from pyshaper import rtnl, tcstats
+from pyshaper.rtnl import FakeRtnlSocket, Rtnl
+from pyshaper.tcstats import TcStats
+
+
+# the connection 'web' has on eth0, as (laddr, lport, raddr, rport, inode)
+webKey = (0x0a000001, 80, 0x0a000002, 40000, 1234)
+
+# what every mode sets up before its filters
+qdiscCmds = [
+    "qdisc add dev eth0 root handle 1: htb default 1000",
+    "class add dev eth0 parent 1: classid 1:1 htb rate 1mbit",
+    "class add dev eth0 parent 1:1 classid 1:101 htb rate 64kbit",
+    "class add dev eth0 parent 1:1 classid 1:1000 htb rate 64kbit",
+    "qdisc add dev eth0 ingress handle ffff:",
+]
+
+# and the filters, for each mode
+filterCmds = {
+    'u32': [
+        "filter add dev eth0 parent 1: protocol ip prio 1 u32 "
+        "match ip src 10.0.0.1 match ip sport 80 0xffff "
+        "match ip dst 10.0.0.2 match ip dport 40000 0xffff flowid 1:101",
+        "filter add dev eth0 parent ffff: protocol ip prio 1 u32 "
+        "match ip src 10.0.0.2 match ip sport 40000 0xffff "
+        "match ip dst 10.0.0.1 match ip dport 80 0xffff "
+        "police rate 32768 burst 10k drop flowid ffff:101",
+    ],
+    'mark': [
+        "filter add dev eth0 parent 1: protocol ip prio 785 "
+        "handle 0x101/0xffff fw flowid 1:101",
+        "filter add dev eth0 parent ffff: protocol ip prio 784 u32 "
+        "match u32 0 0 action connmark continue",
+        "filter add dev eth0 parent ffff: protocol ip prio 785 "
+        "handle 0x101/0xffff fw police rate 32768 burst 10k drop "
+        "flowid ffff:101",
+    ],
+    'flower': [
+        "filter add dev eth0 parent 1: protocol ip prio 784 handle 0x1 "
+        "flower ip_proto tcp src_ip 10.0.0.1 src_port 80 dst_ip 10.0.0.2 "
+        "dst_port 40000 classid 1:101",
+        "filter add dev eth0 parent ffff: protocol ip prio 784 handle 0x1 "
+        "flower ip_proto tcp src_ip 10.0.0.2 src_port 40000 "
+        "dst_ip 10.0.0.1 dst_port 80 classid ffff:101 "
+        "action police rate 32768 burst 10k drop",
+    ],
+    'bpf': [
+        "filter add dev eth0 parent 1: protocol ip prio 786 handle 0x1 "
+        'bpf bytecode "1,6 0 0 65793," classid 1:101',
+        "filter add dev eth0 parent ffff: protocol ip prio 786 "
+        'handle 0x101 bpf bytecode "1,6 0 0 65793," classid ffff:101 '
+        "action police rate 32768 burst 10k drop",
+    ],
+}
+
+
+class Clock:
+    """
+    Stands in for the time module, with time only moving when told to
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ClassIds:
+    """
+    Names minor 0x101 'web', and the default class
+    """
+
+    def name(self, dev, minor):
+        return {0x101: 'web', 0x1000: 'default'}.get(minor, None)
+
+
+class Conn:
+
+    def __init__(self, key):
+        self.key = key
+
+
+class TcStatsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.clock = Clock()
+        self.realTime = tcstats.time
+        tcstats.time = self.clock
+
+    def tearDown(self):
+
+        tcstats.time = self.realTime
+
+    def shaper(self, mode):
+        """
+        Returns a FakeRtnlSocket set up as for filter mode 'mode', and
+        a TcStats reading it
+        """
+        fake = FakeRtnlSocket()
+        sock = Rtnl(fake, fake.ifindex)
+        self.assertEqual(sock.runBatch(qdiscCmds + filterCmds[mode]), [])
+        return fake, TcStats(sock)
+
+    def count(self, fake, count):
+        """
+        Has every class and filter on eth0 count 'count' bytes
+        """
+        for obj in fake.objects:
+            if obj['type'] != rtnl.RTM_NEWQDISC:
+                obj['bytes'], obj['packets'] = count, count / 100
+
+    def rates(self, mode):
+        """
+        Returns the class and connection rates for eth0 set up for
+        mode, two seconds after a poll, with 2000 more bytes counted
+        by every class and filter
+        """
+        fake, stats = self.shaper(mode)
+        self.count(fake, 1000)
+        stats.poll(['eth0', 'eth9'])
+        self.assertEqual(stats.rates, {})
+
+        self.clock.now += 2
+        self.count(fake, 3000)
+        stats.poll(['eth0'])
+        return stats.classRates('eth0', ClassIds()), \
+            stats.connRates(Conn(webKey))
+
+    def testU32(self):
+        classes, conn = self.rates('u32')
+        self.assertEqual(classes, {'web': (1000.0, 1000.0),
+                                   'default': (0.0, 1000.0)})
+        # only the ingress filter has a police action to count with
+        self.assertEqual(conn, (1000.0, None))
+
+    def testMark(self):
+        classes, conn = self.rates('mark')
+        # not counting the connmark filter too
+        self.assertEqual(classes, {'web': (1000.0, 1000.0),
+                                   'default': (0.0, 1000.0)})
+        self.assertEqual(conn, (None, None))
+
+    def testFlower(self):
+        classes, conn = self.rates('flower')
+        self.assertEqual(classes, {'web': (1000.0, 1000.0),
+                                   'default': (0.0, 1000.0)})
+        self.assertEqual(conn, (1000.0, None))
+
+    def testBpf(self):
+        classes, conn = self.rates('bpf')
+        self.assertEqual(classes, {'web': (1000.0, 1000.0),
+                                   'default': (0.0, 1000.0)})
+        self.assertEqual(conn, (None, None))
+
+    def testWindow(self):
+        fake, stats = self.shaper('u32')
+        for i in range(10):
+            self.count(fake, 1000 * i)
+            stats.poll(['eth0'])
+            self.clock.now += 1
+
+        # going from the oldest poll in the last five seconds
+        self.assertEqual(stats.classRates('eth0', ClassIds())['web'],
+                         (1000.0, 1000.0))
+        self.assertEqual(len(stats.samples), 6)
+
+        # counts going back down, as when the filters get rebuilt, make
+        # the rates start again from there
+        self.count(fake, 500)
+        stats.poll(['eth0'])
+        self.assertEqual(stats.rates, {})
+        self.clock.now += 1
+        self.count(fake, 1500)
+        stats.poll(['eth0'])
+        self.assertEqual(stats.connRates(Conn(webKey)), (1000.0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()